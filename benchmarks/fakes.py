@@ -0,0 +1,233 @@
+"""An in-process stand-in for a RabbitMQ broker.
+
+FakeBroker.patch replaces the pika connection classes used by sdc.rabbit
+with FakeConnection, which answers every RPC at once and acknowledges every
+publish, so that consumers and publishers can be driven without a broker or
+a socket. Callbacks that pika would run from its ioloop are queued on a
+FakeIOLoop and run by FakeIOLoop.run_pending, ignoring any delay.
+
+A broker created with sockets=True gives each connection a socket pair,
+held until the connection is closed, so that connections which are never
+closed show up as leaked file descriptors.
+
+"""
+import collections
+import contextlib
+import socket
+from functools import partial
+from unittest import mock
+
+import pika
+from pika import frame, spec
+
+
+class FakeIOLoop(object):
+
+    def __init__(self):
+        self._callbacks = collections.deque()
+        self.running = False
+
+    def call_later(self, delay, callback, *args):
+        handle = partial(callback, *args)
+        self._callbacks.append(handle)
+        return handle
+
+    def add_callback(self, callback, *args):
+        self._callbacks.append(partial(callback, *args))
+
+    add_callback_threadsafe = call_soon_threadsafe = add_callback
+
+    def remove_timeout(self, handle):
+        try:
+            self._callbacks.remove(handle)
+        except ValueError:
+            pass
+
+    def run_pending(self):
+        while self._callbacks:
+            self._callbacks.popleft()()
+
+    def start(self):
+        self.running = True
+        self.run_pending()
+
+    run_forever = start
+
+    def stop(self):
+        self.running = False
+
+
+class FakeChannel(object):
+    """A channel that supports both the blocking and the callback style of
+    pika's channel API.
+    """
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.is_open = True
+        self.is_closed = False
+        self._impl = self
+        self._on_close = []
+        self._on_message = None
+        self._ack_nack_callback = None
+        self._publish_tag = 0
+        self.delivery_tag = 0
+        self.acked = self.nacked = self.rejected = 0
+
+    def _reply(self, callback, method):
+        if callback is not None:
+            self.connection.ioloop.add_callback(callback, frame.Method(self.channel_number, method))
+
+    def add_on_close_callback(self, callback):
+        self._on_close.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        pass
+
+    def add_on_return_callback(self, callback):
+        pass
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False,
+                         arguments=None, callback=None, **kwargs):
+        self._reply(callback, spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue, passive=False, durable=False, arguments=None, callback=None, **kwargs):
+        self._reply(callback, spec.Queue.DeclareOk(queue))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None, callback=None):
+        self._reply(callback, spec.Queue.BindOk())
+
+    def basic_qos(self, prefetch_count=0, callback=None, **kwargs):
+        self._reply(callback, spec.Basic.QosOk())
+
+    def basic_consume(self, queue, on_message_callback, **kwargs):
+        self._on_message = on_message_callback
+        return 'ctag%d' % self.channel_number
+
+    def basic_cancel(self, consumer_tag, callback=None):
+        self._on_message = None
+        self._reply(callback, spec.Basic.CancelOk(consumer_tag))
+
+    def confirm_delivery(self, ack_nack_callback=None, callback=None):
+        self._ack_nack_callback = ack_nack_callback
+        self._reply(callback, spec.Confirm.SelectOk())
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.connection.broker.published += 1
+        self._publish_tag += 1
+        self._reply(self._ack_nack_callback, spec.Basic.Ack(self._publish_tag))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acked += 1
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacked += 1
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.rejected += 1
+
+    def deliver(self, body, headers=None):
+        """Deliver a message to the consumer on this channel."""
+        self.delivery_tag += 1
+        self._on_message(self,
+                         spec.Basic.Deliver(delivery_tag=self.delivery_tag),
+                         spec.BasicProperties(headers=headers),
+                         body)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self._closed(pika.exceptions.ChannelClosedByClient(reply_code, reply_text))
+
+    def _closed(self, reason):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self.is_closed = True
+        for callback in self._on_close:
+            self.connection.ioloop.add_callback(callback, self, reason)
+
+
+class FakeConnection(object):
+    """A connection that accepts the arguments of BlockingConnection,
+    SelectConnection and TornadoConnection.
+    """
+
+    def __init__(self, broker, parameters=None, on_open_callback=None, on_open_error_callback=None,
+                 on_close_callback=None, custom_ioloop=None, **kwargs):
+        self.broker = broker
+        self.ioloop = custom_ioloop or FakeIOLoop()
+        self.is_open = True
+        self.is_closing = False
+        self.is_closed = False
+        self.connection_state = 'OPEN'
+        self.channels = []
+        self._on_close_callback = on_close_callback
+        self._sockets = socket.socketpair() if broker.sockets else ()
+        broker.opened += 1
+        broker.connections.append(self)
+        if on_open_callback is not None:
+            self.ioloop.add_callback(on_open_callback, self)
+
+    def channel(self, channel_number=None, on_open_callback=None):
+        channel = FakeChannel(self, len(self.channels) + 1)
+        self.channels.append(channel)
+        if on_open_callback is not None:
+            self.ioloop.add_callback(on_open_callback, channel)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        self.ioloop.run_pending()
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self._closed(pika.exceptions.ConnectionClosedByClient(reply_code, reply_text))
+
+    def drop(self):
+        """Close the connection as if the broker had gone away."""
+        self._closed(pika.exceptions.ConnectionClosedByBroker(320, 'CONNECTION_FORCED'))
+
+    def _closed(self, reason):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self.is_closed = True
+        self.connection_state = 'CLOSED'
+        for sock in self._sockets:
+            sock.close()
+        self.broker.connections.remove(self)
+        for channel in self.channels:
+            channel._closed(reason)
+        self.channels = []
+        if self._on_close_callback is not None:
+            self.ioloop.add_callback(self._on_close_callback, self, reason)
+
+
+class FakeBroker(object):
+    """Counts what happens across every FakeConnection made while patched."""
+
+    def __init__(self, sockets=False):
+        self.sockets = sockets
+        self.opened = 0
+        self.published = 0
+        self.connections = []
+
+    def connect(self, *args, **kwargs):
+        return FakeConnection(self, *args, **kwargs)
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Make sdc.rabbit connect to this broker rather than to RabbitMQ."""
+        with mock.patch('pika.BlockingConnection', self.connect), \
+                mock.patch('pika.SelectConnection', self.connect), \
+                mock.patch('sdc.rabbit.consumers.TornadoConnection', self.connect), \
+                mock.patch('sdc.rabbit.consumers.AsyncioConnection', self.connect), \
+                mock.patch('sdc.rabbit.publishers.AsyncioConnection', self.connect):
+            yield self
+
+
+def consuming_channel(consumer):
+    """Connect a consumer to the fake broker, returning the channel it
+    consumes from once it is ready for deliveries.
+    """
+    consumer._connection = consumer.connect()
+    consumer._connection.ioloop.run_pending()
+    return consumer._channel
@@ -0,0 +1,169 @@
+"""Long-running soak test for memory, file descriptor and object growth.
+
+Runs a MessageConsumer and publishers, both persistent and connecting for
+each publish, through many simulated deliveries, publishes and forced
+disconnects against the fake broker in benchmarks.fakes, which holds a
+socket pair for each open connection. Every --sample-every iterations it
+records memory traced by tracemalloc, open file descriptors and live
+objects, and it fails if any of them has grown by more than its bound
+between the first sample and the last.
+
+Run from the root of the repository:
+
+    python -m benchmarks.soak [--iterations N] [--disconnect-every N]
+                              [--max-memory-growth BYTES]
+                              [--max-fd-growth N] [--max-object-growth N]
+
+"""
+import argparse
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+from sdc.rabbit import MessageConsumer, QueuePublisher
+
+from benchmarks.fakes import FakeBroker, consuming_channel
+from benchmarks.run import URL, isolated
+
+Sample = namedtuple('Sample', ['iteration', 'seconds', 'memory', 'fds', 'objects', 'connections'])
+
+
+def open_fds():
+    """
+    :returns: The number of file descriptors the process has open, or None
+        if the platform does not say
+    :rtype: int
+    """
+    for path in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return None
+
+
+class Soak(object):
+    """Drives the library through a fixed cycle of work, one iteration at a
+    time, against a fake broker.
+    """
+
+    def __init__(self, broker, disconnect_every, payload_size=1024):
+        self.broker = broker
+        self.disconnect_every = disconnect_every
+        self.body = b'x' * payload_size
+        self.headers = {'tx_id': 'soak'}
+        self.consumer = MessageConsumer(True, 'soak', 'topic', 'soak', [URL],
+                                        QueuePublisher([URL], 'soak-quarantine', **isolated()),
+                                        lambda body, tx_id: None,
+                                        reconnect_delay=0,
+                                        **isolated())
+        self.persistent = QueuePublisher([URL], 'soak', persistent=True, confirm_delivery=True, **isolated())
+        self.per_publish = QueuePublisher([URL], 'soak', **isolated())
+        self.channel = consuming_channel(self.consumer)
+
+    def iteration(self, index):
+        self.channel.deliver(self.body, self.headers)
+        self.persistent.publish_message(self.body)
+        if index % 10 == 0:
+            self.per_publish.publish_message(self.body)
+        if index % self.disconnect_every == 0:
+            self.disconnect()
+
+    def disconnect(self):
+        """Drop every connection, as when the broker restarts, and let the
+        consumer and persistent publisher reconnect.
+        """
+        for connection in list(self.broker.connections):
+            connection.drop()
+        ioloop = self.consumer._connection.ioloop
+        ioloop.run_pending()
+        self.consumer._connection.ioloop.run_pending()
+        self.channel = self.consumer._channel
+
+    def close(self):
+        self.persistent.close()
+        self.consumer.stop()
+        self.consumer._connection.ioloop.run_pending()
+
+
+def sample(iteration, started, broker):
+    gc.collect()
+    return Sample(iteration,
+                  time.monotonic() - started,
+                  tracemalloc.get_traced_memory()[0],
+                  open_fds(),
+                  len(gc.get_objects()),
+                  len(broker.connections))
+
+
+def growth(first, last):
+    return {
+        'memory': last.memory - first.memory,
+        'fds': None if first.fds is None else last.fds - first.fds,
+        'objects': last.objects - first.objects,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=1000000,
+                        help='Deliveries to simulate, each with a publish')
+    parser.add_argument('--disconnect-every', type=int, default=1000, help='Iterations between forced disconnects')
+    parser.add_argument('--sample-every', type=int, default=None, help='Iterations between samples')
+    parser.add_argument('--warm-up', type=float, default=0.1, help='Fraction of iterations to run before the first sample')
+    parser.add_argument('--max-memory-growth', type=int, default=4 * 1024 * 1024, help='Bytes')
+    parser.add_argument('--max-fd-growth', type=int, default=2)
+    parser.add_argument('--max-object-growth', type=int, default=5000)
+    parser.add_argument('--top', type=int, default=10, help='Allocation sites to show that grew the most')
+    args = parser.parse_args(argv)
+    sample_every = args.sample_every or max(1, args.iterations // 20)
+    warm_up = int(args.iterations * args.warm_up)
+
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+
+    samples = []
+    broker = FakeBroker(sockets=True)
+    with broker.patch():
+        soak = Soak(broker, args.disconnect_every)
+        tracemalloc.start()
+        started = time.monotonic()
+        first_snapshot = None
+        sys.stdout.write('%10s %8s %14s %6s %10s %12s\n' % ('iteration', 'seconds', 'traced bytes', 'fds',
+                                                            'objects', 'connections'))
+        for index in range(1, args.iterations + 1):
+            soak.iteration(index)
+            if index >= warm_up and (index - warm_up) % sample_every == 0:
+                samples.append(sample(index, started, broker))
+                sys.stdout.write('%10d %8.1f %14d %6s %10d %12d\n' % samples[-1])
+                if first_snapshot is None:
+                    first_snapshot = tracemalloc.take_snapshot()
+        last_snapshot = tracemalloc.take_snapshot()
+        soak.close()
+        tracemalloc.stop()
+
+    if len(samples) < 2:
+        sys.stdout.write('Too few samples to measure growth; run more iterations\n')
+        return 1
+
+    grown = growth(samples[0], samples[-1])
+    sys.stdout.write('\nGrowth since iteration %d: %s\n' % (samples[0].iteration, grown))
+    for stat in last_snapshot.compare_to(first_snapshot, 'lineno')[:args.top]:
+        sys.stdout.write('  %s\n' % stat)
+
+    failures = []
+    if grown['memory'] > args.max_memory_growth:
+        failures.append('memory grew by %d bytes' % grown['memory'])
+    if grown['fds'] is not None and grown['fds'] > args.max_fd_growth:
+        failures.append('open file descriptors grew by %d' % grown['fds'])
+    if grown['objects'] > args.max_object_growth:
+        failures.append('live objects grew by %d' % grown['objects'])
+    for failure in failures:
+        sys.stdout.write('FAILED: %s\n' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,18 @@ import logging
 from logging import NullHandler
 
 from sdc.rabbit.consumers import AsyncConsumer, MessageConsumer, TornadoConsumer  # noqa
+from sdc.rabbit.consumers import AsyncioConsumer, AsyncioMessageConsumer, BatchMessageConsumer, Message  # noqa
 from sdc.rabbit.publishers import DurableExchangePublisher, ExchangePublisher, QueuePublisher  # noqa
+from sdc.rabbit.publishers import AsyncioDurableExchangePublisher, AsyncioExchangePublisher, AsyncioQueuePublisher  # noqa
+from sdc.rabbit.publishers import BufferedPublisher  # noqa
+from sdc.rabbit.metrics import PrometheusExporter, Registry, registry  # noqa
+from sdc.rabbit.hotpath import HotPathLogger, Lazy, start_background_logging  # noqa
+from sdc.rabbit.serialisation import Serialiser, SerialiserRegistry, serialisers  # noqa
+from sdc.rabbit.dedup import DedupStore, RedisDedupStore  # noqa
+from sdc.rabbit.journal import Journal, JournalDrainer  # noqa
+from sdc.rabbit.pool import ConnectionPool, shared_pool  # noqa
+from sdc.rabbit.nodes import NodeSelector, node_selector  # noqa
+from sdc.rabbit.topology import TopologyRegistry, shared_topology  # noqa
 
 
 logging.getLogger(__name__).addHandler(NullHandler())
@@ -0,0 +1,90 @@
+import time
+
+
+class AckBatcher(object):
+    """Coalesces acknowledgements for a channel so that one Basic.Ack with
+    multiple=True can settle many deliveries.
+
+    An ack with multiple=True settles every outstanding delivery up to its
+    tag, so acks are only released up to the highest acked tag below the
+    oldest delivery that is still being processed. Deliveries that are
+    nacked or rejected are sent individually and reported with settled.
+
+    """
+
+    def __init__(self, max_pending=100, max_delay=0.5):
+        """Create a new instance of the AckBatcher class
+
+        :param max_pending: Number of pending acks that makes a flush due
+        :param max_delay: Seconds after which a pending ack makes a flush due
+
+        :returns: Object of type AckBatcher
+        :rtype: AckBatcher
+
+        """
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.reset()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def reset(self):
+        """
+        Forget every delivery, as when the channel they arrived on closes.
+
+        :returns: None
+
+        """
+        self._unsettled = set()
+        self._pending = []
+        self._oldest = None
+
+    def delivered(self, delivery_tag):
+        """Record a delivery that has yet to be settled."""
+        self._unsettled.add(delivery_tag)
+
+    def settled(self, delivery_tag):
+        """Record a delivery that was nacked or rejected individually."""
+        self._unsettled.discard(delivery_tag)
+
+    def acked(self, delivery_tag):
+        """Record a delivery whose ack can be coalesced."""
+        self._unsettled.discard(delivery_tag)
+        self._pending.append(delivery_tag)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def due(self):
+        """
+        :returns: Whether enough acks are pending, or for long enough, to flush
+        :rtype: bool
+
+        """
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.max_pending:
+            return True
+        return time.monotonic() - self._oldest >= self.max_delay
+
+    def take(self):
+        """
+        Remove the acks that can be sent now.
+
+        :returns: The delivery tag to ack with multiple=True, and the number
+            of deliveries it settles, or (None, 0) if none can be sent yet
+        :rtype: tuple
+
+        """
+        if self._unsettled:
+            limit = min(self._unsettled)
+            ready = [tag for tag in self._pending if tag < limit]
+        else:
+            ready = self._pending
+        if not ready:
+            return None, 0
+
+        delivery_tag = max(ready)
+        self._pending = [tag for tag in self._pending if tag > delivery_tag]
+        self._oldest = time.monotonic() if self._pending else None
+        return delivery_tag, len(ready)
@@ -0,0 +1,150 @@
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+DEFLATE = 'deflate'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+
+
+class Codec(object):
+    """A compression algorithm, named by the content_encoding it sets."""
+
+    def __init__(self, name, compress, decompress):
+        """Create a new instance of the Codec class
+
+        :param name: The content_encoding of messages compressed with it
+        :param compress: Function of the body and a compression level, or
+            None for the default, returning the compressed body
+        :param decompress: Function of a compressed body returning the body
+
+        :returns: Object of type Codec
+        :rtype: Codec
+
+        """
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _zlib_compress(body, level=None):
+    return zlib.compress(body, -1 if level is None else level)
+
+
+def _zstd_compress(body, level=None):
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress(body)
+
+
+def _zstd_decompress(body):
+    # Frames written by ZstdCompressor.compress carry their content size
+    return zstandard.ZstdDecompressor().decompress(body)
+
+
+def _lz4_compress(body, level=None):
+    return lz4.frame.compress(body, compression_level=0 if level is None else level)
+
+
+_codecs = {DEFLATE: Codec(DEFLATE, _zlib_compress, zlib.decompress)}
+if zstandard is not None:
+    _codecs[ZSTD] = Codec(ZSTD, _zstd_compress, _zstd_decompress)
+if lz4 is not None:
+    _codecs[LZ4] = Codec(LZ4, _lz4_compress, lz4.frame.decompress)
+
+
+def available():
+    """
+    :returns: The names of the codecs that can be used, zstd and lz4 only
+        being available if the zstandard and lz4 packages are installed
+    :rtype: list
+
+    """
+    return sorted(_codecs)
+
+
+def get_codec(name):
+    """
+    :param name: A codec name, as set in content_encoding
+
+    :returns: The codec, or None if name is not a codec that is available,
+        as for messages with no content_encoding or one such as utf-8
+    :rtype: Codec
+
+    """
+    return _codecs.get(name)
+
+
+class Compressor(object):
+    """Compresses message bodies of at least threshold bytes with a codec."""
+
+    def __init__(self, codec, threshold=1024, level=None):
+        """Create a new instance of the Compressor class
+
+        :param codec: Name of the codec to compress with
+        :param threshold: Size in bytes below which bodies are published
+            as they are
+        :param level: Compression level, or None for the codec's default
+
+        :returns: Object of type Compressor
+        :rtype: Compressor
+
+        """
+        self.codec = get_codec(codec)
+        if self.codec is None:
+            raise ValueError('Compression codec %s is not available, choose from %s' % (codec, ', '.join(available())))
+        self.threshold = threshold
+        self.level = level
+
+    def compress(self, body):
+        """
+        Compress body if it is large enough.
+
+        :param body: Message body, as bytes or str
+
+        :returns: The body to publish, its content_encoding, or None if it
+            was not compressed, and if compression was attempted, the size
+            of the compressed body relative to the original and the seconds
+            compressing took. A body that does not get any smaller is
+            published as it is
+        :rtype: tuple
+
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if len(body) < self.threshold:
+            return body, None, None, None
+        started = time.monotonic()
+        compressed = self.codec.compress(body, self.level)
+        seconds = time.monotonic() - started
+        ratio = len(compressed) / len(body)
+        if ratio >= 1:
+            return body, None, ratio, seconds
+        return compressed, self.codec.name, ratio, seconds
+
+
+def decompress(body, content_encoding):
+    """
+    Decompress a message body according to its content_encoding.
+
+    :param body: Message body as delivered
+    :param content_encoding: The message's content_encoding property
+
+    :returns: The decompressed body, or body itself if content_encoding is
+        not a codec, and whether it was decompressed
+    :rtype: tuple
+
+    :raises Exception: If the body is not valid for its codec
+
+    """
+    codec = get_codec(content_encoding)
+    if codec is None:
+        return body, False
+    return codec.decompress(body), True
@@ -0,0 +1,123 @@
+import logging
+import time
+from collections import OrderedDict
+
+import pika
+from structlog import wrap_logger
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+ACKED = 'ack'
+NACKED = 'nack'
+RETURNED = 'returned'
+UNCONFIRMED = 'unconfirmed'
+
+
+class ConfirmTracker(object):
+    """Tracks messages published on a channel in confirm mode, calling back
+    with each message's outcome once the broker has confirmed it.
+
+    Delivery tags are assigned in publish order, starting from 1, exactly as
+    the broker numbers them, so every publish on the tracked channel must be
+    registered with add. A Basic.Return is reported against the message
+    confirmed by the Basic.Ack that follows it.
+
+    """
+
+    def __init__(self, observe=None):
+        """Create a new instance of the ConfirmTracker class
+
+        :param observe: Called with the seconds each message waited for its
+            Basic.Ack or Basic.Nack, such as a histogram's observe
+
+        :returns: Object of type ConfirmTracker
+        :rtype: ConfirmTracker
+
+        """
+        self._observe = observe
+        self._pending = OrderedDict()
+        self._next_tag = 1
+        self._returned = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def reset(self):
+        """
+        Start numbering again for a newly opened channel. Messages still
+        awaiting a confirm on the old channel are reported as unconfirmed.
+
+        :returns: None
+
+        """
+        self.fail_all()
+        self._next_tag = 1
+        self._returned = False
+
+    def add(self, callback):
+        """
+        Register the next message to be published.
+
+        :param callback: Called with the message's outcome; one of ACKED,
+            NACKED, RETURNED or UNCONFIRMED
+
+        :returns: The delivery tag the broker will confirm the message with
+        :rtype: int
+
+        """
+        tag = self._next_tag
+        self._next_tag += 1
+        self._pending[tag] = (callback, time.monotonic())
+        return tag
+
+    def fail_all(self, outcome=UNCONFIRMED):
+        """
+        Resolve every message still awaiting a confirm with outcome.
+
+        :returns: None
+
+        """
+        pending, self._pending = self._pending, OrderedDict()
+        for callback, _ in pending.values():
+            callback(outcome)
+
+    def on_delivery_confirmation(self, method_frame):
+        """
+        Invoked by pika when the broker sends a Basic.Ack or Basic.Nack.
+
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+
+        """
+        method = method_frame.method
+        if isinstance(method, pika.spec.Basic.Nack):
+            outcome = NACKED
+        else:
+            outcome = ACKED
+
+        if method.multiple:
+            tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        now = time.monotonic()
+        for tag in tags:
+            callback, published = self._pending.pop(tag, (None, None))
+            if callback is None:
+                continue
+            if self._observe is not None:
+                self._observe(now - published)
+            if outcome == ACKED and self._returned and tag == method.delivery_tag:
+                callback(RETURNED)
+            else:
+                callback(outcome)
+        self._returned = False
+
+    def on_message_returned(self, unused_channel, method, unused_properties, unused_body):
+        """
+        Invoked by pika when the broker returns an unroutable message.
+
+        :param pika.spec.Basic.Return method: Basic.Return method
+
+        """
+        logger.warning('Message returned by broker', reply_text=method.reply_text)
+        self._returned = True
@@ -1,15 +1,115 @@
+import asyncio
+import inspect
 import logging
+import os
+import pickle
+import random
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
 from pika.adapters.tornado_connection import TornadoConnection
 from structlog import wrap_logger
 
+from sdc.rabbit.acks import AckBatcher
+from sdc.rabbit.compression import decompress, get_codec
+from sdc.rabbit.confirms import ACKED, ConfirmTracker
+from sdc.rabbit.hotpath import HotPathLogger
+from sdc.rabbit.journal import JournalDrainer
+from sdc.rabbit.metrics import ConsumerMetrics, registry
+from sdc.rabbit.nodes import node_selector
+from sdc.rabbit.publishers import Publisher
+from sdc.rabbit.serialisation import JSON
+from sdc.rabbit.serialisation import serialisers as default_serialisers
+from sdc.rabbit.topology import DECLARE, PASSIVE, SKIP, shared_topology
 from sdc.rabbit.exceptions import BadMessageError, RetryableError
 from sdc.rabbit.exceptions import PublishMessageError, QuarantinableError
 
 logger = wrap_logger(logging.getLogger(__name__))
 
+Message = namedtuple('Message', ['body', 'tx_id', 'delivery_tag'])
+
+
+BODY_TYPES = (str, bytes, memoryview)
+
+RETRY_COUNT_HEADER = 'retry_count'
+
+
+def _convert_body(body, body_type=str):
+    """Convert a message body as delivered by pika to body_type. Only str
+    copies the body; bytes passes it through and memoryview wraps it.
+
+    """
+    if body_type is str:
+        return body.decode("utf-8")
+    if body_type is memoryview:
+        return memoryview(body)
+    return body
+
+
+def _decode_body(body, body_type=str, serialiser=None, observe=None):
+    """Deserialise a message body with serialiser if one is given, otherwise
+    convert it to body_type.
+
+    :param observe: Called with the seconds that deserialising took
+
+    :raises BadMessageError: If the body cannot be deserialised
+    """
+    if serialiser is None:
+        return _convert_body(body, body_type)
+    started = time.monotonic()
+    try:
+        decoded = serialiser.loads(body)
+    except Exception:
+        logger.exception("Unable to deserialise message", content_type=serialiser.content_type)
+        raise BadMessageError
+    if observe is not None:
+        observe(time.monotonic() - started)
+    return decoded
+
+
+def _run_process(process, body, tx_id, body_type=str, serialiser=None, observe=None):
+    """Call a MessageConsumer's process callback with the message body,
+    deserialised with serialiser or otherwise converted to body_type. This
+    is a module level function so that it can be run in a worker process.
+
+    """
+    try:
+        return process(_decode_body(body, body_type, serialiser, observe), tx_id)
+    except TypeError:
+        logger.error('Incorrect call to process method')
+        raise QuarantinableError
+
+
+# The serialiser registry of the consumer that started a worker process
+_worker_serialisers = None
+
+
+def _init_worker_process(serialisers):
+    global _worker_serialisers
+    _worker_serialisers = serialisers
+
+
+def _run_in_worker_process(process, body, tx_id, body_type=str, content_type=None):
+    """Call _run_process in a worker process, looking the serialiser for
+    content_type up in the registry the worker was started with, as
+    serialisers themselves may not be picklable.
+
+    """
+    serialiser = None
+    if content_type is not None:
+        serialiser = _worker_serialisers.get(content_type)
+    return _run_process(process, body, tx_id, body_type, serialiser)
+
+
+def _warm_up():
+    return os.getpid()
+
 
 class AsyncConsumer:
     """This is an example consumer that will handle unexpected interactions
@@ -30,7 +130,18 @@ class AsyncConsumer:
                  exchange,
                  exchange_type,
                  rabbit_queue,
-                 rabbit_urls):
+                 rabbit_urls,
+                 prefetch_count=1,
+                 ack_batch_size=None,
+                 ack_batch_interval=0.5,
+                 reconnect_delay=1,
+                 max_reconnect_delay=60,
+                 nodes=None,
+                 topology_mode=DECLARE,
+                 topology=None,
+                 metrics=None,
+                 log_sample_rate=1,
+                 log_summary_interval=None):
         """Create a new instance of the AsyncConsumer class.
 
         :param durable_queue: Boolean specifying whether queue is durable
@@ -38,6 +149,32 @@ class AsyncConsumer:
         :param exchange_type: RabbitMQ exchange type
         :param rabbit_queue: RabbitMQ queue name
         :param rabbit_urls: List of rabbit urls
+        :param prefetch_count: Number of unacknowledged messages RabbitMQ may
+            deliver to the consumer at once
+        :param ack_batch_size: If set, coalesce acknowledgements, sending one
+            Basic.Ack with multiple=True once this many are pending
+        :param ack_batch_interval: Seconds after which pending acknowledgements
+            are sent regardless of how many there are
+        :param reconnect_delay: Seconds to wait before the first reconnection
+            attempt. The delay doubles with each failed attempt, with jitter
+        :param max_reconnect_delay: Cap on the delay between reconnection
+            attempts, in seconds
+        :param nodes: sdc.rabbit.nodes.NodeSelector that chooses which of
+            rabbit_urls to connect to. Defaults to the one shared by every
+            consumer and publisher of the same URLs
+        :param topology_mode: How to treat the exchange, queue and binding
+            once they are known to have been declared on a broker. DECLARE
+            declares them again, PASSIVE only checks the exchange and queue
+            exist, and SKIP makes no declarations at all
+        :param topology: sdc.rabbit.topology.TopologyRegistry recording what
+            has been declared. Defaults to the one shared by the process
+        :param metrics: sdc.rabbit.metrics.Registry to record metrics in.
+            Defaults to the global one
+        :param log_sample_rate: Fraction of the lines logged for each message,
+            such as on receipt and acknowledgement, to write. Errors are
+            always logged in full
+        :param log_summary_interval: If set, seconds between lines counting
+            the per-message lines, including those sampled out
 
         :returns Object of type AsyncConsumer
         :rtype AsyncConsumer
@@ -48,13 +185,30 @@ class AsyncConsumer:
         self._durable_queue = durable_queue
         self._queue = rabbit_queue
         self._rabbit_urls = rabbit_urls
+        self._prefetch_count = prefetch_count
+        self._acks = None
+        if ack_batch_size is not None:
+            self._acks = AckBatcher(ack_batch_size, ack_batch_interval)
+        self._ack_timer = None
 
         self._connection = None
         self._channel = None
         self._closing = False
         self._consumer_tag = None
         self._url = None
+        self._nodes = nodes or node_selector(rabbit_urls)
+        self._connect_started = None
+        self._topology_mode = topology_mode
+        self._topology = shared_topology() if topology is None else topology
+        self._declaring = set()
+        self._metrics = ConsumerMetrics(registry if metrics is None else metrics, rabbit_queue)
+        self._delivered_at = {}
+        self._log = HotPathLogger(__name__, log_sample_rate, log_summary_interval)
         self._count = 1
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._disconnected_at = None
+        self.last_reconnect_duration = None
 
     def connect(self):
         """This method connects to RabbitMQ using a SelectConnection object,
@@ -63,27 +217,29 @@ class AsyncConsumer:
         When the connection is established, the on_connection_open method
         will be invoked by pika.
 
+        If the connection object cannot be created at all, the node is marked
+        as failed and reconnect schedules another attempt on the ioloop, and
+        the previous connection handle is returned so that its ioloop is kept.
+        On the first attempt there is no ioloop to wait on yet, so the error
+        is raised.
+
         :rtype: pika.SelectConnection
 
         """
+        self._url = self._nodes.select()
+        self._connect_started = time.monotonic()
 
-        no_of_servers = len(self._rabbit_urls)
-
-        while True:
-            server_choice = (self._count % no_of_servers) - 1
-
-            self._url = self._rabbit_urls[server_choice]
-
-            try:
-                logger.info('Connecting', attempt=self._count)
-                return pika.SelectConnection(pika.URLParameters(self._url),
-                                             on_open_callback=self.on_connection_open,
-                                             on_open_error_callback=self.on_connection_open_error,
-                                             on_close_callback=self.on_connection_closed)
-            except pika.exceptions.AMQPConnectionError:
-                logger.exception("Connection error")
-                self._delay_before_reconnect()
-                continue
+        try:
+            logger.info('Connecting', attempt=self._count)
+            # Reuse the running ioloop when reconnecting
+            ioloop = self._connection.ioloop if self._connection else None
+            return pika.SelectConnection(pika.URLParameters(self._url),
+                                         on_open_callback=self.on_connection_open,
+                                         on_open_error_callback=self.on_connection_open_error,
+                                         on_close_callback=self.on_connection_closed,
+                                         custom_ioloop=ioloop)
+        except pika.exceptions.AMQPConnectionError:
+            return self._on_connect_error()
 
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
@@ -100,6 +256,16 @@ class AsyncConsumer:
         """
         logger.info('Connection opened')
         self._count = 1  # Reset count on successful connection
+        if self._connect_started is not None:
+            connect_seconds = time.monotonic() - self._connect_started
+            self._nodes.succeeded(self._url, connect_seconds)
+            self._metrics.connect_seconds.observe(connect_seconds)
+        if self._disconnected_at is not None:
+            self.last_reconnect_duration = time.monotonic() - self._disconnected_at
+            self._disconnected_at = None
+            self._metrics.reconnects.inc()
+            self._metrics.reconnect_seconds.observe(self.last_reconnect_duration)
+            logger.info('Reconnected', seconds=round(self.last_reconnect_duration, 3))
         self.open_channel()
 
     def on_connection_open_error(self, _unused_connection, error):
@@ -109,6 +275,7 @@ class AsyncConsumer:
         :param Exception err: The error
         """
         logger.error('Connection open failed', error=error)
+        self._nodes.failed(self._url)
         self.reconnect()
 
     def on_connection_closed(self, _unused_connection, reason):
@@ -125,14 +292,27 @@ class AsyncConsumer:
             self._connection.ioloop.stop()
         else:
             logger.warning('Connection closed, reconnect necessary', reason=reason)
+            if not isinstance(reason, pika.exceptions.ConnectionClosedByClient):
+                # The broker may have restarted and lost non-durable topology.
+                # Closes the client asked for, such as after a channel error,
+                # say nothing about the node's health
+                self._topology.forget(self._url)
+                self._nodes.failed(self._url)
             self.reconnect()
 
     def reconnect(self):
-        """Will be invoked by the IOLoop timer if the connection is
-        closed. See the on_connection_closed method.
+        """Invoked if the connection is closed or could not be opened. See the
+        on_connection_closed method. Schedules a reconnection attempt on the
+        ioloop after a backoff delay, without blocking it.
 
         """
-        self._delay_before_reconnect()
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+        delay = self._next_reconnect_delay()
+        logger.info("Reconnecting", in_seconds=round(delay, 3), attempt=self._count)
+        self._connection.ioloop.call_later(delay, self._reconnect_now)
+
+    def _reconnect_now(self):
         logger.info("Reconnecting", is_closing=self._closing)
         if not self._closing:
             # Create a new connection
@@ -153,15 +333,18 @@ class AsyncConsumer:
         """This method is invoked by pika when the channel has been opened.
         The channel object is passed in so we can make use of it.
 
-        Since the channel is now open, we'll declare the exchange to use.
+        Since the channel is now open, we'll declare the topology to use.
 
         :param pika.channel.Channel channel: The channel object
 
         """
         logger.info('Channel opened', channel=channel)
         self._channel = channel
+        self._delivered_at = {}
+        if self._acks is not None:
+            self._acks.reset()
         self.add_on_channel_close_callback()
-        self.setup_exchange(self._exchange)
+        self.setup_topology()
 
     def add_on_channel_close_callback(self):
         """This method tells pika to call the on_channel_closed method if
@@ -181,19 +364,76 @@ class AsyncConsumer:
         :param Exception reason: why the channel was closed
         """
         logger.warning('Channel was closed', channel=channel, reason=reason)
+        if isinstance(reason, pika.exceptions.ChannelClosedByBroker):
+            # A declaration may no longer match what exists on the broker
+            self._topology.forget(self._url)
+        if self._acks is not None and len(self._acks):
+            logger.warning('Dropping pending acknowledgements, messages will be redelivered',
+                           count=len(self._acks))
+            self._acks.reset()
         self.close_connection()
 
-    def setup_exchange(self, exchange_name):
+    def setup_topology(self):
+        """Declare the exchange and queue and bind them together, then start
+        consuming once every declaration has completed.
+
+        Declarations that the topology registry knows have already been made
+        on this broker are made passively or skipped, according to
+        topology_mode. The rest are issued back to back rather than each
+        waiting for the previous one's callback; pika sends each as soon as
+        the broker has answered the one before, and the broker applies them
+        in order.
+
+        """
+        self._declaring = set()
+        exchange = self._declaration_mode(('exchange', self._exchange))
+        queue = self._declaration_mode(('queue', self._queue))
+        binding = self._declaration_mode(('binding', self._queue, self._exchange))
+        if binding == PASSIVE:
+            binding = SKIP  # Bindings cannot be checked passively
+
+        if exchange != SKIP:
+            self.setup_exchange(self._exchange, passive=exchange == PASSIVE)
+        if queue != SKIP:
+            self.setup_queue(self._queue, passive=queue == PASSIVE)
+        if binding != SKIP:
+            self.bind_queue()
+        self.setup_extra_queues()
+
+        if not self._declaring:
+            logger.info('Topology already declared')
+            self.start_consuming()
+
+    def setup_extra_queues(self):
+        """Declare any queues other than the one consumed from, before
+        consuming starts. Does nothing unless overridden.
+
+        """
+        pass
+
+    def _declaration_mode(self, key):
+        return self._topology.mode(self._url, key, self._topology_mode)
+
+    def _declared(self, key):
+        self._topology.declared(self._url, key)
+        self._declaring.discard(key)
+        if not self._declaring:
+            self.start_consuming()
+
+    def setup_exchange(self, exchange_name, passive=False):
         """Setup the exchange on RabbitMQ by invoking the Exchange.Declare RPC
         command. When it is complete, the on_exchange_declareok method will
         be invoked by pika.
 
         :param str|unicode exchange_name: The name of the exchange to declare
+        :param bool passive: Only check that the exchange exists
         """
-        logger.info('Declaring exchange', name=exchange_name)
+        logger.info('Declaring exchange', name=exchange_name, passive=passive)
+        self._declaring.add(('exchange', exchange_name))
         self._channel.exchange_declare(
             exchange=exchange_name,
             exchange_type=self._exchange_type,
+            passive=passive,
             callback=self.on_exchange_declareok)
 
     def on_exchange_declareok(self, unused_frame):
@@ -204,44 +444,52 @@ class AsyncConsumer:
 
         """
         logger.info('Exchange declared')
-        self.setup_queue(self._queue)
+        self._declared(('exchange', self._exchange))
 
-    def setup_queue(self, queue_name):
+    def setup_queue(self, queue_name, passive=False):
         """Setup the queue on RabbitMQ by invoking the Queue.Declare RPC
         command. When it is complete, the on_queue_declareok method will
         be invoked by pika.
         :param str|unicode queue_name: The name of the queue to declare.
+        :param bool passive: Only check that the queue exists
         """
-        logger.info('Declaring queue', name=queue_name)
+        logger.info('Declaring queue', name=queue_name, passive=passive)
+        self._declaring.add(('queue', queue_name))
         self._channel.queue_declare(queue=queue_name,
                                     durable=self._durable_queue,
+                                    passive=passive,
                                     callback=self.on_queue_declareok)
 
     def on_queue_declareok(self, _unused_frame):
         """Method invoked by pika when the Queue.Declare RPC call made in
-        setup_queue has completed. In this method we will bind the queue
-        and exchange together with the routing key by issuing the Queue.Bind
-        RPC command. When this command is complete, the on_bindok method will
-        be invoked by pika.
+        setup_queue has completed.
 
         :param pika.frame.Method _unused_frame: The Queue.DeclareOk frame
+        """
+        logger.info('Queue declared')
+        self._declared(('queue', self._queue))
+
+    def bind_queue(self):
+        """Bind the queue and exchange together by issuing the Queue.Bind RPC
+        command. When this command is complete, the on_bindok method will
+        be invoked by pika.
+
         """
         logger.info('Binding to rabbit', exchange=self._exchange, queue=self._queue)
+        self._declaring.add(('binding', self._queue, self._exchange))
         self._channel.queue_bind(
             self._queue,
             self._exchange,
             callback=self.on_bindok)
 
     def on_bindok(self, _unused_frame):
-        """Invoked by pika when the Queue.Bind method has completed. At this
-        point we will start consuming messages by calling start_consuming
-        which will invoke the needed RPC commands to start the process.
+        """Invoked by pika when the Queue.Bind method has completed.
 
         :param pika.frame.Method _unused_frame: The Queue.BindOk response frame
 
         """
         logger.info('Queue bound')
-        self.start_consuming()
+        self._declared(('binding', self._queue, self._exchange))
 
     def start_consuming(self):
         """This method sets up the consumer by first calling
@@ -255,7 +503,7 @@ class AsyncConsumer:
         """
         logger.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
-        self._channel.basic_qos(prefetch_count=1)
+        self._channel.basic_qos(prefetch_count=self._prefetch_count)
         self._consumer_tag = self._channel.basic_consume(self._queue,
                                                          self.on_message)
 
@@ -287,9 +535,52 @@ class AsyncConsumer:
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
-        logger.info('Acknowledging message', delivery_tag=delivery_tag, **kwargs)
+        self._metrics.acks.inc()
+        self._settled(delivery_tag)
+        if self._acks is not None:
+            self._log.debug('Acknowledging message', delivery_tag=delivery_tag, **kwargs)
+            self._acks.acked(delivery_tag)
+            self._maybe_flush_acks()
+            return
+
+        self._log.info('Acknowledging message', delivery_tag=delivery_tag, **kwargs)
         self._channel.basic_ack(delivery_tag)
 
+    def flush_acks(self):
+        """Send any coalesced acknowledgements that can be sent, as a single
+        Basic.Ack with multiple=True.
+
+        """
+        if self._acks is None or self._channel is None:
+            return
+        delivery_tag, count = self._acks.take()
+        if delivery_tag is not None:
+            self._log.info('Acknowledging messages', delivery_tag=delivery_tag, count=count)
+            self._channel.basic_ack(delivery_tag, multiple=True)
+
+    def _maybe_flush_acks(self):
+        if self._acks.due():
+            self.flush_acks()
+        if len(self._acks) and self._ack_timer is None:
+            self._ack_timer = self._connection.ioloop.call_later(self._acks.max_delay,
+                                                                 self._on_ack_timer)
+
+    def _on_ack_timer(self):
+        self._ack_timer = None
+        if self._acks is not None and self._channel is not None:
+            self._maybe_flush_acks()
+
+    def _delivered(self, delivery_tag):
+        self._metrics.deliveries.inc()
+        self._delivered_at[delivery_tag] = time.monotonic()
+        if self._acks is not None:
+            self._acks.delivered(delivery_tag)
+
+    def _settled(self, delivery_tag):
+        delivered_at = self._delivered_at.pop(delivery_tag, None)
+        if delivered_at is not None:
+            self._metrics.process_seconds.observe(time.monotonic() - delivered_at)
+
     def nack_message(self, delivery_tag, **kwargs):
         """Negative acknowledge a message
 
@@ -298,6 +589,11 @@ class AsyncConsumer:
         """
         logger.info('Nacking message', delivery_tag=delivery_tag, **kwargs)
         self._channel.basic_nack(delivery_tag)
+        self._metrics.nacks.inc()
+        self._settled(delivery_tag)
+        if self._acks is not None:
+            self._acks.settled(delivery_tag)
+            self._maybe_flush_acks()
 
     def reject_message(self, delivery_tag, requeue=False, **kwargs):
         """Reject the message delivery from RabbitMQ by sending a
@@ -307,6 +603,11 @@ class AsyncConsumer:
         """
         logger.info('Rejecting message', delivery_tag=delivery_tag, **kwargs)
         self._channel.basic_reject(delivery_tag, requeue=requeue)
+        self._metrics.rejects.inc()
+        self._settled(delivery_tag)
+        if self._acks is not None:
+            self._acks.settled(delivery_tag)
+            self._maybe_flush_acks()
 
     def on_message(self, unused_channel, basic_deliver, properties, body):
         """Invoked by pika when a message is delivered from RabbitMQ. The
@@ -322,7 +623,8 @@ class AsyncConsumer:
         :param str|unicode body: The message body
 
         """
-        logger.info(
+        self._delivered(basic_deliver.delivery_tag)
+        self._log.info(
             'Received message',
             delivery_tag=basic_deliver.delivery_tag,
             app_id=properties.app_id,
@@ -355,6 +657,7 @@ class AsyncConsumer:
         Channel.Close RPC command.
 
         """
+        self.flush_acks()
         logger.info('Closing the channel')
         self._channel.close()
 
@@ -380,15 +683,46 @@ class AsyncConsumer:
         """
         logger.info('Stopping')
         self._closing = True
+        self.flush_acks()
         self.stop_consuming()
         logger.info('Stopped')
 
-    def _delay_before_reconnect(self):
-        """Sleeps for a number of seconds equal to the `count` attribute on this object
+    def _call_threadsafe(self, callback):
+        """Schedule callback to run on the connection's ioloop. Safe to call
+        from any thread.
+
+        :param callback: Function to call with no arguments
+
         """
-        logger.info("Sleeping before reconnect", no_of_seconds=self._count)
-        time.sleep(self._count)
+        self._connection.ioloop.add_callback_threadsafe(callback)
+
+    def _next_reconnect_delay(self):
+        """Work out how long to wait before the next reconnection attempt,
+        and count the attempt. The delay doubles with each attempt up to
+        max_reconnect_delay, and half of it is randomised so that consumers
+        that lost the same broker do not all reconnect at once.
+
+        :returns: Delay in seconds
+        :rtype: float
+
+        """
+        # Cap the exponent too, as a float delay overflows after enough attempts
+        delay = min(self._max_reconnect_delay, self._reconnect_delay * 2 ** min(self._count - 1, 32))
         self._count += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _on_connect_error(self):
+        """Handle a connection object that could not be created. Must be
+        called while handling the error. See the connect method.
+
+        :returns: The previous connection handle
+        """
+        logger.exception("Connection error")
+        self._nodes.failed(self._url)
+        if self._connection is None:
+            raise
+        self.reconnect()
+        return self._connection
 
 
 class TornadoConsumer(AsyncConsumer):
@@ -402,27 +736,23 @@ class TornadoConsumer(AsyncConsumer):
         When the connection is established, the on_connection_open method
         will be invoked by pika.
 
+        A connection object that cannot be created is handled as in
+        AsyncConsumer.connect.
+
         :rtype: pika.adapters.TornadoConnection
 
         """
-        no_of_servers = len(self._rabbit_urls)
+        self._url = self._nodes.select()
+        self._connect_started = time.monotonic()
 
-        while True:
-            server_choice = (self._count % no_of_servers) - 1
-
-            self._url = self._rabbit_urls[server_choice]
-
-            try:
-                logger.info('Connecting', attempt=self._count)
-                return TornadoConnection(pika.URLParameters(self._url),
-                                         on_open_callback=self.on_connection_open,
-                                         on_open_error_callback=self.on_connection_open_error,
-                                         on_close_callback=self.on_connection_closed)
-            except pika.exceptions.AMQPConnectionError:
-                logger.exception("Connection error")
-                self._delay_before_reconnect()
-
-                continue
+        try:
+            logger.info('Connecting', attempt=self._count)
+            return TornadoConnection(pika.URLParameters(self._url),
+                                     on_open_callback=self.on_connection_open,
+                                     on_open_error_callback=self.on_connection_open_error,
+                                     on_close_callback=self.on_connection_closed)
+        except pika.exceptions.AMQPConnectionError:
+            return self._on_connect_error()
 
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
@@ -447,8 +777,73 @@ class TornadoConsumer(AsyncConsumer):
             logger.warning("Connection closed, stopping ioloop", reason=reason)
             self._connection.ioloop.stop()
         else:
-            logger.warning('Connection closed, reopening in 3 seconds', reason=reason)
-            self._connection.ioloop.call_later(3, self.reconnect)
+            logger.warning('Connection closed, reconnect necessary', reason=reason)
+            if not isinstance(reason, pika.exceptions.ConnectionClosedByClient):
+                # The broker may have restarted and lost non-durable topology.
+                # Closes the client asked for, such as after a channel error,
+                # say nothing about the node's health
+                self._topology.forget(self._url)
+                self._nodes.failed(self._url)
+            self.reconnect()
+
+    def _call_threadsafe(self, callback):
+        """Schedule callback to run on the Tornado IOLoop. Safe to call from
+        any thread.
+
+        :param callback: Function to call with no arguments
+
+        """
+        self._connection.ioloop.add_callback(callback)
+
+
+class AsyncioConsumer(TornadoConsumer):
+    """This is a consumer that uses the TornadoConsumer as a base but uses
+    AsyncioConnection to connect to RabbitMQ on the asyncio event loop
+    """
+    def connect(self):
+        """This method connects to RabbitMQ using an AsyncioConnection object,
+        returning the connection handle.
+
+        When the connection is established, the on_connection_open method
+        will be invoked by pika.
+
+        A connection object that cannot be created is handled as in
+        AsyncConsumer.connect.
+
+        :rtype: pika.adapters.asyncio_connection.AsyncioConnection
+
+        """
+        self._url = self._nodes.select()
+        self._connect_started = time.monotonic()
+
+        try:
+            logger.info('Connecting', attempt=self._count)
+            return AsyncioConnection(pika.URLParameters(self._url),
+                                     on_open_callback=self.on_connection_open,
+                                     on_open_error_callback=self.on_connection_open_error,
+                                     on_close_callback=self.on_connection_closed,
+                                     custom_ioloop=asyncio.get_event_loop())
+        except pika.exceptions.AMQPConnectionError:
+            return self._on_connect_error()
+
+    def run(self):
+        """Run the consumer by connecting to RabbitMQ and then running the
+        asyncio event loop until the connection is closed. Services that
+        already run an event loop should call connect from it instead.
+
+        """
+        logger.debug('Running rabbit consumer')
+        self._connection = self.connect()
+        self._connection.ioloop.run_forever()
+
+    def _call_threadsafe(self, callback):
+        """Schedule callback to run on the asyncio event loop. Safe to call
+        from any thread.
+
+        :param callback: Function to call with no arguments
+
+        """
+        self._connection.ioloop.call_soon_threadsafe(callback)
 
 
 class MessageConsumer(TornadoConsumer):
@@ -476,9 +871,7 @@ class MessageConsumer(TornadoConsumer):
         : returns: tx_id of survey response
         : rtype: str
         """
-        tx_id = properties.headers['tx_id']
-        logger.info("Retrieved tx_id from message properties: tx_id={}".format(tx_id))
-        return tx_id
+        return properties.headers['tx_id']
 
     def __init__(self,
                  durable_queue,
@@ -488,7 +881,27 @@ class MessageConsumer(TornadoConsumer):
                  rabbit_urls,
                  quarantine_publisher,
                  process,
-                 check_tx_id=True):
+                 check_tx_id=True,
+                 prefetch_count=1,
+                 max_workers=None,
+                 use_processes=False,
+                 ack_batch_size=None,
+                 ack_batch_interval=0.5,
+                 reconnect_delay=1,
+                 max_reconnect_delay=60,
+                 nodes=None,
+                 topology_mode=DECLARE,
+                 topology=None,
+                 spill_journal=None,
+                 spill_drain_interval=5,
+                 metrics=None,
+                 log_sample_rate=1,
+                 log_summary_interval=None,
+                 body_type=str,
+                 deserialise=False,
+                 serialisers=None,
+                 dedup=None,
+                 retry_delays=None):
         """Create a new instance of the SDXConsumer class
 
         : param durable_queue: Boolean specifying whether queue is durable
@@ -499,9 +912,69 @@ class MessageConsumer(TornadoConsumer):
         : param quarantine_publisher: Object of type sdc.rabbit.QueuePublisher.
             Will publish quarantined messages to the named queue.
         : param process: Function or method to use for processsing message. Will
-            be passed the body of the message as a string decoded using UTF - 8.
+            be passed the body of the message as a string decoded using UTF - 8,
+            unless body_type or deserialise say otherwise.
             Should raise sdc.rabbit.DecryptError, sdc.rabbit.BadMessageError or
             sdc.rabbit.RetryableError on failure, depending on the failure mode.
+        : param check_tx_id: Reject messages that have no tx_id header
+        : param prefetch_count: Number of unacknowledged messages RabbitMQ may
+            deliver to the consumer at once
+        : param max_workers: If set, process messages on a pool of this many
+            threads rather than on the ioloop. The process callback must then
+            be thread safe, and prefetch_count should be at least max_workers
+        : param use_processes: Use a pool of max_workers processes, started
+            up front, rather than threads. Suits CPU-bound process callbacks,
+            which must then be picklable
+        : param ack_batch_size: If set, coalesce acknowledgements, sending one
+            Basic.Ack with multiple=True once this many are pending
+        : param ack_batch_interval: Seconds after which pending acknowledgements
+            are sent regardless of how many there are
+        : param reconnect_delay: Seconds to wait before the first reconnection
+            attempt. The delay doubles with each failed attempt, with jitter
+        : param max_reconnect_delay: Cap on the delay between reconnection
+            attempts, in seconds
+        : param nodes: sdc.rabbit.nodes.NodeSelector that chooses which of
+            rabbit_urls to connect to
+        : param topology_mode: How to treat topology already known to be
+            declared; one of DECLARE, PASSIVE or SKIP
+        : param topology: sdc.rabbit.topology.TopologyRegistry recording what
+            has been declared
+        : param spill_journal: sdc.rabbit.journal.Journal to write messages
+            to when they cannot be quarantined, so that the original can be
+            settled rather than requeued. A background thread publishes
+            them to the quarantine publisher once it can be reached
+        : param spill_drain_interval: Seconds between attempts to publish
+            the messages in spill_journal
+        : param metrics: sdc.rabbit.metrics.Registry to record metrics in
+        : param log_sample_rate: Fraction of the lines logged for each
+            message to write. Errors and quarantines are always logged
+        : param log_summary_interval: If set, seconds between lines counting
+            the per-message lines, including those sampled out
+        : param body_type: What to pass process the message body as. str,
+            the default, decodes it using UTF - 8. bytes passes the body as
+            delivered and memoryview wraps it, neither of which copies it;
+            decode either with str(body, "utf-8") if and when needed
+        : param deserialise: Pass process the message body deserialised by
+            the serialiser registered for its content_type, or for JSON if
+            it has none. Bodies with a content_type that has no serialiser
+            are passed as body_type. Bodies that cannot be deserialised are
+            quarantined
+        : param serialisers: sdc.rabbit.serialisation.SerialiserRegistry to
+            look serialisers up in. Defaults to the global one. Worker
+            processes are given a copy of it as it is when they start, so
+            serialisers registered after that are not used by them
+        : param dedup: sdc.rabbit.dedup.DedupStore, or an object with the
+            same seen and add methods, recording the tx_ids of messages
+            processed successfully. Redelivered messages whose tx_id it has
+            seen are acknowledged without being processed again. Requires
+            check_tx_id
+        : param retry_delays: If set, a list of delays in seconds, such as
+            [1, 10, 60]. Messages that fail with sdc.rabbit.RetryableError
+            or an unexpected exception are published to a retry queue for
+            the next delay, from which they are dead-lettered back to the
+            queue once it has passed, rather than being requeued at once.
+            The number of retries so far is kept in the retry_count header,
+            and messages still failing after the last delay are quarantined
 
         : returns: Object of type SDXConsumer
         : rtype: SDXConsumer
@@ -512,22 +985,276 @@ class MessageConsumer(TornadoConsumer):
             msg = 'process callback is not callable'
             raise AttributeError(msg.format(process))
 
+        if body_type not in BODY_TYPES:
+            raise ValueError('body_type must be str, bytes or memoryview')
+
+        if retry_delays is not None and (not retry_delays or any(delay <= 0 for delay in retry_delays)):
+            raise ValueError('retry_delays must be a list of positive numbers of seconds')
+
         self.quarantine_publisher = quarantine_publisher
         self.check_tx_id = check_tx_id
+        self.body_type = body_type
+        self.deserialise = deserialise
+        self._serialisers = serialisers or default_serialisers
+        self._dedup = dedup
+        self._retry_delays = tuple(retry_delays or ())
+        # Properties of deliveries awaiting an outcome, kept only for retries
+        self._retry_properties = {}
+        self._quarantine_channel = None
+        self._quarantine_confirms = ConfirmTracker()
+        # Guards quarantine_publisher, which the drainer uses from its thread
+        self._quarantine_lock = threading.Lock()
+        self._spill_journal = spill_journal
+        self._drainer = None
+        if spill_journal is not None:
+            self._drainer = JournalDrainer(spill_journal, self._publish_spilled, spill_drain_interval)
+            self._drainer.start()
+        self._executor = None
+        if max_workers is not None and use_processes:
+            try:
+                pickle.dumps(process)
+            except Exception:
+                raise AttributeError('process callback must be picklable to run in worker processes')
+            self._max_workers = max_workers
+            self._executor = self._start_worker_processes()
+        elif max_workers is not None:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
 
         super().__init__(durable_queue,
                          exchange,
                          exchange_type,
                          rabbit_queue,
-                         rabbit_urls)
+                         rabbit_urls,
+                         prefetch_count=prefetch_count,
+                         ack_batch_size=ack_batch_size,
+                         ack_batch_interval=ack_batch_interval,
+                         reconnect_delay=reconnect_delay,
+                         max_reconnect_delay=max_reconnect_delay,
+                         nodes=nodes,
+                         topology_mode=topology_mode,
+                         topology=topology,
+                         metrics=metrics,
+                         log_sample_rate=log_sample_rate,
+                         log_summary_interval=log_summary_interval)
+
+    def on_channel_open(self, channel):
+        self._retry_properties = {}
+        super().on_channel_open(channel)
+
+    def retry_queue(self, delay):
+        """
+        : param delay: One of retry_delays
+
+        : returns: Name of the queue messages wait in to be retried after delay
+        : rtype: str
+        """
+        return '%s.retry.%gs' % (self._queue, delay)
+
+    def setup_extra_queues(self):
+        """Declare a queue for each of retry_delays, whose messages expire
+        after the delay and are dead-lettered through the default exchange
+        back to the queue being consumed.
+
+        """
+        for delay in self._retry_delays:
+            name = self.retry_queue(delay)
+            mode = self._declaration_mode(('queue', name))
+            if mode == SKIP:
+                continue
+            logger.info('Declaring retry queue', name=name, passive=mode == PASSIVE)
+            self._declaring.add(('queue', name))
+            self._channel.queue_declare(queue=name,
+                                        durable=self._durable_queue,
+                                        passive=mode == PASSIVE,
+                                        arguments={'x-message-ttl': int(delay * 1000),
+                                                   'x-dead-letter-exchange': '',
+                                                   'x-dead-letter-routing-key': self._queue},
+                                        callback=partial(self.on_retry_queue_declareok, name))
+
+    def on_retry_queue_declareok(self, name, _unused_frame):
+        logger.info('Retry queue declared', name=name)
+        self._declared(('queue', name))
+
+    def _start_worker_processes(self):
+        """Start a pool of max_workers processes, waiting until every one
+        of them is running so that the first messages are not held up.
+
+        : returns: The process pool
+        """
+        executor = ProcessPoolExecutor(max_workers=self._max_workers,
+                                       initializer=_init_worker_process,
+                                       initargs=(self._serialisers,))
+        warm_up = [executor.submit(_warm_up) for _ in range(self._max_workers)]
+        pids = set(f.result() for f in warm_up)
+        logger.info('Started worker processes', count=len(pids))
+        return executor
+
+    def _restart_worker_processes(self, broken):
+        """Replace a process pool that a worker dying has left unusable.
+
+        : param broken: The broken pool. Nothing is done if it has already
+            been replaced, or if the consumer is stopping
+        """
+        if self._executor is not broken or self._closing:
+            return
+        logger.error('Worker process pool is broken, restarting it')
+        broken.shutdown(wait=False)
+        self._executor = self._start_worker_processes()
+
+    def on_connection_open(self, unused_connection):
+        """Open the consuming channel as AsyncConsumer.on_connection_open,
+        along with a channel to quarantine and retry messages on.
+
+        """
+        super().on_connection_open(unused_connection)
+        self.open_quarantine_channel()
+
+    def open_quarantine_channel(self):
+        """Open a second channel on the consumer's connection to publish
+        quarantined messages on, so that quarantining does not block the
+        ioloop on a connection of its own. Only used for quarantining when
+        the quarantine publisher is a sdc.rabbit Publisher, whose route and
+        declaration can be reused; otherwise its publish_message is called
+        as before. Messages to be retried are always published on it.
+
+        """
+        if not isinstance(self.quarantine_publisher, Publisher) and not self._retry_delays:
+            return
+        logger.info('Opening quarantine channel')
+        self._connection.channel(on_open_callback=self.on_quarantine_channel_open)
+
+    def on_quarantine_channel_open(self, channel):
+        """Invoked by pika when the quarantine channel has been opened.
+        Declares where quarantined messages are published to and puts the
+        channel in confirm mode.
+
+        :param pika.channel.Channel channel: The channel object
+
+        """
+        logger.info('Quarantine channel opened', channel=channel)
+        self._quarantine_confirms.reset()
+        channel.add_on_close_callback(self.on_quarantine_channel_closed)
+        if isinstance(self.quarantine_publisher, Publisher):
+            self.quarantine_publisher._declare(channel=channel)
+        channel.confirm_delivery(ack_nack_callback=self._quarantine_confirms.on_delivery_confirmation,
+                                 callback=partial(self.on_quarantine_confirm_selected, channel))
+        channel.add_on_return_callback(self._quarantine_confirms.on_message_returned)
+
+    def on_quarantine_confirm_selected(self, channel, unused_frame):
+        """Invoked by pika once the quarantine channel is in confirm mode,
+        after which messages can be quarantined on it.
+
+        :param pika.channel.Channel channel: The quarantine channel
+        :param pika.frame.Method unused_frame: Confirm.SelectOk response frame
+
+        """
+        self._quarantine_channel = channel
+
+    def on_quarantine_channel_closed(self, channel, reason):
+        """Invoked by pika when the quarantine channel is closed. Messages
+        still awaiting a quarantine confirm are requeued, and unless the
+        connection is closing too, the channel is reopened after
+        reconnect_delay seconds, so that a channel the broker keeps closing
+        is not reopened in a tight loop.
+
+        :param pika.channel.Channel channel: The closed channel
+        :param Exception reason: why the channel was closed
+
+        """
+        logger.warning('Quarantine channel was closed', channel=channel, reason=reason)
+        self._quarantine_channel = None
+        self._quarantine_confirms.reset()
+        if self._closing or self._connection is None or not self._connection.is_open:
+            return
+        logger.info('Reopening quarantine channel', in_seconds=self._reconnect_delay)
+        self._connection.ioloop.call_later(self._reconnect_delay,
+                                           partial(self._reopen_quarantine_channel, self._connection))
+
+    def _reopen_quarantine_channel(self, connection):
+        # A new connection opens a quarantine channel of its own
+        if connection is self._connection and connection.is_open and not self._closing:
+            self.open_quarantine_channel()
+
+    def _quarantine(self, basic_deliver, body, tx_id):
+        """Publish a message to the quarantine queue, rejecting the original
+        delivery once the broker has confirmed the quarantined copy.
+
+        : param basic_deliver: AMQP basic.deliver method
+        : param body: Message body
+        : param tx_id: tx_id of the message, or None if not checked
+
+        """
+        channel = self._quarantine_channel
+        if channel is None or not channel.is_open or not isinstance(self.quarantine_publisher, Publisher):
+            with self._quarantine_lock:
+                self.quarantine_publisher.publish_message(body, headers={'tx_id': tx_id})
+            self._metrics.quarantines.inc()
+            self.reject_message(basic_deliver.delivery_tag, tx_id=tx_id)
+            return
+
+        exchange, routing_key = self.quarantine_publisher._route()
+        self._quarantine_confirms.add(partial(self._on_quarantine_confirmed,
+                                              self._channel, basic_deliver, body, tx_id))
+        channel.basic_publish(exchange=exchange,
+                              routing_key=routing_key,
+                              body=body,
+                              properties=self.quarantine_publisher._properties(headers={'tx_id': tx_id}),
+                              mandatory=True)
+
+    def _on_quarantine_confirmed(self, channel, basic_deliver, body, tx_id, outcome):
+        if channel is not self._channel:
+            logger.warning('Channel closed before quarantine was confirmed, message will be redelivered',
+                           tx_id=tx_id)
+            return
+        if outcome == ACKED:
+            self._metrics.quarantines.inc()
+            self.reject_message(basic_deliver.delivery_tag, tx_id=tx_id)
+            logger.info('Message quarantined', tx_id=tx_id)
+        elif not self._spill(basic_deliver, body, tx_id):
+            logger.error("Unable to publish message to quarantine queue. Rejecting message and requeuing.",
+                         outcome=outcome, tx_id=tx_id)
+            self.reject_message(basic_deliver.delivery_tag, requeue=True, tx_id=tx_id)
+
+    def _spill(self, basic_deliver, body, tx_id):
+        """Write a message that could not be quarantined to the spill journal
+        and reject the original.
+
+        : param basic_deliver: AMQP basic.deliver method
+        : param body: Message body
+        : param tx_id: tx_id of the message, or None if not checked
+
+        : returns: False if there is no journal or it could not be written
+            to, in which case the original has not been settled
+        : rtype: bool
+
+        """
+        if self._spill_journal is None:
+            return False
+        try:
+            self._spill_journal.append(body, {'tx_id': tx_id})
+        except Exception:
+            logger.exception("Unable to write to spill journal", tx_id=tx_id)
+            return False
+        self._metrics.spills.inc()
+        self.reject_message(basic_deliver.delivery_tag, tx_id=tx_id)
+        logger.warning("Unable to publish message to quarantine queue, spilled to journal",
+                       tx_id=tx_id, pending=len(self._spill_journal))
+        return True
+
+    def _publish_spilled(self, body, headers):
+        with self._quarantine_lock:
+            self.quarantine_publisher.publish_message(body, headers=headers)
 
     def on_message(self, unused_channel, basic_deliver, properties, body):
         """Called on receipt of a message from a queue.
 
-        Processes the message using the self._process method or function and positively
-        acknowledges the queue if successful. If processing is not succesful,
-        the message can either be rejected, quarantined or negatively acknowledged,
-        depending on the failure mode.
+        Acknowledges redelivered messages that the dedup store says were
+        already processed. Otherwise decompresses the body if its
+        content_encoding says it was compressed, processes the message using
+        the self._process method or function and positively acknowledges the
+        queue if successful. If processing is not succesful, the message can
+        either be rejected, quarantined or negatively acknowledged, depending
+        on the failure mode.
 
         : param basic_deliver: AMQP basic.deliver method
         : param properties: Message properties
@@ -536,15 +1263,16 @@ class MessageConsumer(TornadoConsumer):
         : returns: None
 
         """
+        self._delivered(basic_deliver.delivery_tag)
         if self.check_tx_id:
             try:
                 tx_id = self.tx_id(properties)
 
-                logger.info('Received message',
-                            queue=self._queue,
-                            delivery_tag=basic_deliver.delivery_tag,
-                            app_id=properties.app_id,
-                            tx_id=tx_id)
+                self._log.info('Received message',
+                               queue=self._queue,
+                               delivery_tag=basic_deliver.delivery_tag,
+                               app_id=properties.app_id,
+                               tx_id=tx_id)
 
             except KeyError:
                 self.reject_message(basic_deliver.delivery_tag)
@@ -555,35 +1283,493 @@ class MessageConsumer(TornadoConsumer):
                 logger.exception("Bad message properties - no headers", action="rejected")
                 return None
         else:
-            logger.debug("check_tx_id is False. Not checking tx_id for message.",
-                         delivery_tag=basic_deliver.delivery_tag)
+            self._log.debug("check_tx_id is False. Not checking tx_id for message.",
+                            delivery_tag=basic_deliver.delivery_tag)
             tx_id = None
 
+        if basic_deliver.redelivered and self._is_duplicate(tx_id):
+            self._metrics.duplicates.inc()
+            self._log.info("Redelivered message already processed", action="ack", tx_id=tx_id)
+            self.acknowledge_message(basic_deliver.delivery_tag, tx_id=tx_id)
+            return None
+
+        try:
+            body = self._decompress(body, properties)
+        except Exception:
+            logger.exception("Unable to decompress message",
+                             content_encoding=properties.content_encoding,
+                             tx_id=tx_id)
+            self._on_processed(basic_deliver, body, tx_id, BadMessageError())
+            return None
+
+        if self._retry_delays:
+            self._retry_properties[basic_deliver.delivery_tag] = properties
+
+        serialiser = None
+        if self.deserialise:
+            serialiser = self._serialisers.get(properties.content_type or JSON)
+        self._handle_message(basic_deliver, body, tx_id, serialiser)
+
+    def _is_duplicate(self, tx_id):
+        """Check whether a message has already been processed successfully.
+        Errors from the dedup store are logged and treated as not seen, so
+        the message is processed again.
+
+        : param tx_id: tx_id of the message, or None if not checked
+
+        : returns: Whether dedup has seen tx_id
+        """
+        if self._dedup is None or tx_id is None:
+            return False
+        try:
+            return self._dedup.seen(tx_id)
+        except Exception:
+            logger.exception("Unable to check for duplicate message", tx_id=tx_id)
+            return False
+
+    def _record_processed(self, tx_id):
+        """Record a message processed successfully in the dedup store, if
+        the consumer has one. Errors from the store are logged and ignored.
+
+        : param tx_id: tx_id of the message, or None if not checked
+        """
+        if self._dedup is None or tx_id is None:
+            return
         try:
+            self._dedup.add(tx_id)
+        except Exception:
+            logger.exception("Unable to record processed message", tx_id=tx_id)
+
+    def _decompress(self, body, properties):
+        """Decompress a message body whose content_encoding names one of the
+        codecs in sdc.rabbit.compression. Other bodies are returned as they are.
+
+        : param body: Message body
+        : param properties: Message properties
+
+        : returns: The decompressed body
+        """
+        started = time.monotonic()
+        body, decompressed = decompress(body, properties.content_encoding)
+        if decompressed:
+            self._metrics.decompress_seconds.observe(time.monotonic() - started)
+        return body
+
+    def _handle_message(self, basic_deliver, body, tx_id, serialiser=None):
+        """Process a message and act on the outcome.
+
+        : param basic_deliver: AMQP basic.deliver method
+        : param body: Message body
+        : param tx_id: tx_id of the message, or None if not checked
+        : param serialiser: Serialiser to deserialise the body with, if any
+
+        """
+        if self._executor is not None:
+            executor = self._executor
             try:
-                self.process(body.decode("utf-8"), tx_id)
-            except TypeError:
+                if isinstance(executor, ProcessPoolExecutor):
+                    # Deserialisation time can only be recorded by worker threads
+                    content_type = None if serialiser is None else serialiser.content_type
+                    future = executor.submit(_run_in_worker_process, self.process, body, tx_id,
+                                             self.body_type, content_type)
+                else:
+                    future = executor.submit(_run_process, self.process, body, tx_id, self.body_type,
+                                             serialiser, self._metrics.deserialise_seconds.observe)
+            except BrokenProcessPool:
+                self._restart_worker_processes(executor)
+                self._requeue(basic_deliver, tx_id)
+                return
+            except RuntimeError:
+                # stop() shuts the pool down before the broker has stopped
+                # delivering the messages it had already sent
+                logger.warning("Worker pool shut down, requeuing message", tx_id=tx_id)
+                self._requeue(basic_deliver, tx_id)
+                return
+            done = partial(self._on_process_done, self._channel, basic_deliver, body, tx_id, executor=executor)
+            future.add_done_callback(lambda f: self._call_threadsafe(partial(done, f)))
+            return
+
+        error = None
+        try:
+            self._process(body, tx_id, serialiser)
+        except Exception as e:
+            error = e
+        self._on_processed(basic_deliver, body, tx_id, error)
+
+    def _requeue(self, basic_deliver, tx_id):
+        """Negatively acknowledge a message that could not be processed at
+        all, so that it is requeued without counting as a failure.
+
+        : param basic_deliver: AMQP basic.deliver method
+        : param tx_id: tx_id of the message, or None if not checked
+
+        """
+        self._retry_properties.pop(basic_deliver.delivery_tag, None)
+        self.nack_message(basic_deliver.delivery_tag, tx_id=tx_id)
+
+    def _on_process_done(self, channel, basic_deliver, body, tx_id, future, executor=None):
+        """Invoked on the ioloop when processing a message elsewhere, on a
+        worker or as a coroutine, has completed. Outcomes for messages
+        delivered on a channel that has since closed are dropped, as RabbitMQ
+        will redeliver them.
+
+        : param channel: The channel the message was delivered on
+        : param future: The completed processing future
+        : param executor: The pool the message was processed on, if any.
+            Messages lost with a worker process that died are requeued and
+            the pool restarted
+
+        """
+        if channel is not self._channel:
+            logger.warning("Channel closed while processing message, it will be redelivered",
+                           delivery_tag=basic_deliver.delivery_tag,
+                           tx_id=tx_id)
+            return
+
+        if future.cancelled():
+            error = RetryableError('Processing was cancelled')
+        else:
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                self._restart_worker_processes(executor)
+                self._requeue(basic_deliver, tx_id)
+                return
+            if isinstance(error, TypeError):
                 logger.error('Incorrect call to process method')
-                raise QuarantinableError
+                error = QuarantinableError()
+        self._on_processed(basic_deliver, body, tx_id, error)
+
+    def _process(self, body, tx_id, serialiser=None):
+        """Call the process callback with the message body, deserialised with
+        serialiser or otherwise converted to body_type.
+
+        : returns: Whatever the process callback returns
+        """
+        return _run_process(self.process, body, tx_id, self.body_type, serialiser,
+                            self._metrics.deserialise_seconds.observe)
+
+    def _on_processed(self, basic_deliver, body, tx_id, error=None):
+        """Acknowledge a message that was processed successfully. Otherwise,
+        depending on the error raised by the process callback, quarantine and
+        reject it or negatively acknowledge it.
+
+        : param basic_deliver: AMQP basic.deliver method
+        : param body: Message body
+        : param tx_id: tx_id of the message, or None if not checked
+        : param error: Exception raised processing the message, if any
+
+        """
+        properties = self._retry_properties.pop(basic_deliver.delivery_tag, None)
+        try:
+            if error is not None:
+                raise error
 
+            self._record_processed(tx_id)
             self.acknowledge_message(basic_deliver.delivery_tag,
                                      tx_id=tx_id)
-
         except (QuarantinableError, BadMessageError):
             # Throw it into the quarantine queue to be dealt with
-            try:
-                self.quarantine_publisher.publish_message(body, headers={'tx_id': tx_id})
-                self.reject_message(basic_deliver.delivery_tag, tx_id=tx_id)
+            if self._quarantine_or_requeue(basic_deliver, body, tx_id):
                 logger.exception("Quarantinable error occured", action="quarantined", tx_id=tx_id)
-            except PublishMessageError:
-                logger.error("Unable to publish message to quarantine queue. Rejecting message and requeuing.")
-                self.reject_message(basic_deliver.delivery_tag, requeue=True, tx_id=tx_id)
 
         except RetryableError:
-            self.nack_message(basic_deliver.delivery_tag, tx_id=tx_id)
-            logger.exception("Failed to process", action="nack", tx_id=tx_id)
+            action = self._retry_or_nack(basic_deliver, properties, body, tx_id)
+            logger.exception("Failed to process", action=action, tx_id=tx_id)
         except Exception:
-            self.nack_message(basic_deliver.delivery_tag, tx_id=tx_id)
+            action = self._retry_or_nack(basic_deliver, properties, body, tx_id)
             logger.exception("Unexpected exception occurred, failed to process",
-                             action="nack",
+                             action=action,
                              tx_id=tx_id)
+
+    def _quarantine_or_requeue(self, basic_deliver, body, tx_id):
+        """Quarantine a message, spilling it to the journal if it cannot be
+        quarantined, or failing that rejecting it to be requeued.
+
+        : param basic_deliver: AMQP basic.deliver method
+        : param body: Message body
+        : param tx_id: tx_id of the message, or None if not checked
+
+        : returns: False if the message could not be published to quarantine
+        : rtype: bool
+        """
+        try:
+            self._quarantine(basic_deliver, body, tx_id)
+            return True
+        except PublishMessageError:
+            if not self._spill(basic_deliver, body, tx_id):
+                logger.error("Unable to publish message to quarantine queue. Rejecting message and requeuing.")
+                self.reject_message(basic_deliver.delivery_tag, requeue=True, tx_id=tx_id)
+            return False
+
+    def _retry_or_nack(self, basic_deliver, properties, body, tx_id):
+        """Publish a message that failed to the retry queue for its next
+        delay, acknowledging the original once the broker has confirmed the
+        copy. Messages that have been retried after every delay are
+        quarantined. Without retry_delays, or a channel to publish retries
+        on, the message is negatively acknowledged to be requeued at once.
+
+        : param basic_deliver: AMQP basic.deliver method
+        : param properties: Message properties
+        : param body: Message body
+        : param tx_id: tx_id of the message, or None if not checked
+
+        : returns: What was done with the message, for logging
+        : rtype: str
+        """
+        channel = self._quarantine_channel
+        if not self._retry_delays or properties is None or channel is None or not channel.is_open:
+            if self._retry_delays:
+                logger.warning("Unable to retry message later, no retry channel", tx_id=tx_id)
+            self.nack_message(basic_deliver.delivery_tag, tx_id=tx_id)
+            return 'nack'
+
+        headers = dict(properties.headers or {})
+        retries = headers.get(RETRY_COUNT_HEADER, 0)
+        if retries >= len(self._retry_delays):
+            logger.error("Message failed after every retry", retries=retries, tx_id=tx_id)
+            self._quarantine_or_requeue(basic_deliver, body, tx_id)
+            return 'quarantined'
+
+        headers[RETRY_COUNT_HEADER] = retries + 1
+        delay = self._retry_delays[retries]
+        self._quarantine_confirms.add(partial(self._on_retry_confirmed,
+                                              self._channel, basic_deliver, tx_id, delay))
+        channel.basic_publish(exchange='',
+                              routing_key=self.retry_queue(delay),
+                              body=body,
+                              properties=self._retry_message_properties(properties, headers),
+                              mandatory=True)
+        return 'retry'
+
+    @staticmethod
+    def _retry_message_properties(properties, headers):
+        """Copy a message's properties for the copy published to be retried.
+        Bodies have been decompressed by then, so a content_encoding naming a
+        compression codec is dropped.
+
+        """
+        content_encoding = properties.content_encoding
+        if get_codec(content_encoding) is not None:
+            content_encoding = None
+        return pika.BasicProperties(content_type=properties.content_type,
+                                    content_encoding=content_encoding,
+                                    headers=headers,
+                                    delivery_mode=properties.delivery_mode,
+                                    priority=properties.priority,
+                                    correlation_id=properties.correlation_id,
+                                    reply_to=properties.reply_to,
+                                    message_id=properties.message_id,
+                                    timestamp=properties.timestamp,
+                                    type=properties.type,
+                                    app_id=properties.app_id)
+
+    def _on_retry_confirmed(self, channel, basic_deliver, tx_id, delay, outcome):
+        if channel is not self._channel:
+            logger.warning('Channel closed before retry was confirmed, message will be redelivered',
+                           tx_id=tx_id)
+            return
+        if outcome == ACKED:
+            self._metrics.retries.inc()
+            self.acknowledge_message(basic_deliver.delivery_tag, tx_id=tx_id)
+            logger.info('Message will be retried', in_seconds=delay, tx_id=tx_id)
+        else:
+            logger.error('Unable to publish message to retry queue. Nacking message.',
+                         outcome=outcome, tx_id=tx_id)
+            self.nack_message(basic_deliver.delivery_tag, tx_id=tx_id)
+
+    def stop(self):
+        """Stop consuming, as AsyncConsumer.stop, and shut down the worker
+        pool once the messages it is processing are complete.
+
+        """
+        super().stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._drainer is not None:
+            self._drainer.stop()
+
+
+class AsyncioMessageConsumer(MessageConsumer, AsyncioConsumer):
+    """This is a queue consumer that handles messages from RabbitMQ message
+    queues on the asyncio event loop.
+
+    It behaves as MessageConsumer, except that the process callback may be a
+    coroutine function. Its coroutine is scheduled on the event loop and the
+    message is acknowledged, quarantined or negatively acknowledged when it
+    completes, so with a prefetch_count above 1 several messages can be
+    processed concurrently.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Create a new instance of the AsyncioMessageConsumer class
+
+        : param *args: As for MessageConsumer
+        : param **kwargs: As for MessageConsumer. Messages are processed on
+            the event loop, so max_workers and use_processes are not supported
+
+        : returns: Object of type AsyncioMessageConsumer
+        : rtype: AsyncioMessageConsumer
+
+        """
+        if kwargs.get('max_workers') is not None or kwargs.get('use_processes'):
+            raise ValueError('AsyncioMessageConsumer processes messages on the event loop; '
+                             'max_workers and use_processes are not supported')
+        super().__init__(*args, **kwargs)
+
+    def _handle_message(self, basic_deliver, body, tx_id, serialiser=None):
+        try:
+            result = self._process(body, tx_id, serialiser)
+        except Exception as e:
+            self._on_processed(basic_deliver, body, tx_id, e)
+            return
+
+        if not inspect.isawaitable(result):
+            self._on_processed(basic_deliver, body, tx_id)
+            return
+
+        future = asyncio.ensure_future(result)
+        future.add_done_callback(partial(self._on_process_done, self._channel, basic_deliver, body, tx_id))
+
+
+class BatchMessageConsumer(MessageConsumer):
+    """This is a queue consumer that handles messages from RabbitMQ message
+    queues in batches.
+
+    Deliveries are buffered until batch_size have arrived or batch_timeout
+    milliseconds have passed since the first, then handed to the
+    process_batch callback together as a list of Message tuples.
+
+    process_batch may return None if every message succeeded, or a list
+    with an outcome for each message in order: None for success, or an
+    instance of one of the exceptions in sdc.rabbit.exceptions, which is
+    acted on just as if process had raised it for that message. An
+    exception raised by process_batch applies to every message in the batch.
+
+    """
+
+    def __init__(self,
+                 durable_queue,
+                 exchange,
+                 exchange_type,
+                 rabbit_queue,
+                 rabbit_urls,
+                 quarantine_publisher,
+                 process_batch,
+                 batch_size=100,
+                 batch_timeout=1000,
+                 **kwargs):
+        """Create a new instance of the BatchMessageConsumer class
+
+        : param process_batch: Function or method to process a list of
+            Message tuples, whose bodies are strings decoded using UTF - 8
+            unless body_type or deserialise say otherwise
+        : param batch_size: Maximum number of messages in a batch
+        : param batch_timeout: Milliseconds to wait for a batch to fill
+        : param **kwargs: Other options, as for MessageConsumer. prefetch_count
+            defaults to batch_size. Batches are processed on the ioloop, so
+            max_workers and use_processes are not supported
+
+        : returns: Object of type BatchMessageConsumer
+        : rtype: BatchMessageConsumer
+
+        """
+        if kwargs.get('max_workers') is not None or kwargs.get('use_processes'):
+            raise ValueError('BatchMessageConsumer processes batches on the ioloop; '
+                             'max_workers and use_processes are not supported')
+        kwargs.setdefault('prefetch_count', batch_size)
+        super().__init__(durable_queue,
+                         exchange,
+                         exchange_type,
+                         rabbit_queue,
+                         rabbit_urls,
+                         quarantine_publisher,
+                         process_batch,
+                         **kwargs)
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._batch = []
+        self._batch_timer = None
+
+    def on_channel_open(self, channel):
+        """Discard any partial batch, since its delivery tags belonged to the
+        previous channel, and carry on as AsyncConsumer.on_channel_open.
+
+        """
+        self._drop_batch()
+        super().on_channel_open(channel)
+
+    def on_channel_closed(self, channel, reason):
+        """Discard any partial batch, which RabbitMQ will redeliver, and
+        carry on as AsyncConsumer.on_channel_closed.
+
+        """
+        self._drop_batch()
+        super().on_channel_closed(channel, reason)
+
+    def on_connection_closed(self, _unused_connection, reason):
+        """Discard any partial batch, which RabbitMQ will redeliver, and
+        carry on as TornadoConsumer.on_connection_closed.
+
+        """
+        self._drop_batch()
+        super().on_connection_closed(_unused_connection, reason)
+
+    def _drop_batch(self):
+        self._cancel_batch_timer()
+        if self._batch:
+            logger.warning('Dropping partial batch, messages will be redelivered', count=len(self._batch))
+        self._batch = []
+
+    def _handle_message(self, basic_deliver, body, tx_id, serialiser=None):
+        try:
+            decoded = _decode_body(body, self.body_type, serialiser, self._metrics.deserialise_seconds.observe)
+        except Exception as e:
+            self._on_processed(basic_deliver, body, tx_id, e)
+            return
+
+        self._batch.append((basic_deliver, body, tx_id, decoded))
+        if len(self._batch) >= self._batch_size:
+            self.flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = self._connection.ioloop.call_later(self._batch_timeout / 1000,
+                                                                   self._on_batch_timer)
+
+    def _on_batch_timer(self):
+        self._batch_timer = None
+        if self._channel is not None:
+            self.flush_batch()
+
+    def _cancel_batch_timer(self):
+        if self._batch_timer is not None:
+            self._connection.ioloop.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+
+    def flush_batch(self):
+        """Process the buffered messages and act on each one's outcome."""
+        self._cancel_batch_timer()
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        logger.info('Processing batch', queue=self._queue, size=len(batch))
+        try:
+            messages = [Message(decoded, tx_id, basic_deliver.delivery_tag)
+                        for basic_deliver, body, tx_id, decoded in batch]
+            outcomes = self.process(messages)
+            if outcomes is None:
+                outcomes = [None] * len(batch)
+            else:
+                outcomes = list(outcomes)
+            if len(outcomes) != len(batch):
+                raise ValueError('process_batch returned {} outcomes for {} messages'.format(len(outcomes), len(batch)))
+        except Exception as e:
+            outcomes = [e] * len(batch)
+
+        for (basic_deliver, body, tx_id, _), error in zip(batch, outcomes):
+            self._on_processed(basic_deliver, body, tx_id, error)
+
+    def stop(self):
+        """Process any buffered messages, then stop as MessageConsumer.stop."""
+        self.flush_batch()
+        super().stop()
@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class DedupStore(object):
+    """Remembers the tx_ids of messages that have been processed
+    successfully, so that a consumer can acknowledge redeliveries of them
+    without processing them again.
+
+    Entries are forgotten once they are older than ttl seconds, or when the
+    store holds max_size entries and a new one is added, least recently
+    used first. The store is held in memory, so it only covers redeliveries
+    to the same process; to share one between consumers, pass them an
+    object with the same seen and add methods backed by a shared store,
+    such as RedisDedupStore.
+
+    A store is safe to share between threads.
+
+    """
+
+    def __init__(self, max_size=100000, ttl=3600):
+        """Create a new instance of the DedupStore class
+
+        :param max_size: Most tx_ids to remember
+        :param ttl: Seconds to remember a tx_id for
+
+        :returns: Object of type DedupStore
+        :rtype: DedupStore
+
+        """
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expiries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def seen(self, tx_id):
+        """
+        :param tx_id: tx_id of a message
+
+        :returns: Whether a message with tx_id has been processed within ttl
+        :rtype: bool
+
+        """
+        with self._lock:
+            expiry = self._expiries.get(tx_id)
+            if expiry is None:
+                return False
+            if expiry <= time.monotonic():
+                del self._expiries[tx_id]
+                return False
+            self._expiries.move_to_end(tx_id)
+            return True
+
+    def add(self, tx_id):
+        """
+        Record that a message with tx_id has been processed.
+
+        :param tx_id: tx_id of the message
+
+        :returns: None
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expiries[tx_id] = now + self.ttl
+            self._expiries.move_to_end(tx_id)
+            while len(self._expiries) > self.max_size:
+                self._expiries.popitem(last=False)
+            # Entries are in order of use, so this only forgets expired ones
+            # up to the first that has been used since; others are forgotten
+            # when looked up or evicted
+            while self._expiries:
+                oldest, expiry = next(iter(self._expiries.items()))
+                if expiry > now:
+                    break
+                del self._expiries[oldest]
+
+
+class RedisDedupStore(object):
+    """Remembers processed tx_ids in Redis, so that every consumer sharing
+    it can acknowledge redeliveries of messages processed by any of them.
+
+    """
+
+    def __init__(self, client, ttl=3600, prefix='sdc-rabbit:tx_id:'):
+        """Create a new instance of the RedisDedupStore class
+
+        :param client: A redis.Redis client, or any object with the same
+            exists and set methods
+        :param ttl: Seconds to remember a tx_id for
+        :param prefix: Prefix of the keys tx_ids are stored under
+
+        :returns: Object of type RedisDedupStore
+        :rtype: RedisDedupStore
+
+        """
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def seen(self, tx_id):
+        """
+        :param tx_id: tx_id of a message
+
+        :returns: Whether a message with tx_id has been processed within ttl
+        :rtype: bool
+
+        """
+        return bool(self.client.exists(self.prefix + tx_id))
+
+    def add(self, tx_id):
+        """
+        Record that a message with tx_id has been processed.
+
+        :param tx_id: tx_id of the message
+
+        :returns: None
+
+        """
+        self.client.set(self.prefix + tx_id, 1, ex=self.ttl)
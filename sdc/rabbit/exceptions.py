@@ -28,3 +28,11 @@ class PublishMessageError(Exception):
 
     """
     pass
+
+
+class ConnectionPoolExhaustedError(Exception):
+    """Every pooled connection to a broker is open and has handed out its
+    maximum number of channels.
+
+    """
+    pass
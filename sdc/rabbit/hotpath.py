@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from structlog import wrap_logger
+
+
+class Lazy(object):
+    """A log field whose value is only worked out if the line is written.
+
+    Lazy(func, *args) is replaced by func(*args) when a HotPathLogger emits
+    the line it was passed to, and is never called for lines that are
+    sampled out or below the logger's level.
+
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self):
+        return self.func(*self.args)
+
+
+class HotPathLogger(object):
+    """Logs the lines written for every message at a reduced cost.
+
+    Each call counts its event. Only one in every 1 / sample_rate calls for
+    an event is written, and Lazy fields are evaluated only for lines that
+    are written. With a summary_interval, a single line giving how many times
+    each event happened is written at most that often, so sampled out lines
+    are still accounted for.
+
+    Only use a HotPathLogger for routine, per-message lines. Errors and
+    quarantines should be logged in full with an ordinary logger.
+
+    A HotPathLogger is safe to share between threads.
+
+    """
+
+    def __init__(self, name, sample_rate=1, summary_interval=None):
+        """Create a new instance of the HotPathLogger class
+
+        :param name: Name of the standard library logger to write to
+        :param sample_rate: Fraction, from 0 to 1, of each event's lines to
+            write. 1 writes every line
+        :param summary_interval: If set, seconds between summary lines
+
+        :returns: Object of type HotPathLogger
+        :rtype: HotPathLogger
+
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
+        self._stdlib_logger = logging.getLogger(name)
+        self._logger = wrap_logger(self._stdlib_logger)
+        self._every = round(1 / sample_rate) if sample_rate else None
+        self.summary_interval = summary_interval
+        self._counts = {}
+        self._summary_counts = {}
+        self._summary_started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, 'debug', event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, 'info', event, fields)
+
+    def _log(self, level, method, event, fields):
+        with self._lock:
+            count = self._counts.get(event, 0) + 1
+            self._counts[event] = count
+            self._summary_counts[event] = self._summary_counts.get(event, 0) + 1
+            summary = self._take_summary()
+
+        if summary is not None:
+            self._logger.info('Hot path summary', **summary)
+        if self._every is None or (count - 1) % self._every:
+            return
+        if not self._stdlib_logger.isEnabledFor(level):
+            return
+        for key, value in fields.items():
+            if isinstance(value, Lazy):
+                fields[key] = value()
+        if self._every > 1:
+            fields['sampled'] = self._every
+        getattr(self._logger, method)(event, **fields)
+
+    def _take_summary(self):
+        if self.summary_interval is None:
+            return None
+        now = time.monotonic()
+        seconds = now - self._summary_started
+        if seconds < self.summary_interval:
+            return None
+        counts, self._summary_counts = self._summary_counts, {}
+        self._summary_started = now
+        return {'seconds': round(seconds, 3), 'counts': counts}
+
+
+class _ThreadQueueHandler(QueueHandler):
+    """Hands records to a QueueListener in the same process. Records are
+    queued as they are, leaving all formatting to the listener's thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _BackgroundListener(QueueListener):
+    """A QueueListener that gives its handlers back to the logger they were
+    taken from once it is stopped.
+    """
+
+    def __init__(self, logger, queue_handler, handlers):
+        super().__init__(queue_handler.queue, *handlers, respect_handler_level=True)
+        self._logger = logger
+        self._queue_handler = queue_handler
+
+    def stop(self):
+        super().stop()
+        self._logger.removeHandler(self._queue_handler)
+        for handler in self.handlers:
+            self._logger.addHandler(handler)
+
+
+def start_background_logging(logger=None):
+    """
+    Move the writing of log records to a background thread. The handlers of
+    logger are replaced with one that queues each record, and a listener
+    thread passes the queued records to the original handlers.
+
+    Call stop on the listener that is returned to write any queued records
+    and put the original handlers back.
+
+    :param logger: Standard library logger whose handlers to move. Defaults
+        to the root logger
+
+    :returns: The running listener
+    :rtype: logging.handlers.QueueListener
+
+    """
+    logger = logger or logging.getLogger()
+    handlers = list(logger.handlers)
+    queue_handler = _ThreadQueueHandler(queue.Queue())
+    listener = _BackgroundListener(logger, queue_handler, handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    listener.start()
+    return listener
@@ -0,0 +1,326 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from structlog import wrap_logger
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+_RECORD = struct.Struct('>III')  # crc32, headers length, body length
+_CHECKPOINT = struct.Struct('>QQ')  # segment number, offset
+_SEGMENT_SUFFIX = '.seg'
+
+
+class _Segment(object):
+    """One memory-mapped segment file of a Journal."""
+
+    def __init__(self, path, number, size=None):
+        self.path = path
+        self.number = number
+        with open(path, 'a+b') as f:
+            if size is not None:
+                f.truncate(size)
+            f.flush()
+            self._map = mmap.mmap(f.fileno(), 0)
+
+    def __len__(self):
+        return len(self._map)
+
+    def write(self, offset, data, sync):
+        self._map[offset:offset + len(data)] = data
+        if sync:
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            self._map.flush(start, offset + len(data) - start)
+
+    def read(self, offset):
+        """
+        Read the record at offset.
+
+        :returns: The headers, body and offset of the next record, or None
+            if there is no complete record at offset
+        :rtype: tuple
+
+        """
+        end = offset + _RECORD.size
+        if end > len(self._map):
+            return None
+        crc, headers_length, body_length = _RECORD.unpack(self._map[offset:end])
+        if headers_length == 0 or end + headers_length + body_length > len(self._map):
+            return None
+        headers = self._map[end:end + headers_length]
+        body = self._map[end + headers_length:end + headers_length + body_length]
+        if zlib.crc32(body, zlib.crc32(headers)) != crc:
+            return None
+        return json.loads(headers.decode('utf-8')), body, end + headers_length + body_length
+
+    def close(self):
+        self._map.close()
+
+
+class Journal(object):
+    """An append-only journal of messages kept on local disk.
+
+    Records are appended to memory-mapped segment files of segment_size
+    bytes, starting a new segment when one fills up. replay reads records
+    back in the order they were appended, and a checkpoint file records how
+    far replay has got, so a journal reopened after a restart carries on
+    from the first record that was not replayed. Segments are deleted once
+    every record in them has been replayed.
+
+    Each record carries a checksum, so a record torn by a crash part way
+    through an append is discarded when the journal is reopened.
+
+    A journal is safe to share between threads, but not between processes.
+    Appends may run alongside a replay, while replays run one at a time, so
+    a replay started while another is running waits for it to finish.
+
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, sync=True):
+        """Create a new instance of the Journal class, opening or creating a
+        journal in directory.
+
+        :param directory: Directory to keep the journal's files in
+        :param segment_size: Size in bytes of each segment file. Records
+            larger than this are given a segment of their own
+        :param sync: Flush each record to disk as it is appended
+
+        :returns: Object of type Journal
+        :rtype: Journal
+
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self._lock = threading.Lock()
+        # Held for the whole of a replay, so that two replays cannot pass
+        # the same record to publish
+        self._replay_lock = threading.Lock()
+        self._segments = {}
+        os.makedirs(directory, exist_ok=True)
+
+        numbers = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                         if name.endswith(_SEGMENT_SUFFIX))
+        self._read_segment, self._read_offset = self._load_checkpoint()
+        for number in numbers:
+            path = self._segment_path(number)
+            if number < self._read_segment or not os.path.getsize(path):
+                os.remove(path)
+            else:
+                self._segments[number] = _Segment(path, number)
+        if not self._segments:
+            self._new_segment(max(self._read_segment, 1), self.segment_size)
+        if self._read_segment < min(self._segments):
+            self._read_segment, self._read_offset = min(self._segments), 0
+
+        # Find where appending should carry on, and how many records remain
+        self._pending = 0
+        self.pending_bytes = 0
+        self.replayed = 0
+        self._write_offset = 0
+        for number, offset, _, _, next_offset in self._records():
+            self._pending += 1
+            self.pending_bytes += next_offset - offset
+            if number == self._write_segment.number:
+                self._write_offset = next_offset
+        if self._read_segment == self._write_segment.number:
+            self._write_offset = max(self._write_offset, self._read_offset)
+
+        if self._pending:
+            logger.info("Opened journal", directory=directory, pending=self._pending)
+
+    def __len__(self):
+        return self._pending
+
+    def disk_usage(self):
+        """
+        :returns: Bytes taken up on disk by the journal's segment files
+        :rtype: int
+
+        """
+        with self._lock:
+            return sum(len(segment) for segment in self._segments.values())
+
+    @property
+    def _write_segment(self):
+        return self._segments[max(self._segments)]
+
+    def append(self, body, headers=None):
+        """
+        Append a message to the journal.
+
+        :param body: Message body, as bytes or str
+        :param headers: JSON serialisable dict of message headers
+
+        :returns: None
+
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        encoded_headers = json.dumps(headers or {}).encode('utf-8')
+        crc = zlib.crc32(body, zlib.crc32(encoded_headers))
+        record = _RECORD.pack(crc, len(encoded_headers), len(body)) + encoded_headers + body
+
+        with self._lock:
+            segment = self._write_segment
+            if self._write_offset + len(record) > len(segment):
+                segment = self._new_segment(segment.number + 1, max(self.segment_size, len(record)))
+                self._write_offset = 0
+            segment.write(self._write_offset, record, self.sync)
+            self._write_offset += len(record)
+            self._pending += 1
+            self.pending_bytes += len(record)
+
+    def replay(self, publish):
+        """
+        Pass each record that has not yet been replayed to publish, in the
+        order they were appended. A record counts as replayed once publish
+        returns; if it raises, replay stops and the record is passed again
+        by the next replay. Waits for any replay already running to finish.
+
+        :param publish: Called with the body and headers of each record
+
+        :returns: The number of records replayed
+        :rtype: int
+
+        """
+        replayed = 0
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    record = next(self._records(), None)
+                if record is None:
+                    return replayed
+
+                number, offset, headers, body, next_offset = record
+                publish(body, headers)
+                with self._lock:
+                    self._commit(number, next_offset)
+                    self.pending_bytes -= next_offset - offset
+                    self.replayed += 1
+                replayed += 1
+
+    def close(self):
+        """
+        Close the journal's segment files.
+
+        :returns: None
+
+        """
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+
+    def _records(self):
+        """Yield each record from the read position onwards, along with the
+        segment and offset it was read from and the offset that follows it.
+        """
+        number, offset = self._read_segment, self._read_offset
+        for segment_number in sorted(self._segments):
+            if segment_number < number:
+                continue
+            if segment_number > number:
+                offset = 0
+            segment = self._segments[segment_number]
+            while True:
+                record = segment.read(offset)
+                if record is None:
+                    break
+                headers, body, next_offset = record
+                yield segment_number, offset, headers, bytes(body), next_offset
+                offset = next_offset
+
+    def _commit(self, number, offset):
+        path = os.path.join(self.directory, 'checkpoint')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_CHECKPOINT.pack(number, offset))
+        os.replace(path + '.tmp', path)
+        self._read_segment, self._read_offset = number, offset
+        self._pending -= 1
+
+        for old in [n for n in self._segments if n < number]:
+            self._segments.pop(old).close()
+            os.remove(self._segment_path(old))
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, 'checkpoint'), 'rb') as f:
+                return _CHECKPOINT.unpack(f.read())
+        except (OSError, struct.error):
+            return 0, 0
+
+    def _new_segment(self, number, size):
+        segment = _Segment(self._segment_path(number), number, size)
+        self._segments[number] = segment
+        return segment
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, '%016d%s' % (number, _SEGMENT_SUFFIX))
+
+
+class JournalDrainer(threading.Thread):
+    """A background thread that periodically replays a journal, so that
+    messages spilled to it are published once their destination can be
+    reached again.
+    """
+
+    def __init__(self, journal, publish, interval=5):
+        """Create a new instance of the JournalDrainer class. Call start to
+        begin draining.
+
+        :param journal: The Journal to drain
+        :param publish: Called with the body and headers of each record.
+            Should raise if the record could not be published
+        :param interval: Seconds between attempts to drain the journal
+
+        :returns: Object of type JournalDrainer
+        :rtype: JournalDrainer
+
+        """
+        super().__init__(name='journal-drainer', daemon=True)
+        self.journal = journal
+        self.publish = publish
+        self.interval = interval
+        self.replay_rate = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.drain()
+
+    def drain(self):
+        """
+        Replay the journal now.
+
+        :returns: The number of records replayed
+        :rtype: int
+
+        """
+        if not len(self.journal):
+            return 0
+        started = time.monotonic()
+        before = self.journal.replayed
+        try:
+            self.journal.replay(self.publish)
+        except Exception:
+            logger.warning("Unable to drain journal", pending=len(self.journal))
+        replayed = self.journal.replayed - before
+        if replayed:
+            self.replay_rate = replayed / max(time.monotonic() - started, 1e-6)
+            logger.info("Drained journal", replayed=replayed)
+        return replayed
+
+    def stop(self):
+        """
+        Stop draining. The journal is left open.
+
+        :returns: None
+
+        """
+        self._stopped.set()
@@ -0,0 +1,271 @@
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _Metric(object):
+    """A named metric with a child per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        """
+        Get the child of this metric for a set of label values. Keep hold of
+        the child rather than calling labels for every update.
+
+        :returns: The child, which is updated like the metric itself
+        :rtype: object
+
+        """
+        key = tuple(sorted(labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def children(self):
+        """
+        :returns: (labels, child) pairs, labels being a tuple of (name, value)
+        :rtype: list
+
+        """
+        with self._lock:
+            return sorted(self._children.items())
+
+    def _new_child(self):
+        raise NotImplementedError('_new_child not implemented')
+
+
+class Counter(_Metric):
+    """A count that only goes up, such as of messages delivered."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Histogram(_Metric):
+    """A distribution of observed values, such as processing times, counted
+    into cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class Registry(object):
+    """A collection of metrics, looked up by name."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation):
+        """
+        Get the counter called name, creating it on first use.
+
+        :rtype: Counter
+
+        """
+        return self._get(Counter, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        """
+        Get the histogram called name, creating it on first use.
+
+        :rtype: Histogram
+
+        """
+        return self._get(Histogram, name, documentation, buckets)
+
+    def collect(self):
+        """
+        :returns: Every metric in the registry, ordered by name
+        :rtype: list
+
+        """
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError('%s is already registered as a %s' % (name, metric.kind))
+            return metric
+
+
+registry = Registry()
+
+
+class ConsumerMetrics(object):
+    """The metrics a consumer updates, labelled with its queue."""
+
+    def __init__(self, registry, queue):
+        self.deliveries = registry.counter('sdc_rabbit_deliveries_total',
+                                           'Messages delivered to consumers').labels(queue=queue)
+        self.acks = registry.counter('sdc_rabbit_acks_total', 'Messages acknowledged').labels(queue=queue)
+        self.nacks = registry.counter('sdc_rabbit_nacks_total',
+                                      'Messages negatively acknowledged').labels(queue=queue)
+        self.rejects = registry.counter('sdc_rabbit_rejects_total', 'Messages rejected').labels(queue=queue)
+        self.quarantines = registry.counter('sdc_rabbit_quarantines_total',
+                                            'Messages published to quarantine').labels(queue=queue)
+        self.retries = registry.counter('sdc_rabbit_retries_total',
+                                        'Messages published to a retry queue').labels(queue=queue)
+        self.spills = registry.counter('sdc_rabbit_spills_total',
+                                       'Messages written to the spill journal').labels(queue=queue)
+        self.duplicates = registry.counter('sdc_rabbit_duplicates_total',
+                                           'Redelivered messages acknowledged without processing as already processed'
+                                           ).labels(queue=queue)
+        self.reconnects = registry.counter('sdc_rabbit_reconnects_total',
+                                           'Connections reopened after being lost').labels(queue=queue)
+        self.process_seconds = registry.histogram('sdc_rabbit_process_seconds',
+                                                  'Time from delivery to the outcome of processing').labels(queue=queue)
+        self.connect_seconds = registry.histogram('sdc_rabbit_connect_seconds',
+                                                  'Time taken to open a connection').labels(queue=queue)
+        self.deserialise_seconds = registry.histogram('sdc_rabbit_deserialise_seconds',
+                                                      'Time taken to deserialise a message body').labels(queue=queue)
+        self.decompress_seconds = registry.histogram('sdc_rabbit_decompress_seconds',
+                                                     'Time taken to decompress a message body').labels(queue=queue)
+        self.reconnect_seconds = registry.histogram('sdc_rabbit_reconnect_seconds',
+                                                    'Time from losing a connection to reopening it',
+                                                    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)).labels(queue=queue)
+
+
+class PublisherMetrics(object):
+    """The metrics a publisher updates, labelled with the exchange or queue
+    it publishes to."""
+
+    def __init__(self, registry, destination, codec=None):
+        self.publishes = registry.counter('sdc_rabbit_publishes_total',
+                                          'Messages published').labels(destination=destination)
+        self.publish_failures = registry.counter('sdc_rabbit_publish_failures_total',
+                                                 'Messages that could not be published').labels(destination=destination)
+        self.confirm_seconds = registry.histogram('sdc_rabbit_confirm_seconds',
+                                                  'Time from publishing a message to its confirm').labels(destination=destination)
+        self.connect_seconds = registry.histogram('sdc_rabbit_publisher_connect_seconds',
+                                                  'Time taken by a publisher to connect').labels(destination=destination)
+        self.compression_ratio = registry.histogram('sdc_rabbit_compression_ratio',
+                                                    'Size of each compressed message body relative to the original',
+                                                    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+                                                    ).labels(destination=destination, codec=codec or '')
+        self.compression_seconds = registry.histogram('sdc_rabbit_compression_seconds',
+                                                      'Time taken to compress a message body'
+                                                      ).labels(destination=destination, codec=codec or '')
+        self._destination = destination
+        self._serialise_seconds = registry.histogram('sdc_rabbit_serialise_seconds',
+                                                     'Time taken to serialise a message')
+
+    def serialise_seconds(self, content_type):
+        """
+        :returns: The histogram of serialisation time for a content_type
+        :rtype: object
+
+        """
+        return self._serialise_seconds.labels(destination=self._destination, content_type=content_type)
+
+
+class Exporter(object):
+    """Base class for exporters, which render the metrics in a registry."""
+
+    def export(self, registry=registry):
+        raise NotImplementedError('export not implemented')
+
+
+class PrometheusExporter(Exporter):
+    """Renders metrics in the Prometheus text exposition format."""
+
+    def export(self, registry=registry):
+        """
+        :param registry: The Registry to render. Defaults to the global one
+
+        :returns: The metrics as Prometheus text
+        :rtype: str
+
+        """
+        lines = []
+        for metric in registry.collect():
+            lines.append('# HELP %s %s' % (metric.name, _escape_help(metric.documentation)))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for labels, child in metric.children():
+                if metric.kind == 'counter':
+                    lines.append(_sample(metric.name, labels, child.value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), child.counts):
+                    cumulative += count
+                    lines.append(_sample(metric.name + '_bucket', labels + (('le', _number(bound)),), cumulative))
+                lines.append(_sample(metric.name + '_sum', labels, child.sum))
+                lines.append(_sample(metric.name + '_count', labels, child.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels, value):
+    if labels:
+        rendered = ','.join('%s="%s"' % (key, _escape_label(value)) for key, value in labels)
+        name = '%s{%s}' % (name, rendered)
+    return '%s %s' % (name, _number(value))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+
+from structlog import wrap_logger
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class _Node(object):
+    """What a NodeSelector knows about one broker URL."""
+
+    def __init__(self, url, index):
+        self.url = url
+        self.index = index
+        self.latency = None
+        self.failures = 0
+        self.open_until = None
+
+
+class NodeSelector(object):
+    """Chooses which broker URL to connect to next.
+
+    Each URL has a circuit breaker. A URL that fails failure_threshold times
+    in a row has its circuit opened for cooldown seconds, during which it is
+    only tried once every other URL has failed. A successful connection
+    closes the circuit again.
+
+    URLs with a closed circuit are ordered by their measured connect latency,
+    lowest first, with the last healthy URL preferred on a tie and URLs that
+    have never connected tried after those that have.
+
+    A selector is safe to share between threads.
+
+    """
+
+    def __init__(self, urls, cooldown=30, failure_threshold=1, smoothing=0.3):
+        """Create a new instance of the NodeSelector class
+
+        :param urls: List of RabbitMQ cluster URLs
+        :param cooldown: Seconds that a failing URL's circuit stays open
+        :param failure_threshold: Consecutive failures that open a URL's circuit
+        :param smoothing: Weight given to each new latency measurement in the
+            moving average
+
+        :returns: Object of type NodeSelector
+        :rtype: NodeSelector
+
+        """
+        self.cooldown = cooldown
+        self.failure_threshold = failure_threshold
+        self.smoothing = smoothing
+        self.last_healthy = None
+        self._nodes = {}
+        for index, url in enumerate(urls):
+            self._nodes.setdefault(url, _Node(url, index))
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        """
+        Order the URLs in which connections should be attempted.
+
+        :returns: Every URL, best first, with open circuits last
+        :rtype: list
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            nodes = sorted(self._nodes.values(), key=lambda node: self._rank(node, now))
+        return [node.url for node in nodes]
+
+    def select(self):
+        """
+        :returns: The URL that the next connection should be made to
+        :rtype: str
+
+        """
+        return self.candidates()[0]
+
+    def succeeded(self, url, latency=None):
+        """
+        Record a successful connection, closing url's circuit.
+
+        :param url: The URL that was connected to
+        :param latency: Seconds that the connection took to open
+
+        :returns: None
+
+        """
+        with self._lock:
+            node = self._nodes.get(url)
+            if node is None:
+                return
+            if node.open_until is not None:
+                logger.info("Closing circuit to rabbit node", url=_redact(url))
+            node.failures = 0
+            node.open_until = None
+            if latency is not None:
+                if node.latency is None:
+                    node.latency = latency
+                else:
+                    node.latency += self.smoothing * (latency - node.latency)
+            self.last_healthy = url
+
+    def failed(self, url):
+        """
+        Record a failed or lost connection, opening url's circuit once it
+        has failed failure_threshold times in a row.
+
+        :param url: The URL that could not be connected to
+
+        :returns: None
+
+        """
+        with self._lock:
+            node = self._nodes.get(url)
+            if node is None:
+                return
+            node.failures += 1
+            if self.last_healthy == url:
+                self.last_healthy = None
+            if node.failures >= self.failure_threshold:
+                if node.open_until is None:
+                    logger.warning("Opening circuit to rabbit node", url=_redact(url), cooldown=self.cooldown)
+                node.open_until = time.monotonic() + self.cooldown
+
+    def stats(self):
+        """
+        Report the state of each URL.
+
+        :returns: Latency, consecutive failures and circuit state keyed by URL
+        :rtype: dict
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                node.url: {
+                    'latency': node.latency,
+                    'failures': node.failures,
+                    'circuit_open': self._is_open(node, now),
+                }
+                for node in self._nodes.values()
+            }
+
+    def _rank(self, node, now):
+        if self._is_open(node, now):
+            return (1, node.open_until, 0, 0, node.index)
+        return (0,
+                node.latency is None,
+                node.latency or 0,
+                node.url != self.last_healthy,
+                node.index)
+
+    @staticmethod
+    def _is_open(node, now):
+        return node.open_until is not None and node.open_until > now
+
+
+def _redact(url):
+    """Strip any credentials from url before it is logged."""
+    scheme, sep, rest = url.rpartition('://')
+    return scheme + sep + rest.rpartition('@')[2]
+
+
+_selectors = {}
+_selectors_lock = threading.Lock()
+
+
+def node_selector(urls):
+    """
+    Get the process-wide selector for a list of broker URLs, creating it on
+    first use, so that every consumer and publisher of the same cluster
+    shares what is known about its nodes.
+
+    :param urls: List of RabbitMQ cluster URLs
+
+    :returns: The shared selector
+    :rtype: NodeSelector
+
+    """
+    key = tuple(urls)
+    with _selectors_lock:
+        if key not in _selectors:
+            _selectors[key] = NodeSelector(urls)
+        return _selectors[key]
@@ -0,0 +1,212 @@
+import logging
+import threading
+
+import pika
+from structlog import wrap_logger
+
+from sdc.rabbit.exceptions import ConnectionPoolExhaustedError
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class _PooledConnection(object):
+    """A connection held by a ConnectionPool along with the channels it
+    has handed out.
+    """
+
+    def __init__(self, url, connection):
+        self.url = url
+        self.connection = connection
+        self.channels = set()
+
+    @property
+    def is_open(self):
+        return self.connection.is_open
+
+
+class ConnectionPool(object):
+    """A pool of blocking connections to RabbitMQ, keyed by broker URL.
+
+    Publishers that share a pool multiplex their channels over a bounded set
+    of connections rather than each opening its own, which saves a TCP
+    connection, TLS handshake and heartbeat timer per publisher.
+
+    pika's BlockingConnection is not thread safe, so a pool should only be
+    shared between publishers that are used from the same thread.
+
+    """
+
+    def __init__(self, max_connections_per_url=1, max_channels_per_connection=64):
+        """Create a new instance of the ConnectionPool class
+
+        :param max_connections_per_url: Maximum number of connections to open
+            to a single broker URL
+        :param max_channels_per_connection: Maximum number of channels to hand
+            out from a single connection
+
+        :returns: Object of type ConnectionPool
+        :rtype: ConnectionPool
+
+        """
+        self._max_connections_per_url = max_connections_per_url
+        self._max_channels_per_connection = max_channels_per_connection
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._connections_opened = 0
+        self._connections_evicted = 0
+        self._channels_opened = 0
+        self._channels_released = 0
+
+    def acquire(self, url):
+        """
+        Open a channel to the broker at url, reusing a pooled connection
+        where one has capacity.
+
+        :param url: RabbitMQ URL
+
+        :returns: The connection and a newly opened channel on it
+        :rtype: tuple
+
+        """
+        with self._lock:
+            pooled = self._evict_dead(url)
+            available = [p for p in pooled if len(p.channels) < self._max_channels_per_connection]
+
+            if available:
+                entry = min(available, key=lambda p: len(p.channels))
+            elif len(pooled) < self._max_connections_per_url:
+                logger.info("Opening pooled connection to rabbit")
+                entry = _PooledConnection(url, pika.BlockingConnection(pika.URLParameters(url)))
+                pooled.append(entry)
+                self._connections_opened += 1
+            else:
+                raise ConnectionPoolExhaustedError
+
+            channel = entry.connection.channel()
+            entry.channels.add(channel)
+            self._channels_opened += 1
+            return entry.connection, channel
+
+    def channel(self, connection):
+        """
+        Open another channel on a connection the pool has handed out, for a
+        publisher that needs a second channel on the connection it holds.
+
+        :param connection: A connection previously returned by acquire
+
+        :returns: A newly opened channel on connection
+        :rtype: pika.adapters.blocking_connection.BlockingChannel
+
+        :raises ConnectionPoolExhaustedError: If connection has no capacity
+            for another channel
+
+        """
+        with self._lock:
+            for pooled in self._connections.values():
+                for entry in pooled:
+                    if entry.connection is connection:
+                        if len(entry.channels) >= self._max_channels_per_connection:
+                            raise ConnectionPoolExhaustedError
+                        channel = connection.channel()
+                        entry.channels.add(channel)
+                        self._channels_opened += 1
+                        return channel
+        raise ValueError('connection was not acquired from this pool')
+
+    def release(self, channel):
+        """
+        Return a channel to the pool, closing it. The underlying connection
+        is left open for other publishers.
+
+        :param channel: A channel previously returned by acquire
+
+        :returns: None
+
+        """
+        with self._lock:
+            for pooled in self._connections.values():
+                for entry in pooled:
+                    if channel in entry.channels:
+                        entry.channels.discard(channel)
+                        self._channels_released += 1
+                        if channel.is_open:
+                            channel.close()
+                        return
+
+    def evict_dead(self):
+        """
+        Drop every pooled connection that is no longer open.
+
+        :returns: None
+
+        """
+        with self._lock:
+            for url in list(self._connections):
+                self._evict_dead(url)
+
+    def close(self):
+        """
+        Close every pooled connection.
+
+        :returns: None
+
+        """
+        with self._lock:
+            for pooled in self._connections.values():
+                for entry in pooled:
+                    if entry.is_open:
+                        entry.connection.close()
+            self._connections = {}
+        logger.info("Closed connection pool")
+
+    def stats(self):
+        """
+        Report the state of the pool.
+
+        :returns: Counts of connections and channels, overall and per URL
+        :rtype: dict
+
+        """
+        with self._lock:
+            urls = {}
+            for url, pooled in self._connections.items():
+                urls[url] = {
+                    'connections': len(pooled),
+                    'channels': sum(len(p.channels) for p in pooled),
+                }
+            return {
+                'connections_opened': self._connections_opened,
+                'connections_evicted': self._connections_evicted,
+                'channels_opened': self._channels_opened,
+                'channels_released': self._channels_released,
+                'urls': urls,
+            }
+
+    def _evict_dead(self, url):
+        pooled = self._connections.setdefault(url, [])
+        live = [p for p in pooled if p.is_open]
+        evicted = len(pooled) - len(live)
+        if evicted:
+            logger.warning("Evicting dead pooled connections", count=evicted)
+            self._connections_evicted += evicted
+        self._connections[url] = live
+        return live
+
+
+_shared_pools = threading.local()
+
+
+def shared_pool():
+    """
+    Get the connection pool shared by publishers used from the current
+    thread, creating it on first use. Each thread has its own, as pooled
+    connections must not be used from more than one thread.
+
+    :returns: The current thread's pool
+    :rtype: ConnectionPool
+
+    """
+    pool = getattr(_shared_pools, 'pool', None)
+    if pool is None:
+        pool = _shared_pools.pool = ConnectionPool()
+    return pool
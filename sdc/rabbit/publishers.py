@@ -1,14 +1,51 @@
+import asyncio
 import logging
+import threading
+import time
+from concurrent.futures import Future
 
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
 from pika.exceptions import ConnectionWrongStateError, NackError, UnroutableError
 from structlog import wrap_logger
 
-from sdc.rabbit.exceptions import PublishMessageError
+from sdc.rabbit.compression import Compressor
+from sdc.rabbit.confirms import ACKED, NACKED, RETURNED, UNCONFIRMED, ConfirmTracker
+from sdc.rabbit.exceptions import ConnectionPoolExhaustedError, PublishMessageError
+from sdc.rabbit.hotpath import HotPathLogger
+from sdc.rabbit.journal import JournalDrainer
+from sdc.rabbit.metrics import PublisherMetrics, registry
+from sdc.rabbit.nodes import node_selector
+from sdc.rabbit.serialisation import JSON, serialisers
+from sdc.rabbit.topology import DECLARE, PASSIVE, SKIP, shared_topology
 
 logger = wrap_logger(logging.getLogger(__name__))
 
 
+class BatchResult(object):
+    """The outcome of publishing a batch of messages. Each failed message is
+    identified by its position in the batch.
+    """
+
+    def __init__(self):
+        self.published = 0
+        self.nacked = []
+        self.returned = []
+        self.unconfirmed = []
+
+    @property
+    def ok(self):
+        return not (self.nacked or self.returned or self.unconfirmed)
+
+    def _record(self, index, outcome):
+        if outcome == NACKED:
+            self.nacked.append(index)
+        elif outcome == RETURNED:
+            self.returned.append(index)
+        elif outcome == UNCONFIRMED:
+            self.unconfirmed.append(index)
+
+
 class Publisher(object):
     """Base class for publishers to RabbitMQ."""
 
@@ -17,6 +54,37 @@ class Publisher(object):
 
         :param urls: List of RabbitMQ cluster URLs
         :param confirm_delivery: Delivery confirmations toggle
+        :param persistent: Keep a single connection and channel open between
+            publishes, reconnecting only when it has failed
+        :param pool: sdc.rabbit.pool.ConnectionPool to take a channel from
+            instead of opening a dedicated connection. Implies persistent
+        :param max_outstanding: Maximum number of messages published with
+            publish_message_nowait that may await a confirm at once
+        :param nodes: sdc.rabbit.nodes.NodeSelector that orders the URLs to
+            try. Defaults to the one shared by every consumer and publisher
+            of the same URLs
+        :param topology_mode: How to treat the exchange or queue once it is
+            known to have been declared on a broker. DECLARE declares it
+            again on each connection, PASSIVE only checks that it exists and
+            SKIP makes no declaration
+        :param topology: sdc.rabbit.topology.TopologyRegistry recording what
+            has been declared. Defaults to the one shared by the process
+        :param metrics: sdc.rabbit.metrics.Registry to record metrics in.
+            Defaults to the global one
+        :param log_sample_rate: Fraction of the lines logged for each
+            published message to write. Failures are always logged in full
+        :param log_summary_interval: If set, seconds between lines counting
+            the per-message lines, including those sampled out
+        :param compression: Name of a codec in sdc.rabbit.compression to
+            compress message bodies with, setting their content_encoding:
+            deflate, or zstd or lz4 if installed
+        :param compression_threshold: Size in bytes below which message
+            bodies are not compressed. Defaults to 1024
+        :param compression_level: Compression level, or None for the codec's
+            default
+        :param serialisers: sdc.rabbit.serialisation.SerialiserRegistry used
+            to serialise messages that are not bytes or str, by content_type.
+            Defaults to the global one
         :param **kwargs: Custom key/value pairs passed to the arguments
             parameter of pika's channel.exchange_declare method
 
@@ -28,14 +96,121 @@ class Publisher(object):
         self._arguments = kwargs
         self._connection = None
         self._channel = None
+        self._confirm_channel = None
         self._confirm_delivery = False
         if 'confirm_delivery' in kwargs:
             self._confirm_delivery = True
             self._arguments.pop('confirm_delivery', None)
+        self._pool = self._arguments.pop('pool', None)
+        self._persistent = self._arguments.pop('persistent', False) or self._pool is not None
+        self._max_outstanding = self._arguments.pop('max_outstanding', 1000)
+        self._nodes = self._arguments.pop('nodes', None) or node_selector(urls)
+        self._topology_mode = self._arguments.pop('topology_mode', DECLARE)
+        self._topology = self._arguments.pop('topology', None)
+        if self._topology is None:
+            self._topology = shared_topology()
+        self._url = None
+        self._metrics_registry = self._arguments.pop('metrics', None) or registry
+        self._publisher_metrics = None
+        self._log = HotPathLogger(__name__,
+                                  self._arguments.pop('log_sample_rate', 1),
+                                  self._arguments.pop('log_summary_interval', None))
+        self._compressor = None
+        compression = self._arguments.pop('compression', None)
+        compression_threshold = self._arguments.pop('compression_threshold', 1024)
+        compression_level = self._arguments.pop('compression_level', None)
+        if compression is not None:
+            self._compressor = Compressor(compression, compression_threshold, compression_level)
+        self._serialisers = self._arguments.pop('serialisers', None) or serialisers
+        self._confirms = ConfirmTracker(observe=lambda seconds: self._metrics.confirm_seconds.observe(seconds))
 
-    def _declare(self):
+    def _declare(self, passive=False, channel=None):
         raise NotImplementedError('_declare not implemented')
 
+    def _route(self):
+        raise NotImplementedError('_route not implemented')
+
+    @property
+    def _metrics(self):
+        if self._publisher_metrics is None:
+            try:
+                exchange, routing_key = self._route()
+            except NotImplementedError:
+                exchange, routing_key = '', ''
+            codec = self._compressor.codec.name if self._compressor is not None else None
+            self._publisher_metrics = PublisherMetrics(self._metrics_registry, exchange or routing_key, codec)
+        return self._publisher_metrics
+
+    def _serialise(self, message, content_type=None):
+        """
+        Serialise a message that is not already bytes or str with the
+        serialiser registered for content_type, which defaults to JSON.
+
+        :returns: The message body and its content_type
+        :rtype: tuple
+
+        :raises ValueError: If no serialiser is registered for content_type
+
+        """
+        if isinstance(message, (bytes, str)):
+            return message, content_type
+        content_type = content_type or JSON
+        serialiser = self._serialisers.get(content_type)
+        if serialiser is None:
+            raise ValueError('No serialiser registered for %s' % content_type)
+        started = time.monotonic()
+        message = serialiser.dumps(message)
+        self._metrics.serialise_seconds(content_type).observe(time.monotonic() - started)
+        return message, content_type
+
+    def _encode(self, message, content_type=None):
+        """
+        Serialise a message if necessary, then compress it if the publisher
+        was set up to.
+
+        :returns: The body to publish, its content_type and its
+            content_encoding, which is None unless the body was compressed
+        :rtype: tuple
+
+        """
+        message, content_type = self._serialise(message, content_type)
+        if self._compressor is None:
+            return message, content_type, None
+        message, content_encoding, ratio, seconds = self._compressor.compress(message)
+        if ratio is not None:
+            self._metrics.compression_ratio.observe(ratio)
+            self._metrics.compression_seconds.observe(seconds)
+        return message, content_type, content_encoding
+
+    def _topology_key(self):
+        exchange, routing_key = self._route()
+        if exchange:
+            return 'exchange', exchange
+        return 'queue', routing_key
+
+    def _declare_topology(self):
+        """
+        Declare what is published to, unless the topology registry knows it
+        has already been declared on this broker and topology_mode says to
+        check it passively or skip it.
+
+        :returns: Whether a declaration was made
+        :rtype: bool
+
+        """
+        mode = self._topology.mode(self._url, self._topology_key(), self._topology_mode)
+        if mode == SKIP:
+            return False
+        self._declare(passive=mode == PASSIVE)
+        return True
+
+    @staticmethod
+    def _properties(content_type=None, headers=None, content_encoding=None):
+        return pika.BasicProperties(content_type=content_type,
+                                    content_encoding=content_encoding,
+                                    headers=headers,
+                                    delivery_mode=2)
+
     def _connect(self):
         """
         Connect to a RabbitMQ instance
@@ -43,28 +218,105 @@ class Publisher(object):
         :returns: Boolean corresponding to success of connection
         :rtype: bool
 
+        :raises ConnectionPoolExhaustedError: If the publisher is pooled and
+            the pool has no capacity left for the broker
+
         """
         logger.info("Connecting to rabbit")
-        for url in self._urls:
+        for url in self._nodes.candidates():
+            started = time.monotonic()
             try:
-                self._connection = pika.BlockingConnection(pika.URLParameters(url))
-                self._channel = self._connection.channel()
-                self._declare()
+                if self._pool is not None:
+                    self._connection, self._channel = self._pool.acquire(url)
+                else:
+                    self._connection = pika.BlockingConnection(pika.URLParameters(url))
+                    self._channel = self._connection.channel()
+                self._url = url
+                self._declare_topology()
+                self._topology.declared(url, self._topology_key())
                 if self._confirm_delivery:
                     self._channel.confirm_delivery()
                     logger.info("Enabled delivery confirmation")
                 logger.debug("Connected to rabbit")
+                self._nodes.succeeded(url, time.monotonic() - started)
+                self._metrics.connect_seconds.observe(time.monotonic() - started)
                 return True
 
+            except pika.exceptions.ChannelClosedByBroker:
+                # The broker is up but rejected the declaration
+                logger.exception("Unable to declare topology")
+                self._topology.forget(url)
+                self.close()
+                continue
+            except ConnectionPoolExhaustedError:
+                # A local limit, not a fault with the broker
+                logger.error("Connection pool exhausted, not connecting")
+                self.close()
+                raise
             except pika.exceptions.AMQPConnectionError:
                 logger.exception("Unable to connect to rabbit")
+                self._nodes.failed(url)
+                self.close()
                 continue
             except Exception:
                 logger.exception("Unexpected exception connecting to rabbit")
+                self._nodes.failed(url)
+                self.close()
                 continue
 
         raise pika.exceptions.AMQPConnectionError
 
+    def _is_connected(self):
+        """
+        Check whether the current connection and channel can be published on.
+
+        Any pending I/O is serviced without blocking, so a connection that
+        the broker has dropped is noticed here rather than mid-publish.
+
+        :returns: Boolean corresponding to the liveness of the connection
+        :rtype: bool
+
+        """
+        if self._connection is None or self._channel is None:
+            return False
+        try:
+            if self._connection.is_open:
+                self._connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError:
+            logger.warning("Connection to rabbit lost")
+            return False
+        return self._connection.is_open and self._channel.is_open
+
+    def _ensure_connected(self):
+        """
+        Reuse the current connection if it is still alive, otherwise connect.
+
+        :returns: Boolean corresponding to success of connection
+        :rtype: bool
+
+        """
+        if self._is_connected():
+            return True
+        if self._connection is not None and self._url is not None:
+            # The broker may have restarted, losing non-durable topology
+            self._topology.forget(self._url)
+        self.close()
+        return self._connect()
+
+    def _on_channel_closed_by_broker(self):
+        """
+        Forget the topology recorded for the current broker after it closed
+        the channel, as it does when publishing to an exchange or queue that
+        no longer exists, so that it is declared again on reconnection.
+
+        :returns: None
+
+        """
+        logger.exception("Channel closed by broker, topology will be declared again")
+        if self._url is not None:
+            self._topology.forget(self._url)
+        self.close()
+
     def _disconnect(self):
         """
         Cleanly close a RabbitMQ connection.
@@ -80,14 +332,92 @@ class Publisher(object):
         except Exception:
             logger.exception("Unable to close connection")
 
-    def _do_publish(self, message, mandatory=False, content_type=None, headers=None):
+    def close(self):
+        """
+        Close the publisher's connection to RabbitMQ, if it is open. A pooled
+        publisher returns its channel to the pool instead.
+
+        :returns: None
+
+        """
+        if self._confirm_channel is not None:
+            self._close_confirm_channel()
+            self._confirms.reset()
+        if self._pool is not None:
+            if self._channel is not None:
+                self._pool.release(self._channel)
+        elif self._connection is not None and self._connection.is_open:
+            self._disconnect()
+        self._connection = None
+        self._channel = None
+
+    def _open_confirm_channel(self):
+        """
+        Get a channel in confirm mode on the current connection whose
+        confirms are reported to self._confirms rather than awaited one at a
+        time, opening it if necessary.
+
+        :returns: The underlying pika channel
+        :rtype: pika.channel.Channel
+
+        """
+        if self._confirm_channel is not None and self._confirm_channel.is_open:
+            return self._confirm_channel._impl
+
+        self._confirms.reset()
+        if self._confirm_channel is not None:
+            self._close_confirm_channel()
+        if self._pool is not None:
+            self._confirm_channel = self._pool.channel(self._connection)
+        else:
+            self._confirm_channel = self._connection.channel()
+        # The blocking channel waits for each confirm in turn, so drive
+        # confirm mode on the channel it wraps instead
+        channel = self._confirm_channel._impl
+        selected = []
+        channel.confirm_delivery(ack_nack_callback=self._confirms.on_delivery_confirmation,
+                                 callback=selected.append)
+        channel.add_on_return_callback(self._confirms.on_message_returned)
+        self._wait_for(lambda: selected)
+        logger.debug("Opened confirm channel")
+        return channel
+
+    def _close_confirm_channel(self):
+        # A pooled confirm channel counts against its connection's channels
+        if self._pool is not None:
+            self._pool.release(self._confirm_channel)
+        elif self._confirm_channel.is_open:
+            self._confirm_channel.close()
+        self._confirm_channel = None
+
+    def _wait_for(self, predicate, timeout=None):
+        """
+        Service the connection until predicate is true or timeout expires.
+
+        :returns: Boolean corresponding to whether predicate became true
+        :rtype: bool
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            time_limit = 1
+            if deadline is not None:
+                time_limit = deadline - time.monotonic()
+                if time_limit <= 0:
+                    return False
+            self._connection.process_data_events(time_limit=time_limit)
+        return True
+
+    def _do_publish(self, message, mandatory=False, content_type=None, headers=None, content_encoding=None):
         raise NotImplementedError('_do_publish not implemented')
 
     def publish_message(self, message, content_type=None, headers=None, mandatory=False):
         """
         Publish a response message to a RabbitMQ instance.
 
-        :param message: Response message
+        :param message: Response message, as bytes or str, or an object to
+            serialise with the serialiser for content_type, which defaults
+            to JSON
         :param content_type: Pika BasicProperties content_type value
         :param headers: Message header properties
         :param mandatory: The mandatory flag
@@ -96,30 +426,202 @@ class Publisher(object):
         :rtype: bool
 
         """
-        logger.debug("Publishing message")
+        self._log.debug("Publishing message")
         try:
-            self._connect()
+            if self._persistent:
+                self._ensure_connected()
+            else:
+                self._connect()
+            message, content_type, content_encoding = self._encode(message, content_type)
+            published = time.monotonic()
             self._do_publish(mandatory=mandatory,
                              content_type=content_type,
                              headers=headers,
-                             message=message)
+                             message=message,
+                             content_encoding=content_encoding)
+            if self._confirm_delivery:
+                # The blocking channel waits for the confirm before returning
+                self._metrics.confirm_seconds.observe(time.monotonic() - published)
+            self._metrics.publishes.inc()
             return True
         except pika.exceptions.AMQPConnectionError:
             logger.error("AMQPConnectionError occurred. Message not published.")
+            self._metrics.publish_failures.inc()
+            raise PublishMessageError
+        except pika.exceptions.ChannelClosedByBroker:
+            self._on_channel_closed_by_broker()
+            self._metrics.publish_failures.inc()
             raise PublishMessageError
         except NackError:
             # raised when a message published in publisher-acknowledgments mode
             # is returned via `Basic.Return` followed by `Basic.Ack`.
             logger.error("NackError occurred. Message not published.")
+            self._metrics.publish_failures.inc()
             raise PublishMessageError
         except UnroutableError:
             # raised when a message published in publisher-acknowledgments
             # mode is returned via `Basic.Return` followed by `Basic.Ack`.
             logger.error("UnroutableError occurred. Message not published.")
+            self._metrics.publish_failures.inc()
             raise PublishMessageError
         except Exception:
             logger.exception("Unknown exception occurred. Message not published.")
+            self._metrics.publish_failures.inc()
+            raise PublishMessageError
+        finally:
+            if not self._persistent:
+                self.close()
+
+    def publish_message_nowait(self, message, content_type=None, headers=None, mandatory=False, callback=None):
+        """
+        Publish a response message to a RabbitMQ instance without waiting for
+        the broker to confirm it.
+
+        Confirms are collected whenever the publisher services its connection,
+        which happens on every publish and in flush. Once max_outstanding
+        messages are awaiting a confirm, publishing blocks until the broker
+        catches up. Closing the connection, which a non-persistent publisher
+        does after each publish_message, fails any outstanding futures.
+
+        :param message: Response message, as bytes or str, or an object to
+            serialise with the serialiser for content_type, which defaults
+            to JSON
+        :param content_type: Pika BasicProperties content_type value
+        :param headers: Message header properties
+        :param mandatory: The mandatory flag
+        :param callback: Called with the future once it is resolved
+
+        :returns: Future resolved with True once the message is acked, or
+            with PublishMessageError if it is nacked, returned or lost
+        :rtype: concurrent.futures.Future
+
+        """
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        try:
+            self._ensure_connected()
+            channel = self._open_confirm_channel()
+            if len(self._confirms) >= self._max_outstanding:
+                logger.debug("Waiting for outstanding confirms", outstanding=len(self._confirms))
+                self._wait_for(lambda: len(self._confirms) < self._max_outstanding)
+
+            exchange, routing_key = self._route()
+            message, content_type, content_encoding = self._encode(message, content_type)
+            self._confirms.add(lambda outcome: self._resolve(future, outcome))
+            channel.basic_publish(exchange=exchange,
+                                  routing_key=routing_key,
+                                  body=message,
+                                  properties=self._properties(content_type, headers, content_encoding),
+                                  mandatory=mandatory)
+        except pika.exceptions.ChannelClosedByBroker:
+            self._on_channel_closed_by_broker()
+            self._resolve(future, None)
+        except Exception:
+            logger.exception("Unable to publish message. Message not published.")
+            self._resolve(future, None)
+
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Wait for the broker to confirm every message published with
+        publish_message_nowait.
+
+        :param timeout: Seconds to wait, or None to wait indefinitely
+
+        :returns: Boolean corresponding to whether all confirms arrived
+        :rtype: bool
+
+        """
+        if not self._confirms:
+            return True
+        try:
+            return self._wait_for(lambda: not self._confirms, timeout)
+        except pika.exceptions.AMQPError:
+            logger.exception("Connection lost waiting for confirms")
+            self.close()
+            return False
+
+    def _resolve(self, future, outcome):
+        if future.done():
+            return
+        if outcome == ACKED:
+            self._metrics.publishes.inc()
+            future.set_result(True)
+        else:
+            self._metrics.publish_failures.inc()
+            logger.error("Message not published", outcome=outcome)
+            future.set_exception(PublishMessageError(outcome))
+
+    def publish_messages(self, messages, content_type=None, headers=None, mandatory=False, timeout=None):
+        """
+        Publish a batch of messages to a RabbitMQ instance, waiting for the
+        broker to confirm them once for the whole batch rather than once per
+        message.
+
+        :param messages: Iterable of messages, or of (message, headers) tuples
+            for messages that need their own headers
+        :param content_type: Pika BasicProperties content_type value
+        :param headers: Message header properties
+        :param mandatory: The mandatory flag
+        :param timeout: Seconds to wait for confirms, or None to wait
+            indefinitely
+
+        :returns: Which messages in the batch were nacked, returned or not
+            confirmed in time
+        :rtype: BatchResult
+
+        """
+        logger.debug("Publishing batch of messages")
+        result = BatchResult()
+        try:
+            if self._persistent:
+                self._ensure_connected()
+            else:
+                self._connect()
+            channel = self._open_confirm_channel()
+            exchange, routing_key = self._route()
+
+            for index, message in enumerate(messages):
+                message_headers = headers
+                if isinstance(message, tuple):
+                    message, message_headers = message
+                message, message_content_type, content_encoding = self._encode(message, content_type)
+                self._confirms.add(lambda outcome, index=index: result._record(index, outcome))
+                channel.basic_publish(exchange=exchange,
+                                      routing_key=routing_key,
+                                      body=message,
+                                      properties=self._properties(message_content_type, message_headers, content_encoding),
+                                      mandatory=mandatory)
+                result.published += 1
+
+            if not self._wait_for(lambda: not self._confirms, timeout):
+                self._confirms.fail_all()
+            failed = len(result.nacked) + len(result.returned) + len(result.unconfirmed)
+            self._metrics.publishes.inc(result.published - failed)
+            self._metrics.publish_failures.inc(failed)
+
+        except pika.exceptions.AMQPConnectionError:
+            logger.error("AMQPConnectionError occurred. Batch not published.")
+            raise PublishMessageError
+        except pika.exceptions.ChannelClosedByBroker:
+            self._on_channel_closed_by_broker()
+            raise PublishMessageError
+        except Exception:
+            logger.exception("Unknown exception occurred. Batch not published.")
             raise PublishMessageError
+        finally:
+            if not self._persistent:
+                self.close()
+
+        logger.info('Published batch of messages',
+                    published=result.published,
+                    nacked=len(result.nacked),
+                    returned=len(result.returned),
+                    unconfirmed=len(result.unconfirmed))
+        return result
 
 
 class ExchangePublisher(Publisher):
@@ -146,23 +648,24 @@ class ExchangePublisher(Publisher):
         self._exchange_type = exchange_type
         super(ExchangePublisher, self).__init__(urls, **kwargs)
 
-    def _declare(self):
-        self._channel.exchange_declare(exchange=self._exchange,
-                                       exchange_type=self._exchange_type,
-                                       durable=self._durable_exchange,
-                                       arguments=self._arguments)
+    def _declare(self, passive=False, channel=None):
+        channel = channel or self._channel
+        channel.exchange_declare(exchange=self._exchange,
+                                 exchange_type=self._exchange_type,
+                                 passive=passive,
+                                 durable=self._durable_exchange,
+                                 arguments=self._arguments)
+
+    def _route(self):
+        return self._exchange, ''
 
-    def _do_publish(self, message, mandatory=False, content_type=None, headers=None):
+    def _do_publish(self, message, mandatory=False, content_type=None, headers=None, content_encoding=None):
         self._channel.basic_publish(exchange=self._exchange,
                                     routing_key='',
                                     mandatory=mandatory,
-                                    properties=pika.BasicProperties(
-                                        content_type=content_type,
-                                        headers=headers,
-                                        delivery_mode=2
-                                    ),
+                                    properties=self._properties(content_type, headers, content_encoding),
                                     body=message)
-        logger.info('Published message to exchange', exchange=self._exchange)
+        self._log.info('Published message to exchange', exchange=self._exchange)
 
 
 class DurableExchangePublisher(ExchangePublisher):
@@ -195,19 +698,430 @@ class QueuePublisher(Publisher):
         self._queue = queue
         super(QueuePublisher, self).__init__(urls, **kwargs)
 
-    def _declare(self):
-        self._channel.queue_declare(queue=self._queue,
-                                    durable=self._durable_queue,
-                                    arguments=self._arguments)
+    def _declare(self, passive=False, channel=None):
+        channel = channel or self._channel
+        channel.queue_declare(queue=self._queue,
+                              passive=passive,
+                              durable=self._durable_queue,
+                              arguments=self._arguments)
 
-    def _do_publish(self, message, mandatory=False, content_type=None, headers=None):
+    def _route(self):
+        return '', self._queue
+
+    def _do_publish(self, message, mandatory=False, content_type=None, headers=None, content_encoding=None):
         self._channel.basic_publish(exchange='',
                                     routing_key=self._queue,
                                     mandatory=mandatory,
-                                    properties=pika.BasicProperties(
-                                        content_type=content_type,
-                                        headers=headers,
-                                        delivery_mode=2
-                                    ),
+                                    properties=self._properties(content_type, headers, content_encoding),
                                     body=message)
-        logger.info('Published message to queue', queue=self._queue)
+        self._log.info('Published message to queue', queue=self._queue)
+
+
+class AsyncioPublisher(Publisher):
+    """Base class for publishers to RabbitMQ that run on the asyncio event
+    loop. Rather than blocking, publish_message returns an asyncio future,
+    so many coroutines can publish concurrently over one connection.
+
+    Combine with ExchangePublisher, DurableExchangePublisher or
+    QueuePublisher to choose where messages are published.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._connecting = None
+        self._outstanding = set()
+        super(AsyncioPublisher, self).__init__(*args, **kwargs)
+
+    def _connect(self):
+        """
+        Connect to a RabbitMQ instance, trying each URL in the order chosen
+        by the node selector. Concurrent callers share the same connection
+        attempt.
+
+        :returns: Future resolved once the channel is open and declared
+        :rtype: asyncio.Future
+
+        """
+        if self._connecting is None:
+            logger.info("Connecting to rabbit")
+            self._connecting = asyncio.get_event_loop().create_future()
+            self._connect_next(iter(self._nodes.candidates()))
+        return self._connecting
+
+    def _connect_next(self, urls):
+        url = next(urls, None)
+        if url is None:
+            self._connected(pika.exceptions.AMQPConnectionError())
+            return
+
+        started = time.monotonic()
+
+        def on_open(connection):
+            self._nodes.succeeded(url, time.monotonic() - started)
+            self._metrics.connect_seconds.observe(time.monotonic() - started)
+            self._url = url
+            self._on_connection_open(connection)
+
+        def on_open_error(unused_connection, error):
+            logger.error("Unable to connect to rabbit", error=error)
+            self._nodes.failed(url)
+            self._connect_next(urls)
+
+        self._connection = AsyncioConnection(pika.URLParameters(url),
+                                             on_open_callback=on_open,
+                                             on_open_error_callback=on_open_error,
+                                             on_close_callback=self._on_connection_closed,
+                                             custom_ioloop=asyncio.get_event_loop())
+
+    def _connected(self, error=None):
+        connecting, self._connecting = self._connecting, None
+        if connecting is None or connecting.done():
+            return
+        if error is None:
+            logger.debug("Connected to rabbit")
+            # A declaration that fails closes the channel, forgetting it again
+            self._topology.declared(self._url, self._topology_key())
+            connecting.set_result(True)
+        else:
+            connecting.set_exception(error)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        # pika queues each RPC behind the last, so the declaration needs no
+        # callback of its own before confirm mode is selected
+        self._declare_topology()
+        if self._confirm_delivery:
+            channel.confirm_delivery(ack_nack_callback=self._confirms.on_delivery_confirmation,
+                                     callback=lambda unused_frame: self._connected())
+            channel.add_on_return_callback(self._confirms.on_message_returned)
+        else:
+            self._connected()
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning("Channel was closed", reason=reason)
+        self._channel = None
+        self._confirms.reset()
+        if isinstance(reason, pika.exceptions.ChannelClosedByBroker):
+            self._topology.forget(self._url)
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+        self._connected(pika.exceptions.AMQPConnectionError(reason))
+
+    def _on_connection_closed(self, connection, reason):
+        logger.warning("Connection closed", reason=reason)
+        if not isinstance(reason, pika.exceptions.ConnectionClosedByClient) and self._url is not None:
+            # The broker may have restarted, losing non-durable topology
+            self._topology.forget(self._url)
+        self._connection = None
+        self._channel = None
+        self._confirms.reset()
+        self._connected(pika.exceptions.AMQPConnectionError(reason))
+
+    def _is_connected(self):
+        return self._channel is not None and self._channel.is_open and self._connecting is None
+
+    def close(self):
+        """
+        Close the publisher's connection to RabbitMQ, if it is open. Any
+        messages still awaiting a confirm are failed.
+
+        :returns: None
+
+        """
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def publish_message(self, message, content_type=None, headers=None, mandatory=False):
+        """
+        Publish a response message to a RabbitMQ instance, connecting first
+        if necessary.
+
+        :param message: Response message, as bytes or str, or an object to
+            serialise with the serialiser for content_type, which defaults
+            to JSON
+        :param content_type: Pika BasicProperties content_type value
+        :param headers: Message header properties
+        :param mandatory: The mandatory flag
+
+        :returns: Future resolved with True once the message is published,
+            and confirmed if confirm_delivery is set, or with
+            PublishMessageError otherwise
+        :rtype: asyncio.Future
+
+        """
+        self._log.debug("Publishing message")
+        future = asyncio.get_event_loop().create_future()
+        self._outstanding.add(future)
+        future.add_done_callback(self._outstanding.discard)
+
+        def publish(connecting=None):
+            if connecting is not None and connecting.exception() is not None:
+                logger.error("AMQPConnectionError occurred. Message not published.")
+                self._resolve(future, None)
+                return
+            try:
+                self._publish(future, message, content_type, headers, mandatory)
+            except Exception:
+                logger.exception("Unknown exception occurred. Message not published.")
+                self._resolve(future, None)
+
+        if self._is_connected():
+            publish()
+        else:
+            self._connect().add_done_callback(publish)
+        return future
+
+    publish_message_nowait = publish_message
+
+    def _publish(self, future, message, content_type, headers, mandatory):
+        exchange, routing_key = self._route()
+        message, content_type, content_encoding = self._encode(message, content_type)
+        if self._confirm_delivery:
+            self._confirms.add(lambda outcome: self._resolve(future, outcome))
+        self._channel.basic_publish(exchange=exchange,
+                                    routing_key=routing_key,
+                                    body=message,
+                                    properties=self._properties(content_type, headers, content_encoding),
+                                    mandatory=mandatory)
+        self._log.info('Published message', exchange=exchange, routing_key=routing_key)
+        if not self._confirm_delivery:
+            self._resolve(future, ACKED)
+
+    def publish_messages(self, messages, content_type=None, headers=None, mandatory=False, timeout=None):
+        """
+        Publish a batch of messages to a RabbitMQ instance.
+
+        :param messages: Iterable of messages, or of (message, headers) tuples
+            for messages that need their own headers
+        :param content_type: Pika BasicProperties content_type value
+        :param headers: Message header properties
+        :param mandatory: The mandatory flag
+        :param timeout: Seconds to wait for confirms, or None to wait
+            indefinitely
+
+        :returns: Future resolved with a BatchResult once every message is
+            confirmed or the timeout expires
+        :rtype: asyncio.Future
+
+        """
+        result = BatchResult()
+        futures = []
+        for message in messages:
+            message_headers = headers
+            if isinstance(message, tuple):
+                message, message_headers = message
+            futures.append(self.publish_message(message, content_type, message_headers, mandatory))
+            result.published += 1
+
+        def record(unused_done):
+            for index, future in enumerate(futures):
+                if not future.done():
+                    result._record(index, UNCONFIRMED)
+                elif future.exception() is not None:
+                    outcome = (future.exception().args or (None,))[0]
+                    result._record(index, outcome or UNCONFIRMED)
+            return result
+
+        if not futures:
+            return _resolved(result)
+        return _then(asyncio.wait(futures, timeout=timeout), record)
+
+    def flush(self, timeout=None):
+        """
+        Wait for the broker to confirm every message published so far.
+
+        :param timeout: Seconds to wait, or None to wait indefinitely
+
+        :returns: Future resolved with a boolean corresponding to whether
+            all confirms arrived
+        :rtype: asyncio.Future
+
+        """
+        outstanding = list(self._outstanding)
+        if not outstanding:
+            return _resolved(True)
+        return _then(asyncio.wait(outstanding, timeout=timeout), lambda done: not done[1])
+
+
+def _resolved(result):
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(result)
+    return future
+
+
+def _then(awaitable, callback):
+    """Chain callback onto the result of awaitable without coroutine syntax."""
+    future = asyncio.get_event_loop().create_future()
+
+    def on_done(inner):
+        if inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(callback(inner.result()))
+
+    asyncio.ensure_future(awaitable).add_done_callback(on_done)
+    return future
+
+
+class AsyncioExchangePublisher(AsyncioPublisher, ExchangePublisher):
+    """This is an exchange publisher that publishes response messages to a
+    RabbitMQ exchange on the asyncio event loop.
+    """
+
+
+class AsyncioDurableExchangePublisher(AsyncioPublisher, DurableExchangePublisher):
+    """This is an exchange publisher that publishes response messages to a
+    (durable - survives a reboot) RabbitMQ exchange on the asyncio event loop.
+    """
+
+
+class AsyncioQueuePublisher(AsyncioPublisher, QueuePublisher):
+    """This is a queue publisher that publishes response messages to a
+    RabbitMQ queue on the asyncio event loop.
+    """
+
+
+class BufferedPublisher(object):
+    """Wraps a publisher so that messages published while the broker cannot
+    be reached are written to an on-disk journal instead of failing, and
+    published in order once it can be reached again.
+
+    While the journal holds messages, new messages are appended to it
+    rather than published directly, so that they are not published ahead
+    of older ones and callers are not held up by repeated connection
+    attempts. A background thread replays the journal through the wrapped
+    publisher every drain_interval seconds.
+
+    The wrapped publisher should be a blocking publisher with
+    confirm_delivery set, so that a message is only removed from the
+    journal once the broker has confirmed it. Set blocked_connection_timeout
+    in its URLs for publishes to a blocked broker to be buffered rather than
+    wait indefinitely. Message headers must be JSON serialisable.
+
+    """
+
+    def __init__(self, publisher, journal, max_bytes=1024 * 1024 * 1024, drain_interval=1):
+        """Create a new instance of the BufferedPublisher class
+
+        :param publisher: The publisher to publish messages with
+        :param journal: sdc.rabbit.journal.Journal to buffer messages in
+        :param max_bytes: Most bytes of messages to buffer. Once the journal
+            holds this much, publish_message raises PublishMessageError
+        :param drain_interval: Seconds between attempts to publish the
+            buffered messages
+
+        :returns: Object of type BufferedPublisher
+        :rtype: BufferedPublisher
+
+        """
+        self.publisher = publisher
+        self.journal = journal
+        self.max_bytes = max_bytes
+        # Decides between publishing directly and buffering. Only held
+        # across a publish while the journal is empty, so replays never
+        # hold up callers
+        self._lock = threading.Lock()
+        # Guards the wrapped publisher, which may not be thread safe
+        self._publish_lock = threading.Lock()
+        self._published = 0
+        self._buffered = 0
+        self._drainer = JournalDrainer(journal, self._replay, drain_interval)
+        self._drainer.start()
+
+    def publish_message(self, message, content_type=None, headers=None, mandatory=False):
+        """
+        Publish a message, or buffer it if it cannot be published now.
+
+        :param message: Response message, as bytes or str, or an object to
+            serialise with the serialiser for content_type, which defaults
+            to JSON
+        :param content_type: Pika BasicProperties content_type value
+        :param headers: Message header properties
+        :param mandatory: The mandatory flag
+
+        :returns: True once the message has been published or buffered
+        :rtype: bool
+
+        :raises PublishMessageError: If the message could not be published
+            and the buffer is full
+
+        """
+        if not isinstance(message, (bytes, str)):
+            message, content_type = self.publisher._serialise(message, content_type)
+
+        # Held until the message is published or buffered, so that no other
+        # message can be published directly ahead of one being buffered
+        with self._lock:
+            if not len(self.journal):
+                try:
+                    with self._publish_lock:
+                        self.publisher.publish_message(message, content_type=content_type,
+                                                       headers=headers, mandatory=mandatory)
+                        self._published += 1
+                    return True
+                except PublishMessageError:
+                    logger.warning("Unable to publish message, buffering")
+
+            if self.journal.pending_bytes >= self.max_bytes:
+                logger.error("Publish buffer is full. Message not published.", pending=len(self.journal))
+                raise PublishMessageError
+            self.journal.append(message, {'content_type': content_type,
+                                          'headers': headers,
+                                          'mandatory': mandatory})
+            self._buffered += 1
+        return True
+
+    def _replay(self, body, record):
+        # The record stays in the journal until this returns, so callers
+        # buffer rather than publish directly in the meantime
+        with self._publish_lock:
+            self.publisher.publish_message(body, content_type=record['content_type'],
+                                           headers=record['headers'], mandatory=record['mandatory'])
+            self._published += 1
+
+    def flush(self):
+        """
+        Try to publish every buffered message now.
+
+        :returns: Whether the buffer is empty
+        :rtype: bool
+
+        """
+        self._drainer.drain()
+        return not len(self.journal)
+
+    def stats(self):
+        """
+        Report the state of the buffer.
+
+        :returns: Buffered message count and bytes, disk usage, totals of
+            messages published and buffered, and the rate in messages per
+            second at which the buffer was last replayed
+        :rtype: dict
+
+        """
+        return {
+            'depth': len(self.journal),
+            'pending_bytes': self.journal.pending_bytes,
+            'disk_bytes': self.journal.disk_usage(),
+            'published': self._published,
+            'buffered': self._buffered,
+            'replayed': self.journal.replayed,
+            'replay_rate': self._drainer.replay_rate,
+        }
+
+    def close(self):
+        """
+        Stop replaying the buffer and close the wrapped publisher. Buffered
+        messages stay in the journal for the next BufferedPublisher using it.
+
+        :returns: None
+
+        """
+        self._drainer.stop()
+        with self._lock, self._publish_lock:
+            self.publisher.close()
@@ -0,0 +1,102 @@
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+JSON = 'application/json'
+
+
+class Serialiser(object):
+    """Converts message bodies of one content_type to and from Python
+    objects.
+    """
+
+    def __init__(self, content_type, dumps, loads):
+        """Create a new instance of the Serialiser class
+
+        :param content_type: The content_type it handles
+        :param dumps: Function of an object returning the body as bytes
+        :param loads: Function of a body, as bytes, returning the object.
+            Should raise an exception if the body is not valid
+
+        :returns: Object of type Serialiser
+        :rtype: Serialiser
+
+        """
+        self.content_type = content_type
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def json_serialiser():
+    """
+    :returns: A serialiser for JSON, using orjson if it is installed and the
+        standard library's json otherwise
+    :rtype: Serialiser
+
+    """
+    if orjson is not None:
+        return Serialiser(JSON, orjson.dumps, orjson.loads)
+    return Serialiser(JSON, _json_dumps, json.loads)
+
+
+def _media_type(content_type):
+    """Strip any parameters, such as charset, from a content_type."""
+    return content_type.split(';', 1)[0].strip().lower()
+
+
+class SerialiserRegistry(object):
+    """The serialisers that publishers and consumers look up by content_type.
+
+    A registry is safe to share between threads. It can be pickled, for
+    worker processes, if its serialisers can.
+
+    """
+
+    def __init__(self):
+        self._serialisers = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        with self._lock:
+            return dict(self._serialisers)
+
+    def __setstate__(self, state):
+        self._serialisers = state
+        self._lock = threading.Lock()
+
+    def register(self, serialiser):
+        """
+        Add a serialiser, replacing any already registered for its
+        content_type.
+
+        :param serialiser: The Serialiser to add
+
+        :returns: None
+
+        """
+        with self._lock:
+            self._serialisers[_media_type(serialiser.content_type)] = serialiser
+
+    def get(self, content_type):
+        """
+        :param content_type: A content_type, with or without parameters
+
+        :returns: The serialiser registered for content_type, or None
+        :rtype: Serialiser
+
+        """
+        if not content_type:
+            return None
+        return self._serialisers.get(_media_type(content_type))
+
+
+serialisers = SerialiserRegistry()
+serialisers.register(json_serialiser())
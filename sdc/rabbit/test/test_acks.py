@@ -0,0 +1,76 @@
+import unittest
+from unittest import mock
+
+from sdc.rabbit.acks import AckBatcher
+from sdc.rabbit.test.test_consumer import deliver, make_consumer
+
+
+class TestAckBatcher(unittest.TestCase):
+
+    def test_take_contiguous_acks(self):
+        acks = AckBatcher()
+        for tag in (1, 2, 3, 4):
+            acks.delivered(tag)
+        acks.acked(1)
+        acks.acked(2)
+        acks.acked(4)
+
+        self.assertEqual(acks.take(), (2, 2))
+        self.assertEqual(acks.take(), (None, 0))
+
+        acks.settled(3)
+        self.assertEqual(acks.take(), (4, 1))
+        self.assertEqual(len(acks), 0)
+
+    def test_due_by_count(self):
+        acks = AckBatcher(max_pending=2, max_delay=60)
+        acks.acked(1)
+        self.assertFalse(acks.due())
+        acks.acked(2)
+        self.assertTrue(acks.due())
+
+    def test_due_by_time(self):
+        acks = AckBatcher(max_pending=100, max_delay=0)
+        self.assertFalse(acks.due())
+        acks.acked(1)
+        self.assertTrue(acks.due())
+
+
+class TestBatchedAcknowledgements(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = make_consumer(lambda body, tx_id: None, prefetch_count=10, ack_batch_size=3,
+                                      ack_batch_interval=60)
+        self.consumer._connection = mock.Mock()
+
+    def deliver(self, delivery_tag):
+        deliver(self.consumer, delivery_tag=delivery_tag)
+
+    def test_acks_are_coalesced(self):
+        self.deliver(1)
+        self.deliver(2)
+        self.consumer._channel.basic_ack.assert_not_called()
+        self.consumer._connection.ioloop.call_later.assert_called_once_with(60, self.consumer._on_ack_timer)
+
+        self.deliver(3)
+        self.consumer._channel.basic_ack.assert_called_once_with(3, multiple=True)
+
+    def test_timer_flushes_pending_acks(self):
+        self.deliver(1)
+        self.consumer._acks.max_delay = 0
+        self.consumer._on_ack_timer()
+        self.consumer._channel.basic_ack.assert_called_once_with(1, multiple=True)
+
+    def test_stop_flushes_pending_acks(self):
+        self.deliver(1)
+        self.consumer.stop()
+        self.consumer._channel.basic_ack.assert_called_once_with(1, multiple=True)
+
+    def test_unexpected_channel_close_drops_pending_acks(self):
+        self.deliver(1)
+        self.consumer._connection.is_closing = False
+        self.consumer._connection.is_closed = False
+        with self.assertLogs(level='WARNING'):
+            self.consumer.on_channel_closed(self.consumer._channel, 'closed')
+        self.assertEqual(len(self.consumer._acks), 0)
+        self.consumer._channel.basic_ack.assert_not_called()
@@ -0,0 +1,111 @@
+import os
+import unittest
+import zlib
+from unittest import mock
+
+from sdc.rabbit import QueuePublisher
+from sdc.rabbit.compression import DEFLATE, Compressor, available, decompress
+from sdc.rabbit.metrics import Registry
+from sdc.rabbit.test.test_consumer import deliver, make_consumer, url
+from sdc.rabbit.test.test_metrics import value
+
+compressible = b'{"survey": "' + b'a' * 4096 + b'"}'
+
+
+class TestCompressor(unittest.TestCase):
+
+    def test_deflate_always_available(self):
+        self.assertIn(DEFLATE, available())
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            Compressor('brotli')
+
+    def test_compress(self):
+        body, content_encoding, ratio, seconds = Compressor(DEFLATE).compress(compressible)
+        self.assertEqual(content_encoding, DEFLATE)
+        self.assertEqual(zlib.decompress(body), compressible)
+        self.assertLess(ratio, 0.1)
+        self.assertGreaterEqual(seconds, 0)
+
+    def test_below_threshold(self):
+        self.assertEqual(Compressor(DEFLATE, threshold=10).compress('small'), (b'small', None, None, None))
+
+    def test_incompressible(self):
+        body = os.urandom(512)
+        compressed, content_encoding, ratio, _ = Compressor(DEFLATE, threshold=0).compress(body)
+        self.assertIs(compressed, body)
+        self.assertIsNone(content_encoding)
+        self.assertGreaterEqual(ratio, 1)
+
+    def test_decompress(self):
+        self.assertEqual(decompress(zlib.compress(b'body'), DEFLATE), (b'body', True))
+        self.assertEqual(decompress(b'body', None), (b'body', False))
+        self.assertEqual(decompress(b'body', 'utf-8'), (b'body', False))
+
+
+class TestPublisherCompression(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pika.BlockingConnection')
+        self.channel = patcher.start().return_value.channel.return_value
+        self.addCleanup(patcher.stop)
+        self.registry = Registry()
+
+    def published(self):
+        kwargs = self.channel.basic_publish.call_args[1]
+        return kwargs['body'], kwargs['properties'].content_encoding
+
+    def test_compressed(self):
+        publisher = QueuePublisher([url], 'test', compression=DEFLATE, metrics=self.registry)
+        publisher.publish_message(compressible.decode('utf-8'))
+        body, content_encoding = self.published()
+        self.assertEqual(content_encoding, DEFLATE)
+        self.assertEqual(zlib.decompress(body), compressible)
+        ratio = value(self.registry, 'sdc_rabbit_compression_ratio', codec=DEFLATE, destination='test')
+        self.assertEqual(ratio.count, 1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_compression_seconds', codec=DEFLATE, destination='test').count, 1)
+
+    def test_small_message_not_compressed(self):
+        publisher = QueuePublisher([url], 'test', compression=DEFLATE, compression_threshold=1024)
+        publisher.publish_message(b'{}')
+        self.assertEqual(self.published(), (b'{}', None))
+
+    def test_no_compression_by_default(self):
+        publisher = QueuePublisher([url], 'test')
+        publisher.publish_message(compressible)
+        self.assertEqual(self.published(), (compressible, None))
+
+    def test_compression_options_not_passed_to_declare(self):
+        publisher = QueuePublisher([url], 'test', compression=DEFLATE, compression_threshold=0, compression_level=9)
+        publisher.publish_message(compressible)
+        self.assertEqual(self.channel.queue_declare.call_args[1]['arguments'], {})
+
+
+class TestConsumerDecompression(unittest.TestCase):
+
+    def setUp(self):
+        self.process = mock.Mock()
+        self.registry = Registry()
+        self.consumer = make_consumer(self.process, metrics=self.registry)
+
+    def deliver(self, body, content_encoding):
+        deliver(self.consumer, body, content_encoding=content_encoding)
+
+    def test_decompressed(self):
+        self.deliver(zlib.compress(compressible), DEFLATE)
+        self.process.assert_called_once_with(compressible.decode('utf-8'), 'test')
+        self.assertEqual(value(self.registry, 'sdc_rabbit_decompress_seconds', queue='test').count, 1)
+
+    def test_other_content_encoding(self):
+        self.deliver(b'{}', 'utf-8')
+        self.process.assert_called_once_with('{}', 'test')
+
+    def test_corrupt_body_quarantined(self):
+        with self.assertLogs(level='ERROR') as cm:
+            self.deliver(b'not deflate', DEFLATE)
+        self.process.assert_not_called()
+        self.assertIn('Unable to decompress message', cm.output[0])
+        self.consumer.quarantine_publisher.publish_message.assert_called_once_with(b'not deflate',
+                                                                                   headers={'tx_id': 'test'})
+        self.consumer._channel.basic_reject.assert_called_once_with(1, requeue=False)
@@ -0,0 +1,125 @@
+import unittest
+from unittest import mock
+
+from sdc.rabbit import BatchMessageConsumer
+from sdc.rabbit.dedup import DedupStore, RedisDedupStore
+from sdc.rabbit.exceptions import RetryableError
+from sdc.rabbit.metrics import Registry
+from sdc.rabbit.test.test_consumer import deliver, make_consumer
+from sdc.rabbit.test.test_metrics import value
+
+
+class TestDedupStore(unittest.TestCase):
+
+    def test_seen_once_added(self):
+        store = DedupStore()
+        self.assertFalse(store.seen('a'))
+        store.add('a')
+        self.assertTrue(store.seen('a'))
+        self.assertFalse(store.seen('b'))
+
+    def test_least_recently_used_evicted(self):
+        store = DedupStore(max_size=2)
+        store.add('a')
+        store.add('b')
+        store.seen('a')
+        store.add('c')
+        self.assertEqual(len(store), 2)
+        self.assertTrue(store.seen('a'))
+        self.assertFalse(store.seen('b'))
+        self.assertTrue(store.seen('c'))
+
+    @mock.patch('sdc.rabbit.dedup.time.monotonic')
+    def test_expired(self, monotonic):
+        store = DedupStore(ttl=10)
+        monotonic.return_value = 100
+        store.add('a')
+        monotonic.return_value = 109
+        self.assertTrue(store.seen('a'))
+        monotonic.return_value = 110
+        self.assertFalse(store.seen('a'))
+        self.assertEqual(len(store), 0)
+
+    @mock.patch('sdc.rabbit.dedup.time.monotonic')
+    def test_expired_forgotten_on_add(self, monotonic):
+        store = DedupStore(ttl=10)
+        monotonic.return_value = 100
+        store.add('a')
+        monotonic.return_value = 200
+        store.add('b')
+        self.assertEqual(len(store), 1)
+
+    def test_invalid_max_size(self):
+        with self.assertRaises(ValueError):
+            DedupStore(max_size=0)
+
+
+class TestRedisDedupStore(unittest.TestCase):
+
+    def test_uses_client(self):
+        client = mock.Mock()
+        client.exists.return_value = 1
+        store = RedisDedupStore(client, ttl=60)
+        store.add('a')
+        client.set.assert_called_once_with('sdc-rabbit:tx_id:a', 1, ex=60)
+        self.assertTrue(store.seen('a'))
+        client.exists.assert_called_once_with('sdc-rabbit:tx_id:a')
+
+
+class TestConsumerDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.process = mock.Mock()
+        self.dedup = DedupStore()
+        self.registry = Registry()
+        self.consumer = make_consumer(self.process, dedup=self.dedup, metrics=self.registry)
+
+    def deliver(self, tx_id, redelivered=False, delivery_tag=1):
+        deliver(self.consumer, delivery_tag=delivery_tag, redelivered=redelivered, headers={'tx_id': tx_id})
+
+    def test_redelivered_duplicate_acked_without_processing(self):
+        self.deliver('a')
+        self.deliver('a', redelivered=True, delivery_tag=2)
+        self.process.assert_called_once_with('{}', 'a')
+        self.assertEqual(self.consumer._channel.basic_ack.call_args_list, [mock.call(1), mock.call(2)])
+        self.assertEqual(value(self.registry, 'sdc_rabbit_duplicates_total', queue='test').value, 1)
+
+    def test_first_delivery_not_checked(self):
+        self.dedup.add('a')
+        self.deliver('a')
+        self.process.assert_called_once_with('{}', 'a')
+
+    def test_failure_not_recorded(self):
+        self.process.side_effect = RetryableError
+        with self.assertLogs(level='ERROR'):
+            self.deliver('a')
+        self.assertFalse(self.dedup.seen('a'))
+        self.process.side_effect = None
+        self.deliver('a', redelivered=True, delivery_tag=2)
+        self.assertEqual(self.process.call_count, 2)
+        self.consumer._channel.basic_ack.assert_called_once_with(2)
+
+    def test_store_errors_ignored(self):
+        self.consumer._dedup = mock.Mock()
+        self.consumer._dedup.seen.side_effect = ConnectionError
+        self.consumer._dedup.add.side_effect = ConnectionError
+        with self.assertLogs(level='ERROR') as cm:
+            self.deliver('a', redelivered=True)
+        self.process.assert_called_once_with('{}', 'a')
+        self.consumer._channel.basic_ack.assert_called_once_with(1)
+        self.assertIn('Unable to check for duplicate message', cm.output[0])
+        self.assertIn('Unable to record processed message', cm.output[1])
+
+
+class TestBatchDedup(unittest.TestCase):
+
+    def test_batch_recorded(self):
+        batches = []
+        dedup = DedupStore()
+        consumer = make_consumer(batches.append, BatchMessageConsumer, batch_size=2, dedup=dedup)
+        consumer._connection = mock.Mock()
+        for delivery_tag, tx_id in ((1, 'a'), (2, 'b'), (3, 'a')):
+            deliver(consumer, delivery_tag=delivery_tag, redelivered=delivery_tag == 3, headers={'tx_id': tx_id})
+        self.assertEqual(len(batches), 1)
+        self.assertTrue(dedup.seen('b'))
+        self.assertEqual(consumer._channel.basic_ack.call_count, 3)
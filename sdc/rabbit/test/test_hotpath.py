@@ -0,0 +1,91 @@
+import logging
+import unittest
+from unittest import mock
+
+from sdc.rabbit.hotpath import HotPathLogger, Lazy, start_background_logging
+from sdc.rabbit.test.test_consumer import deliver, make_consumer
+
+
+class TestHotPathLogger(unittest.TestCase):
+
+    def test_logs_every_line_by_default(self):
+        log = HotPathLogger('sdc.rabbit.test')
+        with self.assertLogs(level='INFO') as cm:
+            for _ in range(3):
+                log.info('Received message')
+        self.assertEqual(len(cm.output), 3)
+        self.assertNotIn('sampled', cm.output[0])
+
+    def test_samples_lines(self):
+        log = HotPathLogger('sdc.rabbit.test', sample_rate=0.25)
+        with self.assertLogs(level='INFO') as cm:
+            for _ in range(8):
+                log.info('Received message')
+        self.assertEqual(len(cm.output), 2)
+        self.assertIn('sampled=4', cm.output[0])
+
+    def test_samples_each_event_separately(self):
+        log = HotPathLogger('sdc.rabbit.test', sample_rate=0.5)
+        with self.assertLogs(level='INFO') as cm:
+            log.info('Received message')
+            log.info('Acknowledging message')
+        self.assertEqual(len(cm.output), 2)
+
+    def test_invalid_sample_rate(self):
+        with self.assertRaises(ValueError):
+            HotPathLogger('sdc.rabbit.test', sample_rate=2)
+
+    def test_lazy_fields(self):
+        func = mock.Mock(return_value='evaluated')
+        log = HotPathLogger('sdc.rabbit.test', sample_rate=0.5)
+        with self.assertLogs(level='INFO') as cm:
+            log.info('Received message', field=Lazy(func, 'arg'))
+            log.info('Received message', field=Lazy(func, 'arg'))
+        func.assert_called_once_with('arg')
+        self.assertIn('evaluated', cm.output[0])
+
+    def test_lazy_fields_not_evaluated_below_level(self):
+        func = mock.Mock()
+        log = HotPathLogger('sdc.rabbit.test')
+        with self.assertLogs(level='INFO'):
+            log.debug('Acknowledging message', field=Lazy(func))
+            log.info('Received message')
+        func.assert_not_called()
+
+    def test_summary(self):
+        log = HotPathLogger('sdc.rabbit.test', sample_rate=0, summary_interval=0)
+        with self.assertLogs(level='INFO') as cm:
+            log.info('Received message')
+        self.assertEqual(len(cm.output), 1)
+        self.assertIn('Hot path summary', cm.output[0])
+        self.assertIn("'Received message': 1", cm.output[0])
+
+
+class TestBackgroundLogging(unittest.TestCase):
+
+    def test_records_written_by_listener(self):
+        logger = logging.getLogger('sdc.rabbit.test.background')
+        logger.propagate = False
+        self.addCleanup(setattr, logger, 'propagate', True)
+        handler = mock.Mock(level=logging.NOTSET)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        listener = start_background_logging(logger)
+        self.assertNotIn(handler, logger.handlers)
+        logger.warning('Written in the background')
+        listener.stop()
+
+        self.assertEqual(handler.handle.call_args[0][0].getMessage(), 'Written in the background')
+        self.assertEqual(logger.handlers, [handler])
+
+
+class TestConsumerSampling(unittest.TestCase):
+
+    def test_errors_logged_when_sampled_out(self):
+        process = mock.Mock(side_effect=Exception)
+        consumer = make_consumer(process, log_sample_rate=0)
+        with self.assertLogs(level='INFO') as cm:
+            deliver(consumer)
+        self.assertNotIn('Received message', ''.join(cm.output))
+        self.assertIn('Unexpected exception occurred', ''.join(cm.output))
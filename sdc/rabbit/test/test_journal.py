@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from sdc.rabbit.journal import Journal, JournalDrainer
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def journal(self, **kwargs):
+        journal = Journal(self.directory, **kwargs)
+        self.addCleanup(journal.close)
+        return journal
+
+    def replayed(self, journal):
+        records = []
+        journal.replay(lambda body, headers: records.append((body, headers)))
+        return records
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def test_replays_in_order(self):
+        journal = self.journal()
+        journal.append(b'one', {'tx_id': '1'})
+        journal.append('two', {'tx_id': '2'})
+        self.assertEqual(len(journal), 2)
+
+        self.assertEqual(self.replayed(journal), [(b'one', {'tx_id': '1'}), (b'two', {'tx_id': '2'})])
+        self.assertEqual(len(journal), 0)
+        self.assertEqual(self.replayed(journal), [])
+
+    def test_failed_publish_is_retried(self):
+        journal = self.journal()
+        journal.append(b'one')
+        journal.append(b'two')
+
+        publish = mock.Mock(side_effect=[None, Exception('unreachable')])
+        with self.assertRaises(Exception):
+            journal.replay(publish)
+        self.assertEqual(len(journal), 1)
+        self.assertEqual(self.replayed(journal), [(b'two', {})])
+
+    def test_concurrent_replays_pass_each_record_once(self):
+        journal = self.journal()
+        journal.append(b'one')
+        journal.append(b'two')
+        published = []
+        publishing = threading.Event()
+        release = threading.Event()
+
+        def publish(body, headers):
+            published.append(body)
+            publishing.set()
+            release.wait(1)
+
+        first = threading.Thread(target=journal.replay, args=(publish,))
+        first.start()
+        publishing.wait(1)
+        second = threading.Thread(target=journal.replay, args=(publish,))
+        second.start()
+        release.set()
+        first.join(1)
+        second.join(1)
+
+        self.assertEqual(published, [b'one', b'two'])
+        self.assertEqual(len(journal), 0)
+
+    def test_segments_rotate_and_are_deleted_once_replayed(self):
+        journal = self.journal(segment_size=64)
+        for i in range(5):
+            journal.append(b'x' * 20, {'i': i})
+        self.assertEqual(len(self.segments()), 5)
+
+        self.assertEqual([headers['i'] for _, headers in self.replayed(journal)], [0, 1, 2, 3, 4])
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_large_record_gets_its_own_segment(self):
+        journal = self.journal(segment_size=64)
+        journal.append(b'x' * 1000)
+        self.assertEqual(self.replayed(journal), [(b'x' * 1000, {})])
+
+    def test_reopened_journal_resumes(self):
+        journal = Journal(self.directory, segment_size=64)
+        for i in range(4):
+            journal.append(b'x' * 20, {'i': i})
+        with self.assertRaises(Exception):
+            journal.replay(mock.Mock(side_effect=[None, Exception('unreachable')]))
+        journal.close()
+
+        journal = self.journal(segment_size=64)
+        self.assertEqual(len(journal), 3)
+        journal.append(b'y', {'i': 4})
+        self.assertEqual([headers['i'] for _, headers in self.replayed(journal)], [1, 2, 3, 4])
+
+    def test_torn_record_is_discarded(self):
+        journal = Journal(self.directory)
+        journal.append(b'complete')
+        journal.append(b'torn')
+        journal.close()
+        path = os.path.join(self.directory, self.segments()[0])
+        with open(path, 'r+b') as f:
+            f.seek(12 + 2 + len(b'complete') + 12 + 2)
+            f.write(b'\xff')
+
+        journal = self.journal()
+        self.assertEqual(len(journal), 1)
+        journal.append(b'next')
+        self.assertEqual(self.replayed(journal), [(b'complete', {}), (b'next', {})])
+
+
+class TestJournalDrainer(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.journal = Journal(directory)
+        self.addCleanup(self.journal.close)
+
+    def test_drain(self):
+        self.journal.append(b'one', {'tx_id': '1'})
+        publish = mock.Mock()
+        self.assertEqual(JournalDrainer(self.journal, publish).drain(), 1)
+        publish.assert_called_once_with(b'one', {'tx_id': '1'})
+
+    def test_drain_failure_is_logged(self):
+        self.journal.append(b'one')
+        drainer = JournalDrainer(self.journal, mock.Mock(side_effect=Exception('unreachable')))
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(drainer.drain(), 0)
+        self.assertEqual(len(self.journal), 1)
+
+    def test_thread_stops(self):
+        drainer = JournalDrainer(self.journal, mock.Mock(), interval=0.01)
+        drainer.start()
+        drainer.stop()
+        drainer.join(1)
+        self.assertFalse(drainer.is_alive())
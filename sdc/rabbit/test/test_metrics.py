@@ -0,0 +1,112 @@
+import unittest
+from unittest import mock
+
+from pika.spec import Basic
+
+from sdc.rabbit import QueuePublisher
+from sdc.rabbit.confirms import ACKED, ConfirmTracker
+from sdc.rabbit.metrics import PrometheusExporter, Registry
+from sdc.rabbit.test.test_consumer import deliver, make_consumer, url
+from sdc.rabbit.test.test_data import test_data
+
+
+def value(registry, name, **labels):
+    for metric in registry.collect():
+        if metric.name == name:
+            return metric.labels(**labels)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_counter(self):
+        registry = Registry()
+        registry.counter('messages_total', 'Messages').inc(queue='a')
+        registry.counter('messages_total', 'Messages').labels(queue='a').inc(2)
+        self.assertEqual(value(registry, 'messages_total', queue='a').value, 3)
+
+    def test_name_reused_for_another_kind(self):
+        registry = Registry()
+        registry.counter('messages', 'Messages')
+        with self.assertRaises(ValueError):
+            registry.histogram('messages', 'Messages')
+
+    def test_prometheus_text(self):
+        registry = Registry()
+        registry.counter('messages_total', 'Messages\nseen').inc(queue='a"b')
+        histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        histogram.observe(0.1, queue='a')
+        histogram.observe(0.5, queue='a')
+        histogram.observe(2, queue='a')
+
+        self.assertEqual(PrometheusExporter().export(registry), '\n'.join([
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{queue="a",le="0.1"} 1',
+            'latency_seconds_bucket{queue="a",le="1"} 2',
+            'latency_seconds_bucket{queue="a",le="+Inf"} 3',
+            'latency_seconds_sum{queue="a"} 2.6',
+            'latency_seconds_count{queue="a"} 3',
+            '# HELP messages_total Messages\\nseen',
+            '# TYPE messages_total counter',
+            'messages_total{queue="a\\"b"} 1',
+        ]) + '\n')
+
+
+class TestConsumerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.consumer = make_consumer(lambda body, tx_id: None, metrics=self.registry)
+
+    def test_delivery_and_ack(self):
+        deliver(self.consumer)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_deliveries_total', queue='test').value, 1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_acks_total', queue='test').value, 1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_process_seconds', queue='test').count, 1)
+
+    def test_nack_and_reject(self):
+        self.consumer.nack_message(1)
+        self.consumer.reject_message(2)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_nacks_total', queue='test').value, 1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_rejects_total', queue='test').value, 1)
+
+    def test_reconnect(self):
+        self.consumer._connection = mock.Mock()
+        self.consumer.on_connection_closed(None, Exception('gone'))
+        self.consumer.on_connection_open(None)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_reconnects_total', queue='test').value, 1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_reconnect_seconds', queue='test').count, 1)
+
+
+class TestPublisherMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        patcher = mock.patch('pika.BlockingConnection')
+        self.connection_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_publish_and_confirm(self):
+        publisher = QueuePublisher([url], 'test', confirm_delivery=True, metrics=self.registry)
+        publisher.publish_message(test_data['valid'])
+        self.assertEqual(value(self.registry, 'sdc_rabbit_publishes_total', destination='test').value, 1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_confirm_seconds', destination='test').count, 1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_publisher_connect_seconds', destination='test').count, 1)
+
+    def test_publish_failure(self):
+        publisher = QueuePublisher([url], 'test', metrics=self.registry)
+        channel = self.connection_class.return_value.channel.return_value
+        channel.basic_publish.side_effect = Exception('failed')
+        with self.assertLogs(level='ERROR'), self.assertRaises(Exception):
+            publisher.publish_message(test_data['valid'])
+        self.assertEqual(value(self.registry, 'sdc_rabbit_publish_failures_total', destination='test').value, 1)
+
+    def test_confirm_latency(self):
+        observed = []
+        confirms = ConfirmTracker(observe=observed.append)
+        outcomes = []
+        confirms.add(outcomes.append)
+        confirms.on_delivery_confirmation(mock.Mock(method=Basic.Ack(delivery_tag=1)))
+        self.assertEqual(outcomes, [ACKED])
+        self.assertEqual(len(observed), 1)
+        self.assertGreaterEqual(observed[0], 0)
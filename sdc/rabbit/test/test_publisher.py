@@ -1,10 +1,17 @@
+import asyncio
 import logging
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 
 from pika.exceptions import AMQPConnectionError, NackError, UnroutableError
+from pika.spec import Basic
 
 from sdc.rabbit import DurableExchangePublisher, ExchangePublisher, QueuePublisher
+from sdc.rabbit import AsyncioExchangePublisher, AsyncioQueuePublisher, BufferedPublisher, Journal
 from sdc.rabbit.exceptions import PublishMessageError
 from sdc.rabbit.test.test_data import test_data
 
@@ -323,3 +330,325 @@ class TestPublisher(unittest.TestCase):
             self.durable_exchange_publisher._connect()
             with self.assertRaises(Exception):
                 self.durable_exchange_publisher.publish_message(test_data['valid'])
+
+
+class TestPersistentPublisher(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pika.BlockingConnection')
+        self.connection_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_persistent_init(self):
+        this_publisher = QueuePublisher(good_urls, queue_name, persistent=True)
+        self.assertEqual(this_publisher._persistent, True)
+        self.assertEqual(this_publisher._arguments, {})
+
+    def test_persistent_publish_reuses_connection(self):
+        this_publisher = QueuePublisher(good_urls, queue_name, persistent=True)
+        this_publisher.publish_message(test_data['valid'])
+        this_publisher.publish_message(test_data['valid'])
+
+        self.assertEqual(self.connection_class.call_count, 1)
+        connection = self.connection_class.return_value
+        self.assertEqual(connection.channel.return_value.queue_declare.call_count, 1)
+        self.assertEqual(connection.channel.return_value.basic_publish.call_count, 2)
+        connection.close.assert_not_called()
+
+    def test_persistent_publish_reconnects_when_connection_lost(self):
+        this_publisher = QueuePublisher(good_urls, queue_name, persistent=True)
+        this_publisher.publish_message(test_data['valid'])
+
+        connection = self.connection_class.return_value
+        connection.process_data_events.side_effect = AMQPConnectionError
+        this_publisher.publish_message(test_data['valid'])
+
+        self.assertEqual(self.connection_class.call_count, 2)
+
+    def test_non_persistent_publish_closes_connection(self):
+        this_publisher = QueuePublisher(good_urls, queue_name)
+        this_publisher.publish_message(test_data['valid'])
+
+        self.connection_class.return_value.close.assert_called_once_with()
+        self.assertEqual(this_publisher._connection, None)
+        self.assertEqual(this_publisher._channel, None)
+
+
+def method_frame(method):
+    return mock.Mock(method=method)
+
+
+class ConfirmChannelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pika.BlockingConnection')
+        self.connection = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+        self.publisher = QueuePublisher(good_urls, queue_name, persistent=True)
+        self.channel = self.connection.channel.return_value._impl
+        self.channel.confirm_delivery.side_effect = lambda ack_nack_callback, callback: callback(None)
+        self.confirms = []
+        self.connection.process_data_events.side_effect = self.send_confirms
+
+    def send_confirms(self, time_limit=0):
+        while self.confirms and self.publisher._confirms:
+            self.publisher._confirms.on_delivery_confirmation(method_frame(self.confirms.pop(0)))
+
+
+class TestBatchPublisher(ConfirmChannelTestCase):
+
+    def test_batch_waits_for_confirms_once(self):
+        self.confirms = [Basic.Ack(delivery_tag=3, multiple=True)]
+        result = self.publisher.publish_messages(['a', 'b', ('c', {'tx_id': 'c'})])
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.published, 3)
+        self.assertEqual(self.channel.basic_publish.call_count, 3)
+        properties = self.channel.basic_publish.call_args[1]['properties']
+        self.assertEqual(properties.headers, {'tx_id': 'c'})
+
+    def test_batch_reports_nacked_and_returned_messages(self):
+        self.confirms = [Basic.Ack(delivery_tag=1),
+                         Basic.Nack(delivery_tag=2)]
+
+        def publish(**kwargs):
+            if kwargs['body'] == 'returned':
+                self.publisher._confirms.on_message_returned(None, Basic.Return(), None, None)
+                self.confirms.append(Basic.Ack(delivery_tag=1))
+
+        self.channel.basic_publish.side_effect = publish
+        result = self.publisher.publish_messages(['a', 'b'])
+        self.assertEqual(result.nacked, [1])
+
+        self.publisher._confirms.reset()
+        result = self.publisher.publish_messages(['returned'])
+        self.assertEqual(result.returned, [0])
+        self.assertFalse(result.ok)
+
+    def test_batch_unconfirmed_after_timeout(self):
+        self.connection.process_data_events.side_effect = None
+        result = self.publisher.publish_messages(['a'], timeout=0.01)
+
+        self.assertEqual(result.unconfirmed, [0])
+        self.assertEqual(len(self.publisher._confirms), 0)
+
+    def test_batch_no_connection(self):
+        with self.assertRaises(PublishMessageError):
+            self.bad_publisher().publish_messages(['a'])
+
+    def bad_publisher(self):
+        publisher = QueuePublisher(bad_urls, queue_name)
+        publisher._connect = mock.Mock(side_effect=AMQPConnectionError)
+        return publisher
+
+
+class TestNowaitPublisher(ConfirmChannelTestCase):
+
+    def test_future_resolved_on_ack(self):
+        called = []
+        future = self.publisher.publish_message_nowait('a', callback=called.append)
+        self.assertFalse(future.done())
+
+        self.confirms = [Basic.Ack(delivery_tag=1)]
+        self.assertTrue(self.publisher.flush())
+        self.assertTrue(future.result())
+        self.assertEqual(called, [future])
+
+    def test_future_fails_on_nack(self):
+        future = self.publisher.publish_message_nowait('a')
+        self.confirms = [Basic.Nack(delivery_tag=1)]
+        self.publisher.flush()
+
+        with self.assertRaises(PublishMessageError):
+            future.result()
+
+    def test_outstanding_messages_are_capped(self):
+        self.publisher._max_outstanding = 2
+        futures = [self.publisher.publish_message_nowait('a') for _ in range(2)]
+        self.confirms = [Basic.Ack(delivery_tag=1)]
+        futures.append(self.publisher.publish_message_nowait('a'))
+
+        self.assertTrue(futures[0].done())
+        self.assertEqual(len(self.publisher._confirms), 2)
+
+    def test_close_fails_outstanding_futures(self):
+        future = self.publisher.publish_message_nowait('a')
+        self.publisher.close()
+
+        with self.assertRaises(PublishMessageError):
+            future.result()
+
+    def test_connection_error_fails_future(self):
+        self.publisher._connect = mock.Mock(side_effect=AMQPConnectionError)
+        future = self.publisher.publish_message_nowait('a')
+
+        with self.assertRaises(PublishMessageError):
+            future.result()
+
+
+class TestAsyncioPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+        self.channel = mock.MagicMock()
+        self.channel.confirm_delivery.side_effect = lambda ack_nack_callback, callback: callback(None)
+        patcher = mock.patch('sdc.rabbit.publishers.AsyncioConnection', side_effect=self.open_connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fail_urls = set()
+
+    def open_connection(self, parameters, on_open_callback, on_open_error_callback, on_close_callback, custom_ioloop):
+        connection = mock.MagicMock()
+        connection.channel.side_effect = lambda on_open_callback: on_open_callback(self.channel)
+        if parameters.port in self.fail_urls:
+            self.loop.call_soon(on_open_error_callback, connection, AMQPConnectionError())
+        else:
+            self.loop.call_soon(on_open_callback, connection)
+        return connection
+
+    def run_loop(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_concurrent_publishes_share_a_connection(self):
+        publisher = AsyncioQueuePublisher(good_urls, queue_name)
+        futures = [publisher.publish_message(test_data['valid']) for _ in range(3)]
+
+        self.assertEqual(self.run_loop(asyncio.gather(*futures)), [True, True, True])
+        self.assertEqual(self.channel.basic_publish.call_count, 3)
+        self.channel.queue_declare.assert_called_once_with(queue=queue_name, passive=False, durable=True, arguments={})
+
+    def test_confirmed_publish_waits_for_ack(self):
+        publisher = AsyncioExchangePublisher(good_urls, exchange_name, confirm_delivery=True)
+        future = publisher.publish_message(test_data['valid'])
+        self.run_loop(asyncio.sleep(0))
+        self.assertFalse(future.done())
+
+        publisher._confirms.on_delivery_confirmation(mock.Mock(method=Basic.Ack(delivery_tag=1)))
+        self.assertTrue(self.run_loop(future))
+
+    def test_nacked_publish_raises(self):
+        publisher = AsyncioQueuePublisher(good_urls, queue_name, confirm_delivery=True)
+        future = publisher.publish_message(test_data['valid'])
+        self.run_loop(asyncio.sleep(0))
+
+        publisher._confirms.on_delivery_confirmation(mock.Mock(method=Basic.Nack(delivery_tag=1)))
+        with self.assertRaises(PublishMessageError):
+            self.run_loop(future)
+
+    def test_connect_tries_each_url(self):
+        self.fail_urls = {672}
+        publisher = AsyncioQueuePublisher(loop_urls, queue_name)
+        self.assertTrue(self.run_loop(publisher.publish_message(test_data['valid'])))
+        self.assertEqual(self.channel.basic_publish.call_count, 1)
+
+    def test_publish_message_no_connection(self):
+        self.fail_urls = {672}
+        publisher = AsyncioQueuePublisher(bad_urls, queue_name)
+        with self.assertRaises(PublishMessageError):
+            self.run_loop(publisher.publish_message(test_data['valid']))
+
+    def test_publish_messages_reports_nacks(self):
+        publisher = AsyncioQueuePublisher(good_urls, queue_name, confirm_delivery=True)
+        batch = publisher.publish_messages(['a', 'b'])
+        self.run_loop(asyncio.sleep(0))
+        self.run_loop(asyncio.sleep(0))
+
+        publisher._confirms.on_delivery_confirmation(mock.Mock(method=Basic.Ack(delivery_tag=1)))
+        publisher._confirms.on_delivery_confirmation(mock.Mock(method=Basic.Nack(delivery_tag=2)))
+        result = self.run_loop(batch)
+        self.assertEqual(result.published, 2)
+        self.assertEqual(result.nacked, [1])
+
+    def test_connection_lost_fails_outstanding(self):
+        publisher = AsyncioQueuePublisher(good_urls, queue_name, confirm_delivery=True)
+        future = publisher.publish_message(test_data['valid'])
+        self.run_loop(asyncio.sleep(0))
+
+        publisher._on_connection_closed(publisher._connection, 'lost')
+        with self.assertRaises(PublishMessageError):
+            self.run_loop(future)
+
+
+class TestBufferedPublisher(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.journal = Journal(directory)
+        self.addCleanup(self.journal.close)
+        self.publisher = mock.Mock()
+        self.buffered = BufferedPublisher(self.publisher, self.journal, max_bytes=200, drain_interval=60)
+        self.addCleanup(self.buffered.close)
+
+    def test_publishes_directly_when_connected(self):
+        self.assertTrue(self.buffered.publish_message('a', headers={'tx_id': '1'}))
+        self.publisher.publish_message.assert_called_once_with('a', content_type=None,
+                                                               headers={'tx_id': '1'}, mandatory=False)
+        self.assertEqual(len(self.journal), 0)
+
+    def test_buffers_when_broker_unreachable(self):
+        self.publisher.publish_message.side_effect = PublishMessageError
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(self.buffered.publish_message('a', content_type='application/json'))
+        self.assertEqual(len(self.journal), 1)
+
+        self.assertTrue(self.buffered.publish_message('b'))
+        self.assertEqual(self.publisher.publish_message.call_count, 1)
+        self.assertEqual(self.buffered.stats()['depth'], 2)
+
+    def test_replays_in_order_once_reachable(self):
+        self.publisher.publish_message.side_effect = PublishMessageError
+        with self.assertLogs(level='WARNING'):
+            self.buffered.publish_message('a', content_type='application/json')
+        self.buffered.publish_message('b', headers={'tx_id': '2'}, mandatory=True)
+
+        self.publisher.publish_message.reset_mock(side_effect=True)
+        self.assertTrue(self.buffered.flush())
+        self.assertEqual(self.publisher.publish_message.call_args_list, [
+            mock.call(b'a', content_type='application/json', headers=None, mandatory=False),
+            mock.call(b'b', content_type=None, headers={'tx_id': '2'}, mandatory=True),
+        ])
+        stats = self.buffered.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['replayed'], 2)
+        self.assertIsNotNone(stats['replay_rate'])
+
+    def test_lock_held_until_buffered(self):
+        # Otherwise another thread could publish directly ahead of the message
+        locked = []
+        append = self.journal.append
+        self.journal.append = lambda *args: locked.append(self.buffered._lock.locked()) or append(*args)
+        self.publisher.publish_message.side_effect = PublishMessageError
+        with self.assertLogs(level='WARNING'):
+            self.buffered.publish_message('a')
+        self.assertEqual(locked, [True])
+
+    def test_replay_does_not_hold_up_publishing(self):
+        self.publisher.publish_message.side_effect = PublishMessageError
+        with self.assertLogs(level='WARNING'):
+            self.buffered.publish_message('a')
+        replaying = threading.Event()
+        release = threading.Event()
+        self.publisher.publish_message.side_effect = lambda *args, **kwargs: replaying.set() or release.wait(1)
+        flush = threading.Thread(target=self.buffered.flush)
+        flush.start()
+        self.addCleanup(flush.join, 1)
+        self.addCleanup(release.set)
+        replaying.wait(1)
+
+        started = time.monotonic()
+        self.assertTrue(self.buffered.publish_message('b'))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(len(self.journal), 2)
+
+    def test_full_buffer_raises(self):
+        self.publisher.publish_message.side_effect = PublishMessageError
+        with self.assertLogs(level='WARNING'):
+            self.buffered.publish_message('x' * 200)
+        with self.assertLogs(level='ERROR'), self.assertRaises(PublishMessageError):
+            self.buffered.publish_message('y')
@@ -0,0 +1,150 @@
+import unittest
+import zlib
+from unittest import mock
+
+from pika.spec import Basic
+
+from sdc.rabbit.compression import DEFLATE
+from sdc.rabbit.consumers import RETRY_COUNT_HEADER
+from sdc.rabbit.exceptions import RetryableError
+from sdc.rabbit.metrics import Registry
+from sdc.rabbit.test.test_consumer import deliver, make_consumer
+from sdc.rabbit.test.test_metrics import value
+
+
+class TestRetryQueues(unittest.TestCase):
+
+    def consumer(self, **kwargs):
+        return make_consumer(mock.Mock(), **kwargs)
+
+    def test_invalid_delays(self):
+        for retry_delays in ([], [1, 0], [-1]):
+            with self.assertRaises(ValueError):
+                self.consumer(retry_delays=retry_delays)
+
+    def test_retry_queue_names(self):
+        consumer = self.consumer(retry_delays=[0.5, 10])
+        self.assertEqual(consumer.retry_queue(0.5), 'test.retry.0.5s')
+        self.assertEqual(consumer.retry_queue(10), 'test.retry.10s')
+
+    def test_retry_queues_declared_before_consuming(self):
+        consumer = self.consumer(retry_delays=[1, 60])
+        consumer._channel = mock.Mock()
+        consumer.setup_topology()
+        declared = [c[1] for c in consumer._channel.queue_declare.call_args_list]
+        self.assertEqual([d['queue'] for d in declared], ['test', 'test.retry.1s', 'test.retry.60s'])
+        self.assertEqual(declared[2]['arguments'], {'x-message-ttl': 60000,
+                                                    'x-dead-letter-exchange': '',
+                                                    'x-dead-letter-routing-key': 'test'})
+        self.assertTrue(declared[2]['durable'])
+
+        for call in consumer._channel.queue_declare.call_args_list:
+            call[1]['callback'](None)
+        consumer._channel.basic_consume.assert_not_called()
+        consumer._channel.queue_bind.call_args[1]['callback'](None)
+        consumer._channel.exchange_declare.call_args[1]['callback'](None)
+        consumer._channel.basic_consume.assert_called_once_with('test', consumer.on_message)
+
+    def test_no_retry_queues_by_default(self):
+        consumer = self.consumer()
+        consumer._channel = mock.Mock()
+        consumer.setup_topology()
+        self.assertEqual(consumer._channel.queue_declare.call_count, 1)
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.process = mock.Mock(side_effect=RetryableError)
+        self.registry = Registry()
+        self.consumer = make_consumer(self.process, retry_delays=[1, 10], metrics=self.registry)
+        self.consumer._quarantine_channel = mock.Mock()
+
+    def deliver(self, headers, level='ERROR', **properties):
+        with self.assertLogs(level=level) as cm:
+            deliver(self.consumer, headers=headers, **properties)
+        return cm.output
+
+    def published(self):
+        return self.consumer._quarantine_channel.basic_publish.call_args[1]
+
+    def confirm(self, method):
+        self.consumer._quarantine_confirms.on_delivery_confirmation(mock.Mock(method=method(delivery_tag=1)))
+
+    def test_first_failure_retried_after_first_delay(self):
+        output = self.deliver({'tx_id': 'test'}, content_type='application/json', delivery_mode=2)
+        self.assertIn("action=retry", output[0])
+        published = self.published()
+        self.assertEqual(published['exchange'], '')
+        self.assertEqual(published['routing_key'], 'test.retry.1s')
+        self.assertEqual(published['body'], b'{}')
+        self.assertEqual(published['properties'].headers, {'tx_id': 'test', RETRY_COUNT_HEADER: 1})
+        self.assertEqual(published['properties'].content_type, 'application/json')
+        self.assertEqual(published['properties'].delivery_mode, 2)
+        self.consumer._channel.basic_ack.assert_not_called()
+        self.consumer._channel.basic_nack.assert_not_called()
+
+    def test_acked_once_retry_confirmed(self):
+        self.deliver({'tx_id': 'test'})
+        self.assertEqual(len(self.consumer._quarantine_confirms), 1)
+        self.confirm(Basic.Ack)
+        self.consumer._channel.basic_ack.assert_called_once_with(1)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_retries_total', queue='test').value, 1)
+
+    def test_nacked_if_retry_not_confirmed(self):
+        self.deliver({'tx_id': 'test'})
+        with self.assertLogs(level='ERROR'):
+            self.confirm(Basic.Nack)
+        self.consumer._channel.basic_nack.assert_called_once_with(1)
+        self.consumer._channel.basic_ack.assert_not_called()
+
+    def test_later_failure_retried_after_next_delay(self):
+        self.deliver({'tx_id': 'test', RETRY_COUNT_HEADER: 1})
+        self.assertEqual(self.published()['routing_key'], 'test.retry.10s')
+        self.assertEqual(self.published()['properties'].headers[RETRY_COUNT_HEADER], 2)
+
+    def test_quarantined_after_last_delay(self):
+        output = self.deliver({'tx_id': 'test', RETRY_COUNT_HEADER: 2})
+        self.assertIn('Message failed after every retry', output[0])
+        self.consumer.quarantine_publisher.publish_message.assert_called_once_with(b'{}', headers={'tx_id': 'test'})
+        self.consumer._channel.basic_reject.assert_called_once_with(1, requeue=False)
+        self.consumer._quarantine_channel.basic_publish.assert_not_called()
+
+    def test_unexpected_exception_retried(self):
+        self.process.side_effect = ValueError
+        self.deliver({'tx_id': 'test'})
+        self.assertEqual(self.published()['routing_key'], 'test.retry.1s')
+
+    def test_compressed_body_republished_decompressed(self):
+        deliver(self.consumer, zlib.compress(b'{}'), content_encoding=DEFLATE)
+        self.assertEqual(self.published()['body'], b'{}')
+        self.assertIsNone(self.published()['properties'].content_encoding)
+
+    def test_nacked_without_retry_channel(self):
+        self.consumer._quarantine_channel = None
+        output = self.deliver({'tx_id': 'test'}, level='WARNING')
+        self.assertIn('Unable to retry message later, no retry channel', output[0])
+        self.assertIn('action=nack', output[1])
+        self.consumer._channel.basic_nack.assert_called_once_with(1)
+
+    def test_properties_forgotten_once_processed(self):
+        self.process.side_effect = None
+        deliver(self.consumer)
+        self.assertEqual(self.consumer._retry_properties, {})
+
+
+class TestNoRetry(unittest.TestCase):
+
+    def test_nacked_by_default(self):
+        consumer = make_consumer(mock.Mock(side_effect=RetryableError))
+        with self.assertLogs(level='ERROR') as cm:
+            deliver(consumer)
+        consumer._channel.basic_nack.assert_called_once_with(1)
+        self.assertIn("action=nack", cm.output[0])
+        self.assertEqual(consumer._retry_properties, {})
+
+    def test_no_republish_channel_without_retries(self):
+        consumer = make_consumer(mock.Mock())
+        consumer._connection = mock.Mock()
+        consumer.open_quarantine_channel()
+        consumer._connection.channel.assert_not_called()
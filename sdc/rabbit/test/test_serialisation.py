@@ -0,0 +1,208 @@
+import json
+import pickle
+import unittest
+from unittest import mock
+
+from sdc.rabbit import BatchMessageConsumer, BufferedPublisher, Message, QueuePublisher
+from sdc.rabbit import serialisation
+from sdc.rabbit.exceptions import BadMessageError, PublishMessageError, RetryableError
+from sdc.rabbit.metrics import Registry
+from sdc.rabbit.serialisation import JSON, Serialiser, SerialiserRegistry, json_serialiser
+from sdc.rabbit.test.test_consumer import deliver, make_consumer, url
+from sdc.rabbit.test.test_metrics import value
+
+CSV = 'text/csv'
+
+
+def csv_dumps(rows):
+    return '\n'.join(','.join(row) for row in rows).encode('utf-8')
+
+
+def csv_loads(body):
+    return [line.split(',') for line in body.decode('utf-8').split('\n')]
+
+
+def csv_serialiser():
+    return Serialiser(CSV, csv_dumps, csv_loads)
+
+
+def rows_in_worker(rows, tx_id):
+    if not isinstance(rows, list):
+        raise BadMessageError
+    raise RetryableError(rows)
+
+
+class TestSerialiserRegistry(unittest.TestCase):
+
+    def test_json_registered_by_default(self):
+        self.assertEqual(serialisation.serialisers.get(JSON).content_type, JSON)
+
+    def test_parameters_ignored(self):
+        registry = SerialiserRegistry()
+        registry.register(csv_serialiser())
+        self.assertIsNotNone(registry.get('Text/CSV; charset=utf-8'))
+
+    def test_unknown_content_type(self):
+        self.assertIsNone(SerialiserRegistry().get(JSON))
+        self.assertIsNone(serialisation.serialisers.get(None))
+
+    def test_pickled(self):
+        registry = SerialiserRegistry()
+        registry.register(csv_serialiser())
+        self.assertEqual(pickle.loads(pickle.dumps(registry)).get(CSV).loads(b'a,b'), [['a', 'b']])
+
+    def test_json_round_trip(self):
+        serialiser = json_serialiser()
+        body = serialiser.dumps({'tx_id': 'test', 'values': [1, 2]})
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(serialiser.loads(body), {'tx_id': 'test', 'values': [1, 2]})
+
+    def test_stdlib_json_without_orjson(self):
+        with mock.patch.object(serialisation, 'orjson', None):
+            serialiser = json_serialiser()
+        self.assertEqual(serialiser.dumps({'a': 1}), b'{"a":1}')
+        self.assertEqual(serialiser.loads(b'{"a": 1}'), {'a': 1})
+
+
+class TestPublisherSerialisation(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pika.BlockingConnection')
+        self.channel = patcher.start().return_value.channel.return_value
+        self.addCleanup(patcher.stop)
+        self.registry = Registry()
+
+    def published(self):
+        kwargs = self.channel.basic_publish.call_args[1]
+        return kwargs['body'], kwargs['properties'].content_type
+
+    def test_object_serialised_as_json(self):
+        publisher = QueuePublisher([url], 'test', metrics=self.registry)
+        publisher.publish_message({'survey': '009'})
+        body, content_type = self.published()
+        self.assertEqual(json.loads(body), {'survey': '009'})
+        self.assertEqual(content_type, JSON)
+        self.assertEqual(value(self.registry, 'sdc_rabbit_serialise_seconds',
+                               destination='test', content_type=JSON).count, 1)
+
+    def test_bodies_published_as_they_are(self):
+        publisher = QueuePublisher([url], 'test')
+        publisher.publish_message(b'{}', content_type=CSV)
+        self.assertEqual(self.published(), (b'{}', CSV))
+
+    def test_own_registry(self):
+        registry = SerialiserRegistry()
+        registry.register(csv_serialiser())
+        publisher = QueuePublisher([url], 'test', serialisers=registry)
+        publisher.publish_message([['a', 'b'], ['c', 'd']], content_type=CSV)
+        self.assertEqual(self.published(), (b'a,b\nc,d', CSV))
+
+    def test_no_serialiser(self):
+        publisher = QueuePublisher([url], 'test')
+        with self.assertLogs(level='ERROR') as cm, self.assertRaises(PublishMessageError):
+            publisher.publish_message({'survey': '009'}, content_type=CSV)
+        self.assertIn('No serialiser registered for text/csv', cm.output[0])
+        self.channel.basic_publish.assert_not_called()
+
+    def test_serialisers_not_passed_to_declare(self):
+        publisher = QueuePublisher([url], 'test', serialisers=SerialiserRegistry())
+        publisher.publish_message(b'{}')
+        self.assertEqual(self.channel.queue_declare.call_args[1]['arguments'], {})
+
+
+class TestBufferedPublisherSerialisation(unittest.TestCase):
+
+    def test_buffered_object_serialised(self):
+        publisher = mock.Mock()
+        publisher.publish_message.side_effect = PublishMessageError
+        publisher._serialise.return_value = (b'{"a":1}', JSON)
+        journal = mock.Mock()
+        journal.__len__ = mock.Mock(return_value=0)
+        journal.pending_bytes = 0
+        with mock.patch('sdc.rabbit.publishers.JournalDrainer'):
+            buffered = BufferedPublisher(publisher, journal)
+        buffered.publish_message({'a': 1})
+        publisher._serialise.assert_called_once_with({'a': 1}, None)
+        journal.append.assert_called_once_with(b'{"a":1}', {'content_type': JSON, 'headers': None, 'mandatory': False})
+
+
+class TestConsumerDeserialisation(unittest.TestCase):
+
+    def setUp(self):
+        self.process = mock.Mock()
+        self.registry = Registry()
+
+    def consumer(self, **kwargs):
+        return make_consumer(self.process, metrics=self.registry, **kwargs)
+
+    def test_not_deserialised_by_default(self):
+        deliver(self.consumer(), b'{"a": 1}', content_type=JSON)
+        self.process.assert_called_once_with('{"a": 1}', 'test')
+
+    def test_deserialised(self):
+        deliver(self.consumer(deserialise=True), b'{"a": 1}', content_type=JSON)
+        self.process.assert_called_once_with({'a': 1}, 'test')
+        self.assertEqual(value(self.registry, 'sdc_rabbit_deserialise_seconds', queue='test').count, 1)
+
+    def test_json_without_content_type(self):
+        deliver(self.consumer(deserialise=True), b'[1]')
+        self.process.assert_called_once_with([1], 'test')
+
+    def test_unregistered_content_type_passed_as_body_type(self):
+        deliver(self.consumer(deserialise=True, body_type=bytes), b'a,b', content_type=CSV)
+        self.process.assert_called_once_with(b'a,b', 'test')
+
+    def test_own_registry(self):
+        registry = SerialiserRegistry()
+        registry.register(csv_serialiser())
+        deliver(self.consumer(deserialise=True, serialisers=registry), b'a,b', content_type=CSV)
+        self.process.assert_called_once_with([['a', 'b']], 'test')
+
+    def test_own_registry_used_by_worker_processes(self):
+        registry = SerialiserRegistry()
+        registry.register(csv_serialiser())
+        callbacks = []
+        consumer = make_consumer(rows_in_worker, deserialise=True, serialisers=registry, max_workers=1,
+                                 use_processes=True)
+        consumer._connection = mock.Mock()
+        consumer._connection.ioloop.add_callback.side_effect = callbacks.append
+        deliver(consumer, b'a,b', content_type=CSV)
+        consumer._executor.shutdown(wait=True)
+        with self.assertLogs(level='ERROR') as cm:
+            for callback in callbacks:
+                callback()
+        self.assertIn("[['a', 'b']]", cm.output[0])
+        consumer._channel.basic_nack.assert_called_once_with(1)
+
+    def test_invalid_body_quarantined(self):
+        consumer = self.consumer(deserialise=True)
+        with self.assertLogs(level='ERROR') as cm:
+            deliver(consumer, b'not json', content_type=JSON)
+        self.process.assert_not_called()
+        self.assertIn('Unable to deserialise message', cm.output[0])
+        consumer.quarantine_publisher.publish_message.assert_called_once_with(b'not json', headers={'tx_id': 'test'})
+        consumer._channel.basic_reject.assert_called_once_with(1, requeue=False)
+
+
+class TestBatchDeserialisation(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.consumer = make_consumer(self.batches.append, BatchMessageConsumer, batch_size=2, deserialise=True)
+        self.consumer._connection = mock.Mock()
+
+    def deliver(self, delivery_tag, body):
+        deliver(self.consumer, body, delivery_tag, content_type=JSON)
+
+    def test_batch_deserialised(self):
+        self.deliver(1, b'{"a": 1}')
+        self.deliver(2, b'[2]')
+        self.assertEqual(self.batches, [[Message({'a': 1}, 'test', 1), Message([2], 'test', 2)]])
+
+    def test_invalid_body_kept_out_of_batch(self):
+        with self.assertLogs(level='ERROR'):
+            self.deliver(1, b'not json')
+        self.consumer._channel.basic_reject.assert_called_once_with(1, requeue=False)
+        self.deliver(2, b'[2]')
+        self.deliver(3, b'[3]')
+        self.assertEqual(self.batches, [[Message([2], 'test', 2), Message([3], 'test', 3)]])
@@ -0,0 +1,94 @@
+import logging
+import threading
+
+from structlog import wrap_logger
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+DECLARE = 'declare'
+PASSIVE = 'passive'
+SKIP = 'skip'
+
+
+class TopologyRegistry(object):
+    """Records which exchanges, queues and bindings have been successfully
+    declared on each broker, so that reconnecting consumers and publishers
+    can check or skip declarations that have already been made.
+
+    Entities are identified by a tuple key such as ('queue', name). Once the
+    broker closes a channel with an error, which is how it reports a
+    declaration that conflicts with what exists, or a connection to it is
+    lost other than by the client closing it, everything recorded for that
+    broker is forgotten and will be declared again.
+
+    A registry is safe to share between threads.
+
+    """
+
+    def __init__(self):
+        self._declared = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._declared)
+
+    def mode(self, url, key, mode):
+        """
+        Decide how an entity should be declared.
+
+        :param url: The broker URL the declaration is for
+        :param key: Tuple identifying the entity
+        :param mode: DECLARE, PASSIVE or SKIP; how to treat an entity that
+            has already been declared
+
+        :returns: DECLARE if the entity has not been declared on this broker,
+            otherwise mode
+        :rtype: str
+
+        """
+        with self._lock:
+            if (url, key) in self._declared:
+                return mode
+        return DECLARE
+
+    def declared(self, url, key):
+        """
+        Record that an entity has been declared.
+
+        :returns: None
+
+        """
+        with self._lock:
+            self._declared.add((url, key))
+
+    def forget(self, url):
+        """
+        Forget everything declared on a broker.
+
+        :returns: None
+
+        """
+        with self._lock:
+            forgotten = {entry for entry in self._declared if entry[0] == url}
+            self._declared -= forgotten
+        if forgotten:
+            logger.info("Forgot declared topology", count=len(forgotten))
+
+
+_shared_topology = None
+_shared_topology_lock = threading.Lock()
+
+
+def shared_topology():
+    """
+    Get the process-wide topology registry, creating it on first use.
+
+    :returns: The shared registry
+    :rtype: TopologyRegistry
+
+    """
+    global _shared_topology
+    with _shared_topology_lock:
+        if _shared_topology is None:
+            _shared_topology = TopologyRegistry()
+        return _shared_topology
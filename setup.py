@@ -55,6 +55,11 @@ setup(
         ],
     },
     install_requires=installRequirements,
+    extras_require={
+        "zstd": ["zstandard"],
+        "lz4": ["lz4"],
+        "orjson": ["orjson"],
+    },
     entry_points={
         "console_scripts": [
         ],